@@ -1,15 +1,24 @@
-""" Automatic AWS EBS snapshot handling """
+""" Automatic AWS EBS snapshot handling
+
+Importing the package has no side effects and does not load boto. The
+command line is parsed by main(), and the functions below can be used as a
+library without it:
+
+    import automated_ebs_snapshots
+
+    connection = automated_ebs_snapshots.connect('eu-west-1')
+    automated_ebs_snapshots.watch(connection, 'vol-12345678', 'daily', 7)
+    summary = automated_ebs_snapshots.run(connection, workers=4)
+
+Modules depending on boto are imported when first needed.
+"""
+import copy
 import logging
 import logging.config
-import time
 import sys
+import time
 
-from automated_ebs_snapshots.command_line_options import args
-from automated_ebs_snapshots import config_file_parser
-from automated_ebs_snapshots import connection_manager
-from automated_ebs_snapshots import snapshot_manager
-from automated_ebs_snapshots import volume_manager
-from automated_ebs_snapshots.daemon import Daemon
+from automated_ebs_snapshots import command_line_options
 
 LOG_CONFIG = {
     'version': 1,
@@ -56,81 +65,215 @@ LOG_CONFIG = {
     }
 }
 
-if args.log_file:
-    LOG_CONFIG['handlers']['file'] = {
-        'level': 'DEBUG',
-        'class': 'logging.handlers.TimedRotatingFileHandler',
-        'formatter': 'standard',
-        'filename': args.log_file,
-        'when': 'midnight',
-        'backupCount': 5
-    }
+logger = logging.getLogger(__name__)
 
-    for logger in LOG_CONFIG['loggers'].keys():
-        LOG_CONFIG['loggers'][logger]['handlers'].append('file')
 
-logging.config.dictConfig(LOG_CONFIG)
-logger = logging.getLogger(__name__)
+def connect(region='us-east-1', access_key_id=None, secret_access_key=None):
+    """ Connect to AWS EC2
+
+    :type region: str
+    :param region: AWS region to connect to
+    :type access_key_id: str
+    :param access_key_id: AWS access key id. None == use env vars, boto
+        configuration or the instance role
+    :type secret_access_key: str
+    :param secret_access_key: AWS secret access key
+    :returns: boto.ec2.connection.EC2Connection -- EC2 connection
+    """
+    from automated_ebs_snapshots import connection_manager
+    return connection_manager.connect_to_ec2(
+        region, access_key_id, secret_access_key)
+
+
+def run(connection, force=False, bulk=False, workers=1, max_deletions=0,
+        completion_timeout=0, slots=None, volume_ids=None, shards=None):
+    """ Ensure snapshots of all watched volumes and instances
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type force: bool
+    :param force: Always create a new snapshot
+    :type bulk: bool
+    :param bulk: Fetch all snapshots in one paged sweep
+    :type workers: int
+    :param workers: Number of volumes to process concurrently
+    :type max_deletions: int
+    :param max_deletions: Maximum number of snapshots to delete. 0 == no
+        limit
+    :type completion_timeout: int
+    :param completion_timeout: Seconds to wait for the created snapshots to
+        complete. 0 == do not wait
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :type volume_ids: list
+    :param volume_ids: Only process these volumes. None == all watched
+    :type shards: automated_ebs_snapshots.sharding.Shards
+    :param shards: Only process volumes and instances in these shards.
+        None == all
+    :returns: dict -- Number of created, deleted, skipped and failed
+    """
+    from automated_ebs_snapshots import snapshot_manager
+
+    tracker = None
+    if completion_timeout:
+        tracker = snapshot_manager.new_completion_tracker()
+
+    summary = snapshot_manager.run(
+        connection,
+        force=force,
+        bulk=bulk,
+        workers=workers,
+        max_deletions=max_deletions,
+        volume_ids=volume_ids,
+        tracker=tracker,
+        slots=slots,
+        shards=shards)
+
+    if tracker is not None:
+        tracker.wait(connection, completion_timeout)
+
+    return summary
 
 
-class AutoEBSDaemon(Daemon):
-    """ Daemon for automatic-ebs-snapshots"""
+def plan(connection, force=False, bulk=False, max_deletions=0, slots=None,
+         shards=None):
+    """ Compute what run() would create and delete, without changing anything
 
-    def run(self, check_interval=300):
-        """ Run the daemon
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type force: bool
+    :param force: Plan a forced run
+    :type bulk: bool
+    :param bulk: Estimate API calls for a run with bulk fetching
+    :type max_deletions: int
+    :param max_deletions: Maximum number of snapshots to delete. 0 == no
+        limit
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :type shards: automated_ebs_snapshots.sharding.Shards
+    :param shards: Only plan volumes in these shards. None == all
+    :returns: dict -- Plan, see snapshot_manager.plan
+    """
+    from automated_ebs_snapshots import snapshot_manager
+    return snapshot_manager.plan(
+        connection,
+        force=force,
+        bulk=bulk,
+        max_deletions=max_deletions,
+        slots=slots,
+        shards=shards)
 
-        :type check_interval: int
-        :param check_interval: Delay in seconds between checks
-        """
-        while True:
-            # Read configuration from the config file if present, else fall
-            # back to command line options
-            if args.config:
-                config = config_file_parser.get_configuration(args.config)
-                access_key_id = config['access-key-id']
-                secret_access_key = config['secret-access-key']
-                region = config['region']
-            else:
-                access_key_id = args.access_key_id
-                secret_access_key = args.secret_access_key
-                region = args.region
 
-            # Connect to AWS
-            connection = connection_manager.connect_to_ec2(
-                region, access_key_id, secret_access_key)
+def watch(connection, volume_id, interval='daily', retention=0):
+    """ Start watching a volume
 
-            snapshot_manager.run(connection)
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type volume_id: str
+    :param volume_id: VolumeID or Name tag of the volume
+    :type interval: str
+    :param interval: A valid snapshotting interval
+    :type retention: str
+    :param retention: Number of snapshots to keep, or a tiered policy.
+        0 == keep all
+    :returns: bool
+    """
+    from automated_ebs_snapshots import volume_manager
+    volume_id = _get_volume_id(connection, volume_id)
+    if volume_id is None:
+        return False
+    return volume_manager.watch(connection, volume_id, interval, retention)
 
-            logger.info('Sleeping {} seconds until next check'.format(
-                check_interval))
-            time.sleep(check_interval)
 
+def unwatch(connection, volume_id):
+    """ Stop watching a volume
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type volume_id: str
+    :param volume_id: VolumeID or Name tag of the volume
+    :returns: bool
+    """
+    from automated_ebs_snapshots import volume_manager
+    volume_id = _get_volume_id(connection, volume_id)
+    if volume_id is None:
+        return False
+    return volume_manager.unwatch(connection, volume_id)
+
+
+def main(argv=None):
+    """ Main function
+
+    :type argv: list
+    :param argv: Command line arguments. None == sys.argv[1:]
+    :returns: None
+    """
+    args = command_line_options.parse_args(argv)
+
+    if args.version:
+        print('Automated EBS Snapshots version {}'.format(
+            command_line_options.get_version()))
+        return
+
+    _configure_logging(args.log_file)
+
+    # gevent must patch the standard library before boto is imported
+    if args.engine == 'gevent':
+        from automated_ebs_snapshots import worker_pool
+        try:
+            worker_pool.use_gevent()
+        except ImportError:
+            logger.error(
+                '--engine gevent requires gevent. Install it with '
+                'pip install gevent')
+            sys.exit(1)
+
+    if args.daemon == 'stop':
+        from automated_ebs_snapshots.daemon import Daemon
+        Daemon(args.pid_file).stop()
+        sys.exit(0)
+
+    if args.plan and args.format == 'csv':
+        logger.error(
+            '--format csv is only supported by --report. Use table or json '
+            'with --plan')
+        sys.exit(1)
+
+    slots = _get_slots(args)
+    shards = _get_shards(args)
 
-def main():
-    """ Main function """
     # Read configuration from the config file if present, else fall back to
     # command line options
     if args.config:
+        from automated_ebs_snapshots import config_file_parser
         config = config_file_parser.get_configuration(args.config)
         access_key_id = config['access-key-id']
         secret_access_key = config['secret-access-key']
         region = config['region']
+        targets = config['targets']
     else:
         access_key_id = args.access_key_id
         secret_access_key = args.secret_access_key
         region = args.region
+        targets = []
+
+    # Fan out over all accounts and regions if the configuration lists more
+    # than the [general] region
+    multi_target = len(targets) > 1 or bool(targets and targets[0]['account'])
 
     if args.daemon:
-        pid_file = '/tmp/automatic-ebs-snapshots.pid'
-        daemon = AutoEBSDaemon(pid_file)
+        from automated_ebs_snapshots.snapshot_daemon import AutoEBSDaemon
+
+        if multi_target:
+            logger.warning(
+                'Daemon mode only handles the [general] credentials and '
+                'region of the configuration file')
+
+        daemon = AutoEBSDaemon(args.pid_file, args, slots, shards)
 
         if args.daemon == 'start':
             daemon.start()
 
-        elif args.daemon == 'stop':
-            daemon.stop()
-            sys.exit(0)
-
         elif args.daemon == 'restart':
             daemon.restart()
 
@@ -141,19 +284,35 @@ def main():
             print 'Valid options for --daemon are start, stop and restart'
             sys.exit(1)
 
+    from automated_ebs_snapshots import instance_manager
+    from automated_ebs_snapshots import metrics
+    from automated_ebs_snapshots import profiling
+    from automated_ebs_snapshots import report as snapshot_report
+    from automated_ebs_snapshots import snapshot_manager
+    from automated_ebs_snapshots import volume_manager
+
+    if args.profile is not None:
+        profiling.start(args.profile or None)
+
     # Connect to AWS
-    connection = connection_manager.connect_to_ec2(
-        region, access_key_id, secret_access_key)
+    connection = connect(region, access_key_id, secret_access_key)
 
     if args.watch:
-        volume_manager.watch(
+        watch(connection, args.watch, args.interval, args.retention)
+
+    if args.unwatch:
+        unwatch(connection, args.unwatch)
+
+    if args.watch_instance:
+        instance_manager.watch(
             connection,
-            args.watch,
+            args.watch_instance,
             args.interval,
-            args.retention)
+            args.retention,
+            exclude_boot=bool(args.exclude_boot_volume))
 
-    if args.unwatch:
-        volume_manager.unwatch(connection, args.unwatch)
+    if args.unwatch_instance:
+        instance_manager.unwatch(connection, args.unwatch_instance)
 
     if args.watch_file:
         volume_manager.watch_from_file(connection, args.watch_file)
@@ -166,9 +325,158 @@ def main():
 
     if args.list:
         volume_manager.list(connection)
+        instance_manager.list(connection)
+
+    if args.plan:
+        snapshot_manager.print_plan(
+            plan(
+                connection,
+                bulk=bool(args.bulk_fetch),
+                max_deletions=args.max_deletions,
+                slots=slots,
+                shards=shards),
+            args.format)
+
+    if args.report:
+        rows = snapshot_manager.report(
+            connection, slots=slots, shards=shards)
+        snapshot_report.print_report(rows, args.format)
+        if args.metrics_file:
+            metrics.set_snapshot_lag(
+                (row['interval'],
+                 None if row['completed_age'] is None
+                 else time.time() - row['completed_age'])
+                for row in rows)
+            metrics.write_textfile(args.metrics_file)
+
+    for force in [False, True]:
+        if not (args.force_run if force else args.run):
+            continue
+
+        if multi_target:
+            snapshot_manager.run_targets(
+                targets,
+                force=force,
+                bulk=bool(args.bulk_fetch),
+                workers=args.workers,
+                max_deletions=args.max_deletions,
+                completion_timeout=args.completion_timeout,
+                slots=slots,
+                shards=shards)
+        else:
+            run(
+                connection,
+                force=force,
+                bulk=bool(args.bulk_fetch),
+                workers=args.workers,
+                max_deletions=args.max_deletions,
+                completion_timeout=args.completion_timeout,
+                slots=slots,
+                shards=shards)
+
+    if args.metrics_file and (args.run or args.force_run):
+        metrics.write_textfile(args.metrics_file)
+
+    if args.profile is not None:
+        profiling.stop()
+
+
+def _configure_logging(log_file=None):
+    """ Configure logging for the command line
+
+    :type log_file: str
+    :param log_file: Path to file to send logs to. None == log to stderr
+        only
+    :returns: None
+    """
+    log_config = copy.deepcopy(LOG_CONFIG)
+    if log_file:
+        log_config['handlers']['file'] = {
+            'level': 'DEBUG',
+            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'formatter': 'standard',
+            'filename': log_file,
+            'when': 'midnight',
+            'backupCount': 5
+        }
+
+        for logger_config in log_config['loggers'].values():
+            logger_config['handlers'].append('file')
+
+    logging.config.dictConfig(log_config)
+
+
+def _get_slots(args):
+    """ Get the snapshot slots configured on the command line
+
+    :type args: argparse.Namespace
+    :param args: Parsed command line options
+    :returns: slots.Slots -- Slots or None to snapshot once per interval
+    """
+    if not args.schedule_window and args.schedule_time is None:
+        return None
+
+    from automated_ebs_snapshots import slots as snapshot_slots
+
+    align = None
+    if args.schedule_time is not None:
+        try:
+            align = snapshot_slots.parse_time(args.schedule_time)
+        except ValueError:
+            logger.error('Invalid --schedule-time {}'.format(
+                args.schedule_time))
+            sys.exit(1)
+
+    return snapshot_slots.Slots(window=args.schedule_window, align=align)
+
+
+def _get_volume_id(connection, volume):
+    """ Resolve the Name tag of a volume to its volume ID
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type volume: str
+    :param volume: VolumeID or Name tag of the volume
+    :returns: str -- Volume ID, or None if no volume has the name
+    """
+    from automated_ebs_snapshots import volume_manager
+    if volume_manager.VOLUME_ID_PATTERN.match(volume):
+        return volume
+    return volume_manager.get_volume_id(connection, volume)
+
+
+def _get_shards(args):
+    """ Get the shards configured on the command line
+
+    :type args: argparse.Namespace
+    :param args: Parsed command line options
+    :returns: sharding.Shards -- Shards or None to handle all volumes
+    """
+    if args.shard is None:
+        if args.lease_file:
+            logger.error('--lease-file requires --shard')
+            sys.exit(1)
+        return None
+
+    # Leases are only refreshed by the daemon. A one-shot action holding no
+    # lease would handle no volumes at all
+    if args.lease_file and not args.daemon:
+        logger.error(
+            '--lease-file is only supported with --daemon. Without it, '
+            '--shard I/N handles shard I')
+        sys.exit(1)
+
+    from automated_ebs_snapshots import sharding
+
+    try:
+        shard, count = sharding.parse_shard(args.shard)
+    except ValueError:
+        logger.error('Invalid --shard {}, use I/N, e.g. 2/5'.format(
+            args.shard))
+        sys.exit(1)
 
-    if args.run:
-        snapshot_manager.run(connection)
+    backend = None
+    if args.lease_file:
+        backend = sharding.SQLiteLeaseBackend(args.lease_file)
 
-    if args.force_run:
-        snapshot_manager.run(connection, force=True)
+    return sharding.Shards(shard, count, backend=backend, ttl=args.lease_ttl)
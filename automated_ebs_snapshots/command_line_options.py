@@ -1,16 +1,14 @@
-""" Command line options """
+""" Command line options
+
+The command line is only parsed when parse_args is called, so importing
+this module has no side effects.
+"""
 import argparse
-import sys
 import os.path
 from ConfigParser import SafeConfigParser
 
 from automated_ebs_snapshots.valid_intervals import VALID_INTERVALS
 
-settings = SafeConfigParser()
-settings.read('{}/settings.conf'.format(
-    os.path.dirname(os.path.realpath(__file__))))
-
-
 parser = argparse.ArgumentParser(
     description='Automatic AWS EBS snapshot handling')
 aws_config_ag = parser.add_argument_group(
@@ -38,10 +36,11 @@ general_ag.add_argument(
         'Valid values are: {}'.format(', '.join(VALID_INTERVALS))))
 general_ag.add_argument(
     '-r', '--retention',
-    default=0,
-    type=int,
+    default='0',
     help=(
-        'Number of snapshots to keep. 0 == keep all. '
+        'Number of snapshots to keep, or a tiered policy keeping the newest '
+        'snapshot per hour (h), day (d), week (w), month (m) and year (y), '
+        'e.g. h24,d14,w8,m12. 0 == keep all. '
         'Default: 0. '
         'WARNING: This setting will delete older snapshots!'))
 general_ag.add_argument(
@@ -56,24 +55,71 @@ general_ag.add_argument(
     help=(
         'Run Automatic EBS Snapshots in daemon mode. Valid modes are '
         '[start|stop|restart|foreground]'))
+general_ag.add_argument(
+    '--pid-file',
+    default='/tmp/automatic-ebs-snapshots.pid',
+    help=(
+        'Pid file of the daemon. Give every daemon on a host its own. '
+        'Default: /tmp/automatic-ebs-snapshots.pid'))
+general_ag.add_argument(
+    '--shard',
+    metavar='I/N',
+    help=(
+        'Only handle the volumes and instances in shard I of N, by a hash '
+        'of their IDs, e.g. --shard 2/5. With --lease-file, daemons take '
+        'over the shards of daemons that stopped renewing their lease'))
+general_ag.add_argument(
+    '--lease-file',
+    help=(
+        'SQLite database holding the shard leases of all daemons, see '
+        '--shard. Must be reachable by all daemons. Only supported with '
+        '--daemon. Default: own shard I without leases'))
+general_ag.add_argument(
+    '--lease-ttl',
+    default=900,
+    type=int,
+    help=(
+        'Seconds until the shard of a daemon that stopped renewing its '
+        'lease is taken over. Runs must finish within this time. '
+        'Default: 900'))
+general_ag.add_argument(
+    '--state-dir',
+    help=(
+        'Directory to persist the daemon\'s cache of the snapshot state of '
+        'watched volumes in. Default: keep the cache in memory'))
+general_ag.add_argument(
+    '--metrics-file',
+    help=(
+        'File to write metrics to in the Prometheus text format, e.g. in '
+        'the node_exporter textfile collector directory. Written after '
+        'every check in daemon mode, and after --run or --force-run'))
+general_ag.add_argument(
+    '--reconcile-interval',
+    default=3600,
+    type=int,
+    help=(
+        'Seconds between full reconciliations of the daemon\'s cache '
+        'with EC2. Default: 3600'))
 admin_actions_ag = parser.add_argument_group(
     title='Administrative actions')
 admin_actions_ag.add_argument(
     '--list',
     action='count',
-    help='List volumes that we are watching')
+    help='List volumes and instances that we are watching')
 admin_actions_ag.add_argument(
     '--unwatch',
     metavar='VOLUME_ID',
     help=(
         'Remove an EBS volume from the watch list. '
-        'Usage: --unwatch vol-12345678'))
+        'Usage: --unwatch vol-12345678. The Name tag of the volume may be '
+        'given instead of its ID'))
 admin_actions_ag.add_argument(
     '--watch',
     metavar='VOLUME_ID',
     help=(
         'Add a new EBS volume to the watch list. '
-        'Usage: --watch vol-12345678'))
+        'Usage: --watch vol-12345678. The Name tag of the volume may be '
+        'given instead of its ID'))
 admin_actions_ag.add_argument(
     '--snapshots',
     metavar='VOLUME',
@@ -90,6 +136,23 @@ admin_actions_ag.add_argument(
     help=(
         'Add all EBS volumes in the config file to the watch list. '
         'Usage: --watch-file volumes.conf'))
+admin_actions_ag.add_argument(
+    '--watch-instance',
+    metavar='INSTANCE_ID',
+    help=(
+        'Snapshot all EBS volumes of an instance together, in one '
+        'crash-consistent snapshot set. --retention counts snapshot sets. '
+        'Usage: --watch-instance i-12345678'))
+admin_actions_ag.add_argument(
+    '--unwatch-instance',
+    metavar='INSTANCE_ID',
+    help=(
+        'Remove an instance from the watch list. '
+        'Usage: --unwatch-instance i-12345678'))
+admin_actions_ag.add_argument(
+    '--exclude-boot-volume',
+    action='count',
+    help='Leave the root volume out of the snapshot sets of --watch-instance')
 
 actions_ag = parser.add_argument_group(
     title='Actions')
@@ -104,9 +167,116 @@ actions_ag.add_argument(
     help='Similar to --run, but always take a snapshot and purge '
          'snapshots that should be removed.')
 
-args = parser.parse_args()
+actions_ag.add_argument(
+    '--plan',
+    action='count',
+    help=(
+        'Print the snapshots that --run would create and delete, and the '
+        'number of API calls it would make, without changing anything'))
+
+actions_ag.add_argument(
+    '--report',
+    action='count',
+    help=(
+        'Print the age of the newest snapshot, how overdue the next '
+        'snapshot is and the number of snapshots against the retention of '
+        'every watched volume, most overdue first'))
+
+actions_ag.add_argument(
+    '--format',
+    default='table',
+    choices=['table', 'csv', 'json'],
+    help=(
+        'Output format of --plan and --report. csv is only supported by '
+        '--report. Default: table'))
+
+actions_ag.add_argument(
+    '--bulk-fetch',
+    action='count',
+    help=(
+        'Fetch all snapshots owned by the account in one paged sweep '
+        'instead of once per volume. Recommended when watching many '
+        'volumes'))
+
+actions_ag.add_argument(
+    '--workers',
+    default=1,
+    type=int,
+    help=(
+        'Number of volumes to process concurrently when running. '
+        'Default: 1'))
+
+actions_ag.add_argument(
+    '--engine',
+    default='threads',
+    choices=['threads', 'gevent'],
+    help=(
+        'How --workers run concurrently. gevent runs them as greenlets on '
+        'one thread, so --workers can be in the thousands. Requires the '
+        'gevent package. Default: threads'))
+
+actions_ag.add_argument(
+    '--max-deletions',
+    default=0,
+    type=int,
+    help=(
+        'Maximum number of old snapshots to delete per run. Remaining '
+        'snapshots are deleted in later runs. 0 == no limit. Default: 0'))
+
+actions_ag.add_argument(
+    '--profile',
+    nargs='?',
+    const='',
+    metavar='PSTATS_FILE',
+    help=(
+        'Print the time spent per phase and the EC2 API calls per action '
+        'at the end of the run. If PSTATS_FILE is given, also dump cProfile '
+        'statistics to it. cProfile only sees the main thread, so use '
+        '--workers 1 for complete statistics'))
+
+actions_ag.add_argument(
+    '--schedule-window',
+    default=0,
+    type=int,
+    help=(
+        'Spread the snapshots of volumes with the same interval over this '
+        'many seconds, at a fixed offset per volume, instead of taking '
+        'them one interval after the previous snapshot. 0 == no spreading. '
+        'Default: 0'))
+
+actions_ag.add_argument(
+    '--schedule-time',
+    metavar='[HH:]MM',
+    help=(
+        'Align snapshots to this time of day (UTC), or minute past the hour '
+        'for hourly volumes. --schedule-window starts at this time'))
+
+actions_ag.add_argument(
+    '--completion-timeout',
+    default=0,
+    type=int,
+    help=(
+        'Seconds to wait for created snapshots to complete after a run. '
+        'Failed snapshots are retried while waiting. 0 == do not wait. '
+        'Default: 0'))
+
+
+def parse_args(argv=None):
+    """ Parse command line options
+
+    :type argv: list
+    :param argv: Arguments to parse. None == sys.argv[1:]
+    :returns: argparse.Namespace -- Parsed options
+    """
+    return parser.parse_args(argv)
+
+
+def get_version():
+    """ Get the Automated EBS Snapshots version
 
-if args.version:
-    print('Automated EBS Snapshots version {}'.format(
-        settings.get('general', 'version')))
-    sys.exit(0)
+    :returns: str -- Version from settings.conf
+    """
+    settings = SafeConfigParser()
+    settings.read('{}/settings.conf'.format(
+        os.path.dirname(os.path.realpath(__file__))))
+    return settings.get('general', 'version')
@@ -0,0 +1,290 @@
+""" Track created snapshots until they are completed """
+import logging
+import time
+
+from automated_ebs_snapshots import pagination
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of snapshot IDs per DescribeSnapshots filter
+BATCH_SIZE = 200
+
+# Seconds between the first polls, doubled after each poll up to
+# MAX_POLL_INTERVAL
+POLL_INTERVAL = 15
+MAX_POLL_INTERVAL = 300
+
+# Number of times a snapshot is created for a volume before giving up
+MAX_ATTEMPTS = 3
+
+
+class CompletionTracker(object):
+    """ Poll in-flight snapshots until they are completed or failed
+
+    Snapshots are polled in batches, with one DescribeSnapshots call per
+    BATCH_SIZE snapshots. The delay between polls starts at poll_interval
+    and is doubled after each poll, up to max_poll_interval. Snapshots
+    ending in the error state are recreated, up to max_attempts times per
+    volume. A snapshot set of an instance is recreated as a whole when one
+    of its snapshots fails, up to max_attempts times per instance.
+    """
+    def __init__(self, create_snapshot=None, create_snapshot_set=None,
+                 poll_interval=POLL_INTERVAL,
+                 max_poll_interval=MAX_POLL_INTERVAL,
+                 max_attempts=MAX_ATTEMPTS):
+        """ Constructor
+
+        :type create_snapshot: callable
+        :param create_snapshot: Function taking a volume and returning a new
+            snapshot_record.SnapshotRecord, used to retry failed snapshots.
+            None == do not retry
+        :type create_snapshot_set: callable
+        :param create_snapshot_set: Function taking an instance and
+            returning the new [snapshot_record.SnapshotRecord] of a set,
+            used to retry failed snapshot sets. None == do not retry
+        :type poll_interval: int
+        :param poll_interval: Seconds before the first poll
+        :type max_poll_interval: int
+        :param max_poll_interval: Maximum seconds between polls
+        :type max_attempts: int
+        :param max_attempts: Number of snapshots to create per volume
+            before giving up
+        """
+        self.create_snapshot = create_snapshot
+        self.create_snapshot_set = create_snapshot_set
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_attempts = max_attempts
+        self.next_poll_time = None
+        self._delay = poll_interval
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, volume, snapshot, attempt=1):
+        """ Start tracking a created snapshot
+
+        :type volume: boto.ec2.volume.Volume
+        :param volume: Snapshotted volume
+        :type snapshot: snapshot_record.SnapshotRecord
+        :param snapshot: The new snapshot
+        :type attempt: int
+        :param attempt: Number of snapshots created for the volume so far
+        :returns: None
+        """
+        self._pending[snapshot.id] = {
+            'target': volume,
+            'volume_id': volume.id,
+            'instance_id': None,
+            'snapshot': snapshot,
+            'attempt': attempt
+        }
+        self._delay = self.poll_interval
+        self.next_poll_time = time.time() + self._delay
+
+    def add_set(self, instance, snapshots, attempt=1):
+        """ Start tracking the snapshots of a created snapshot set
+
+        :type instance: boto.ec2.instance.Instance
+        :param instance: Snapshotted instance
+        :type snapshots: list
+        :param snapshots: [snapshot_record.SnapshotRecord] of the new set
+        :type attempt: int
+        :param attempt: Number of sets created for the instance so far
+        :returns: None
+        """
+        set_ids = [snapshot.id for snapshot in snapshots]
+        for snapshot in snapshots:
+            self._pending[snapshot.id] = {
+                'target': instance,
+                'volume_id': snapshot.volume_id,
+                'instance_id': instance.id,
+                'set_ids': set_ids,
+                'snapshot': snapshot,
+                'attempt': attempt
+            }
+        if snapshots:
+            self._delay = self.poll_interval
+            self.next_poll_time = time.time() + self._delay
+
+    def poll(self, connection, now=None):
+        """ Check the status of all tracked snapshots once
+
+        :type connection: boto.ec2.connection.EC2Connection
+        :param connection: EC2 connection object
+        :type now: float
+        :param now: Current UNIX timestamp. Default: time.time()
+        :returns: list -- [dict] with volume_id, instance_id (None for
+            snapshots of a volume on its own), snapshot_id, status
+            (completed or error), attempts and seconds (from the start of
+            the snapshot) for each snapshot that finished in this poll
+        """
+        if now is None:
+            now = time.time()
+
+        snapshot_ids = sorted(self._pending)
+        statuses = {}
+        for start in range(0, len(snapshot_ids), BATCH_SIZE):
+            for snapshot in pagination.iter_snapshots(
+                    connection,
+                    filters={
+                        'snapshot-id': snapshot_ids[start:start + BATCH_SIZE]
+                    }):
+                statuses[snapshot.id] = snapshot.status
+
+        finished = []
+        for snapshot_id in snapshot_ids:
+            status = statuses.get(snapshot_id)
+            if status in ('pending', 'recoverable', 'recovering'):
+                continue
+
+            # Dropped when another snapshot of its set failed
+            tracked = self._pending.pop(snapshot_id, None)
+            if tracked is None:
+                continue
+
+            volume_id = tracked['volume_id']
+            if status is None:
+                logger.warning(
+                    'Snapshot {} of {} no longer exists'.format(
+                        snapshot_id, volume_id))
+                continue
+
+            seconds = int(now - tracked['snapshot'].start_time)
+            finished.append({
+                'volume_id': volume_id,
+                'instance_id': tracked['instance_id'],
+                'snapshot_id': snapshot_id,
+                'status': status,
+                'attempts': tracked['attempt'],
+                'seconds': seconds
+            })
+
+            if status == 'completed':
+                logger.info(
+                    'Snapshot {} of {} completed in {} seconds'.format(
+                        snapshot_id, volume_id, seconds))
+                continue
+
+            logger.warning(
+                'Snapshot {} of {} failed with status {} after {} '
+                'seconds'.format(snapshot_id, volume_id, status, seconds))
+            if tracked['instance_id'] is not None:
+                # The set is recreated as a whole, so the other snapshots
+                # of the failed set are no longer tracked
+                for set_id in tracked['set_ids']:
+                    self._pending.pop(set_id, None)
+            self._retry(tracked)
+
+        if self._pending:
+            self._delay = min(self._delay * 2, self.max_poll_interval)
+            self.next_poll_time = now + self._delay
+        else:
+            self.next_poll_time = None
+
+        return finished
+
+    def wait(self, connection, timeout=None):
+        """ Poll until all tracked snapshots are finished
+
+        :type connection: boto.ec2.connection.EC2Connection
+        :param connection: EC2 connection object
+        :type timeout: int
+        :param timeout: Maximum seconds to wait. None == no limit
+        :returns: list -- [dict] as returned by poll() for all snapshots
+            that finished while waiting
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        finished = []
+        while self._pending:
+            delay = max(0, self.next_poll_time - time.time())
+            if deadline is not None:
+                if time.time() >= deadline:
+                    logger.warning(
+                        'Gave up waiting for {} pending snapshots'.format(
+                            len(self._pending)))
+                    break
+                delay = min(delay, deadline - time.time())
+
+            logger.info(
+                'Waiting {:.0f} seconds for {} pending snapshots'.format(
+                    delay, len(self._pending)))
+            time.sleep(delay)
+            finished.extend(self.poll(connection))
+
+        _log_report(finished)
+        return finished
+
+    def _retry(self, tracked):
+        """ Create a new snapshot for a volume whose snapshot failed, or a
+        new snapshot set for an instance whose set failed
+
+        :type tracked: dict
+        :param tracked: The tracked failed snapshot
+        :returns: None
+        """
+        target = tracked['target']
+        attempt = tracked['attempt']
+        is_set = tracked['instance_id'] is not None
+        create = self.create_snapshot_set if is_set else self.create_snapshot
+        if create is None:
+            return
+
+        if attempt >= self.max_attempts:
+            logger.error(
+                'Giving up on snapshotting {} after {} attempts'.format(
+                    target.id, attempt))
+            return
+
+        try:
+            created = create(target)
+        except Exception:
+            logger.exception('Could not retry the snapshot of {}'.format(
+                target.id))
+            return
+
+        if is_set:
+            self.add_set(target, created, attempt + 1)
+        else:
+            self.add(target, created, attempt + 1)
+
+
+def _log_report(finished):
+    """ Log the time to complete per volume
+
+    :type finished: list
+    :param finished: [dict] as returned by CompletionTracker.poll
+    :returns: None
+    """
+    if not finished:
+        return
+
+    separator = '+{}+{}+{}+{}+{}+'.format(
+        '-' * 25, '-' * 25, '-' * 12, '-' * 10, '-' * 12)
+    row = '| {:<23} | {:<23} | {:<10} | {:>8} | {:>10} |'
+
+    logger.info(separator)
+    logger.info(row.format(
+        'Volume ID', 'Snapshot ID', 'Status', 'Attempt', 'Seconds'))
+    logger.info(separator)
+    for result in finished:
+        logger.info(row.format(
+            result['volume_id'],
+            result['snapshot_id'],
+            result['status'],
+            result['attempts'],
+            result['seconds']))
+    logger.info(separator)
+
+    completed = [
+        result['seconds'] for result in finished
+        if result['status'] == 'completed']
+    if completed:
+        logger.info(
+            '{} snapshots completed in {} seconds on average, {} at '
+            'most'.format(
+                len(completed),
+                sum(completed) // len(completed),
+                max(completed)))
@@ -9,6 +9,10 @@ logger = logging.getLogger(__name__)
 def get_configuration(filename):
     """ Read configuration file
 
+    Besides the credentials and region in [general], the configuration can
+    list several regions and accounts to process in one run. Each
+    combination of account and region is returned as a target.
+
     :type filename: str
     :param filename: Path to the configuration file
     """
@@ -34,4 +38,93 @@ def get_configuration(filename):
         logger.error('Error in config file: {}'.format(err))
         sys.exit(1)
 
+    try:
+        config['targets'] = _get_targets(conf, config)
+    except ValueError as err:
+        logger.error('Error in config file: {}'.format(err))
+        sys.exit(1)
+
     return config
+
+
+def _get_targets(conf, config):
+    """ Get the account and region combinations to process
+
+    Without any [account:<name>] sections, the [general] credentials are
+    used in each of the regions listed in the optional "regions" option.
+    Otherwise each account section is one account, and the [general]
+    credentials are only used to assume the account's role-arn.
+
+    :type conf: ConfigParser.SafeConfigParser
+    :param conf: Parsed configuration file
+    :type config: dict
+    :param config: The [general] configuration
+    :returns: list -- [dict] with one dict per target
+    """
+    regions = _get_list(conf, 'general', 'regions') or [config['region']]
+
+    accounts = [
+        section for section in conf.sections()
+        if section.startswith('account:')]
+
+    if not accounts:
+        return [
+            {
+                'name': 'default/{}'.format(region),
+                'account': None,
+                'region': region,
+                'access-key-id': config['access-key-id'],
+                'secret-access-key': config['secret-access-key'],
+                'profile': None,
+                'role-arn': None,
+                'workers': None
+            }
+            for region in regions]
+
+    targets = []
+    for section in accounts:
+        name = section.split(':', 1)[1]
+        access_key_id = _get(conf, section, 'access-key-id')
+        secret_access_key = _get(conf, section, 'secret-access-key')
+        profile = _get(conf, section, 'profile')
+        role_arn = _get(conf, section, 'role-arn')
+        workers = _get(conf, section, 'workers')
+
+        # Assume roles using the [general] credentials unless the account
+        # has credentials of its own
+        if role_arn and not access_key_id and not profile:
+            access_key_id = config['access-key-id']
+            secret_access_key = config['secret-access-key']
+
+        for region in _get_list(conf, section, 'regions') or regions:
+            targets.append({
+                'name': '{}/{}'.format(name, region),
+                'account': name,
+                'region': region,
+                'access-key-id': access_key_id,
+                'secret-access-key': secret_access_key,
+                'profile': profile,
+                'role-arn': role_arn,
+                'workers': int(workers) if workers else None
+            })
+
+    return targets
+
+
+def _get(conf, section, option):
+    """ Get an optional option
+
+    :returns: str -- The value or None if it is not set
+    """
+    if not conf.has_option(section, option):
+        return None
+    return conf.get(section, option) or None
+
+
+def _get_list(conf, section, option):
+    """ Get an optional comma separated option
+
+    :returns: list -- The values
+    """
+    value = _get(conf, section, option) or ''
+    return [item.strip() for item in value.split(',') if item.strip()]
@@ -1,16 +1,35 @@
 """ Handles connections to AWS """
+import datetime
 import logging
+import os.path
 import sys
 
 from boto import ec2
+from boto import sts
 from boto.utils import get_instance_metadata
 
+from automated_ebs_snapshots import config_file_parser
+from automated_ebs_snapshots import rate_limiter
+
 logger = logging.getLogger(__name__)
 
+# Rebuild cached connections this many seconds before their temporary
+# credentials expire
+CREDENTIAL_EXPIRY_MARGIN = 300
+
+# Session name used when assuming roles in other accounts
+ROLE_SESSION_NAME = 'automated-ebs-snapshots'
+
+# Instance metadata is only looked up once per process
+_instance_metadata = {}
+
 
 def connect_to_ec2(region='us-east-1', access_key=None, secret_key=None):
     """ Connect to AWS ec2
 
+    All API calls made through the returned connection are rate limited
+    and retried on throttling, see rate_limiter.throttle_connection.
+
     :type region: str
     :param region: AWS region to connect to
     :type access_key: str
@@ -28,13 +47,8 @@ def connect_to_ec2(region='us-east-1', access_key=None, secret_key=None):
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key)
     else:
-        # Fetch instance metadata
-        metadata = get_instance_metadata(timeout=1, num_retries=1)
-        if metadata:
-            try:
-                region = metadata['placement']['availability-zone'][:-1]
-            except KeyError:
-                pass
+        # Use the region of the instance we are running on, if any
+        region = _get_instance_region() or region
 
         # Connect using env vars or boto credentials
         logger.info('Connecting to AWS EC2 in {}'.format(region))
@@ -44,4 +58,143 @@ def connect_to_ec2(region='us-east-1', access_key=None, secret_key=None):
         logger.error('An error occurred when connecting to EC2')
         sys.exit(1)
 
-    return connection
+    return rate_limiter.throttle_connection(connection)
+
+
+def connect_to_target(target):
+    """ Connect to AWS ec2 for one account and region
+
+    :type target: dict
+    :param target: Target as returned by config_file_parser.get_configuration
+    :returns: boto.ec2.connection.EC2Connection -- EC2 connection
+    :raises: ValueError -- If the region is unknown
+    """
+    credentials = {}
+    if target['access-key-id']:
+        credentials['aws_access_key_id'] = target['access-key-id']
+        credentials['aws_secret_access_key'] = target['secret-access-key']
+    elif target['profile']:
+        credentials['profile_name'] = target['profile']
+
+    if target['role-arn']:
+        logger.info('Assuming role {} for {}'.format(
+            target['role-arn'], target['name']))
+        role = sts.connect_to_region(
+            target['region'], **credentials).assume_role(
+                target['role-arn'], ROLE_SESSION_NAME)
+        credentials = {
+            'aws_access_key_id': role.credentials.access_key,
+            'aws_secret_access_key': role.credentials.secret_key,
+            'security_token': role.credentials.session_token
+        }
+
+    logger.info('Connecting to AWS EC2 for {}'.format(target['name']))
+    connection = ec2.connect_to_region(target['region'], **credentials)
+
+    if not connection:
+        raise ValueError('Unknown region {} for {}'.format(
+            target['region'], target['name']))
+
+    return rate_limiter.throttle_connection(connection)
+
+
+def _get_instance_region():
+    """ Get the region from the instance metadata
+
+    The metadata service is only queried on the first call.
+
+    :returns: str -- Region or None if not running on EC2
+    """
+    if 'region' not in _instance_metadata:
+        region = None
+        metadata = get_instance_metadata(timeout=1, num_retries=1)
+        if metadata:
+            try:
+                region = metadata['placement']['availability-zone'][:-1]
+            except KeyError:
+                pass
+        _instance_metadata['region'] = region
+
+    return _instance_metadata['region']
+
+
+class ConnectionCache(object):
+    """ Keep one EC2 connection alive across daemon cycles
+
+    Reusing the connection keeps boto's HTTP connection pool, the rate
+    limiter state and any instance profile credentials between cycles. The
+    connection is rebuilt when the configuration file is modified or when
+    its temporary credentials are about to expire.
+    """
+    def __init__(self, config_file=None, region='us-east-1',
+                 access_key=None, secret_key=None):
+        """ Constructor
+
+        :type config_file: str
+        :param config_file: Configuration file to read. Overrides region,
+            access_key and secret_key
+        :type region: str
+        :param region: AWS region to connect to
+        :type access_key: str
+        :param access_key: AWS access key id
+        :type secret_key: str
+        :param secret_key: AWS secret access key
+        """
+        self.config_file = config_file
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.connection = None
+        self._config_mtime = None
+
+    def get_connection(self):
+        """ Get the cached connection, rebuilding it if needed
+
+        :returns: boto.ec2.connection.EC2Connection -- EC2 connection
+        """
+        if self.config_file:
+            try:
+                mtime = os.path.getmtime(self.config_file)
+            except OSError as error:
+                # The file may be briefly missing while it is replaced.
+                # Keep the configuration read last, if there is one
+                if self._config_mtime is None:
+                    raise
+                logger.warning(
+                    'Could not check configuration file {}, keeping the '
+                    'current connection: {}'.format(self.config_file, error))
+                mtime = self._config_mtime
+            if mtime != self._config_mtime:
+                if self._config_mtime is not None:
+                    logger.info('Configuration file {} changed'.format(
+                        self.config_file))
+                config = config_file_parser.get_configuration(
+                    self.config_file)
+                self.access_key = config['access-key-id']
+                self.secret_key = config['secret-access-key']
+                self.region = config['region']
+                self._config_mtime = mtime
+                self.connection = None
+
+        if self.connection is not None and self._credentials_expiring():
+            logger.info('EC2 credentials are about to expire')
+            self.connection = None
+
+        if self.connection is None:
+            self.connection = connect_to_ec2(
+                self.region, self.access_key, self.secret_key)
+
+        return self.connection
+
+    def _credentials_expiring(self):
+        """ Check if the connection's temporary credentials expire soon
+
+        :returns: bool
+        """
+        expiry_time = getattr(
+            self.connection.provider, '_credential_expiry_time', None)
+        if expiry_time is None:
+            return False
+
+        margin = datetime.timedelta(seconds=CREDENTIAL_EXPIRY_MARGIN)
+        return expiry_time - datetime.datetime.utcnow() < margin
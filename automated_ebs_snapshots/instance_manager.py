@@ -0,0 +1,323 @@
+""" Handle instances whose volumes are snapshotted together
+
+All volumes attached to a watched instance are snapshotted in one
+multi-volume CreateSnapshots request, which gives crash-consistent
+snapshots from one point in time. The snapshots of one request form a set,
+tagged with snapshot_record.GROUP_TAG, and the retention of the instance
+counts sets rather than snapshots.
+"""
+import logging
+
+from boto import ec2
+from boto.ec2.snapshot import Snapshot
+from boto.exception import EC2ResponseError
+
+from automated_ebs_snapshots import pagination
+from automated_ebs_snapshots import planner
+from automated_ebs_snapshots import profiling
+from automated_ebs_snapshots import rate_limiter
+from automated_ebs_snapshots import retention as retention_policy
+from automated_ebs_snapshots import snapshot_record
+from automated_ebs_snapshots.valid_intervals import VALID_INTERVALS
+
+logger = logging.getLogger(__name__)
+
+# Instance tag excluding the root volume from the snapshot sets
+EXCLUDE_BOOT_TAG = 'AutomatedEBSSnapshotsExcludeBoot'
+
+# First EC2 API version with CreateSnapshots. boto 2 does not wrap the
+# action and defaults to an older API version
+MULTI_VOLUME_API_VERSION = '2016-11-15'
+
+
+def iter_watched_instances(connection):
+    """ Iterate over the instances that we are watching
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :returns: generator -- boto.ec2.instance.Instance
+    """
+    return pagination.iter_instances(
+        connection, filters={'tag-key': 'AutomatedEBSSnapshots'})
+
+
+def get_watched_instances(connection):
+    """ Get a list of instances that we are watching
+
+    Listing instances needs ec2:DescribeInstances, which IAM policies
+    written for watching volumes only may lack. Without it, a warning is
+    logged and no instances are returned, so volumes are still processed.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :returns: [boto.ec2.instance.Instance] -- List of instances
+    """
+    try:
+        with profiling.phase('describe instances'):
+            return [
+                instance for instance in iter_watched_instances(connection)]
+    except EC2ResponseError as error:
+        if error.error_code != 'UnauthorizedOperation':
+            raise
+        logger.warning(
+            'Not allowed to describe instances, skipping watched '
+            'instances. Add ec2:DescribeInstances and ec2:CreateSnapshots '
+            'to the IAM policy to snapshot them')
+        return []
+
+
+def watch(connection, instance_id, interval='daily', retention=0,
+          exclude_boot=False):
+    """ Start snapshotting all volumes of an instance together
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type instance_id: str
+    :param instance_id: Instance ID
+    :type interval: str
+    :param interval: Backup interval [hourly|daily|weekly|monthly|yearly]
+    :type retention: str
+    :param retention: Number of snapshot sets to keep, or a tiered policy
+        like d7,w4 (see retention.parse_policy). 0 == keep all
+    :type exclude_boot: bool
+    :param exclude_boot: Leave the root volume out of the snapshot sets
+    :returns: bool - True if the watch was successful
+    """
+    if interval not in VALID_INTERVALS:
+        logger.warning(
+            '{} is not a valid interval. Valid intervals are {}'.format(
+                interval, ', '.join(VALID_INTERVALS)))
+
+    try:
+        retention = retention_policy.format_policy(
+            retention_policy.parse_policy(retention))
+    except ValueError:
+        logger.warning('{} is not a valid retention'.format(retention))
+        return False
+
+    try:
+        connection.create_tags([instance_id], {
+            'AutomatedEBSSnapshots': interval,
+            'AutomatedEBSSnapshotsRetention': retention,
+            EXCLUDE_BOOT_TAG: 'true' if exclude_boot else 'false'
+        })
+    except EC2ResponseError:
+        logger.warning('Instance {} not found'.format(instance_id))
+        return False
+
+    logger.info('Updated the rotation interval to {} for {}'.format(
+        interval, instance_id))
+
+    return True
+
+
+def unwatch(connection, instance_id):
+    """ Stop snapshotting the volumes of an instance together
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type instance_id: str
+    :param instance_id: Instance ID
+    :returns: bool - True if the unwatch was successful
+    """
+    try:
+        connection.delete_tags([instance_id], [
+            'AutomatedEBSSnapshots',
+            'AutomatedEBSSnapshotsRetention',
+            EXCLUDE_BOOT_TAG
+        ])
+    except EC2ResponseError:
+        pass
+
+    logger.info('Removed {} from the watchlist'.format(instance_id))
+
+    return True
+
+
+def list(connection):
+    """ List watched instances
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :returns: None
+    """
+    separator = '+{}+{}+{}+{}+'.format(
+        '-' * 23, '-' * 22, '-' * 14, '-' * 18)
+    row = '| {:<21} | {:<20.20} | {:<12} | {:<16} |'
+
+    found = False
+    for instance in get_watched_instances(connection):
+        if not found:
+            found = True
+            logger.info(separator)
+            logger.info(row.format(
+                'Instance ID', 'Instance name', 'Interval', 'Retention'))
+            logger.info(separator)
+
+        interval = instance.tags['AutomatedEBSSnapshots']
+        if interval not in VALID_INTERVALS:
+            interval = 'Invalid interval'
+
+        logger.info(row.format(
+            instance.id,
+            instance.tags.get('Name', ''),
+            interval,
+            instance.tags.get('AutomatedEBSSnapshotsRetention', 0)))
+
+    if found:
+        logger.info(separator)
+
+
+def get_group_snapshots(connection, instance_id):
+    """ Get the snapshot sets taken of an instance
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type instance_id: str
+    :param instance_id: Instance ID
+    :returns: [snapshot_record.SnapshotRecord] -- Snapshots of all sets
+    """
+    return [
+        snapshot_record.from_snapshot(snapshot)
+        for snapshot in pagination.iter_snapshots(
+            connection,
+            filters={
+                'tag:{}'.format(snapshot_record.GROUP_TAG):
+                '{}:*'.format(instance_id)
+            })]
+
+
+def create_group_snapshot(connection, instance, now):
+    """ Snapshot all volumes of an instance in one request
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type instance: boto.ec2.instance.Instance
+    :param instance: Instance to snapshot
+    :type now: float
+    :param now: UNIX timestamp identifying the snapshot set
+    :returns: [snapshot_record.SnapshotRecord] -- The new snapshots
+    """
+    group = '{}:{}'.format(instance.id, int(now))
+    params = {
+        'InstanceSpecification.InstanceId': instance.id,
+        'InstanceSpecification.ExcludeBootVolume':
+        instance.tags.get(EXCLUDE_BOOT_TAG, 'false'),
+        'Description': 'Automatic snapshot by Automated EBS Snapshots',
+        'CopyTagsFromSource': 'volume',
+        'TagSpecification.1.ResourceType': 'snapshot',
+        'TagSpecification.1.Tag.1.Key': snapshot_record.GROUP_TAG,
+        'TagSpecification.1.Tag.1.Value': group
+    }
+
+    logger.info('Creating new snapshot set for {}'.format(instance.id))
+    with profiling.phase('create snapshot set'):
+        snapshots = [
+            snapshot_record.from_snapshot(snapshot)
+            for snapshot in _get_multi_volume_connection(connection).get_list(
+                'CreateSnapshots', params, [('item', Snapshot)], verb='POST')]
+    logger.info('Created snapshot set {} of {} volumes for {}'.format(
+        group, len(snapshots), instance.id))
+
+    return snapshots
+
+
+def needs_snapshot_set(instance, snapshots, now, force=False, slots=None):
+    """ Check if an instance needs a new snapshot set
+
+    :type instance: boto.ec2.instance.Instance
+    :param instance: Watched instance with a valid interval
+    :type snapshots: list
+    :param snapshots: Snapshots of all sets of the instance
+    :type now: float
+    :param now: UNIX timestamp the snapshot ages are computed at
+    :type force: bool
+    :param force: Always create a new snapshot set
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :returns: bool
+    """
+    interval = instance.tags['AutomatedEBSSnapshots']
+    age = planner.get_newest_age(snapshots, now)
+    max_age = None
+    if slots is not None:
+        max_age = slots.get_max_age(instance.id, interval, now)
+    return planner.needs_snapshot(interval, age, force, max_age)
+
+
+def process(connection, instance, now, force=False, slots=None):
+    """ Ensure an up to date snapshot set and find expired sets
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type instance: boto.ec2.instance.Instance
+    :param instance: Watched instance
+    :type now: float
+    :param now: UNIX timestamp the snapshot ages are computed at
+    :type force: bool
+    :param force: Always create a new snapshot set
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :returns: tuple -- ([new snapshots], [expired snapshots])
+    """
+    interval = instance.tags['AutomatedEBSSnapshots']
+    if interval not in VALID_INTERVALS:
+        logger.warning(
+            '"{}" is not a valid snapshotting interval for instance '
+            '{}'.format(interval, instance.id))
+        return [], []
+
+    with profiling.phase('describe snapshots'):
+        snapshots = get_group_snapshots(connection, instance.id)
+
+    created = []
+    if needs_snapshot_set(instance, snapshots, now, force, slots):
+        created = create_group_snapshot(connection, instance, now)
+    else:
+        logger.info('No need for a new snapshot set of {}'.format(
+            instance.id))
+
+    try:
+        policy = retention_policy.parse_policy(
+            instance.tags.get('AutomatedEBSSnapshotsRetention', 0))
+    except ValueError:
+        logger.warning('Invalid retention for instance {}'.format(
+            instance.id))
+        return created, []
+
+    expired = planner.select_expired_groups(snapshots, policy)
+    if expired:
+        logger.info('Found {} old snapshots to remove for {}'.format(
+            len(expired), instance.id))
+
+    return created, expired
+
+
+def _get_multi_volume_connection(connection):
+    """ Get a connection using an API version with CreateSnapshots
+
+    The connection shares the credentials and rate limits of the given
+    connection. It is created for every call and not cached, as boto only
+    refreshes instance profile and assumed role credentials in the
+    provider of the given connection. Creating a connection makes no
+    requests.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :returns: boto.ec2.connection.EC2Connection -- EC2 connection
+    """
+    if connection.APIVersion >= MULTI_VOLUME_API_VERSION:
+        return connection
+
+    # Reading the credentials from the provider refreshes them if needed
+    provider = connection.provider
+    multi_volume_connection = ec2.connection.EC2Connection(
+        aws_access_key_id=provider.access_key,
+        aws_secret_access_key=provider.secret_key,
+        security_token=provider.security_token,
+        region=connection.region,
+        is_secure=connection.is_secure,
+        api_version=MULTI_VOLUME_API_VERSION)
+    return rate_limiter.throttle_connection(
+        multi_volume_connection,
+        getattr(connection, 'rate_limiter', None))
@@ -0,0 +1,298 @@
+""" Metrics in the Prometheus text exposition format
+
+Metrics are collected in memory by the code paths they measure, and
+written with write_textfile, e.g. for the node_exporter textfile
+collector. All metric names start with PREFIX.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'automated_ebs_snapshots_'
+
+# Histogram buckets in seconds
+RUN_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+API_CALL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_metrics = []
+
+
+class Metric(object):
+    """ Base class of metrics with optional labels """
+    metric_type = None
+
+    def __init__(self, name, description, labels=()):
+        """ Constructor
+
+        :type name: str
+        :param name: Metric name, without PREFIX
+        :type description: str
+        :param description: Help text
+        :type labels: tuple
+        :param labels: Label names
+        """
+        self.name = PREFIX + name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        _metrics.append(self)
+
+    def collect(self):
+        """ Get the lines of the metric in the text format
+
+        :returns: list -- Lines
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for label_values, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(
+                self.name,
+                _format_labels(zip(self.labels, label_values)),
+                _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """ Monotonically increasing count """
+    metric_type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        Metric.__init__(self, name, description, labels)
+        if not labels:
+            self.values[()] = 0
+
+    def inc(self, amount=1, *label_values):
+        """ Increase the counter
+
+        :type amount: int
+        :param amount: Amount to add
+        :returns: None
+        """
+        with _lock:
+            self.values[label_values] = (
+                self.values.get(label_values, 0) + amount)
+
+
+class Gauge(Metric):
+    """ Value that can go up and down """
+    metric_type = 'gauge'
+
+    def set(self, value, *label_values):
+        """ Set the gauge
+
+        :type value: float
+        :param value: New value
+        :returns: None
+        """
+        with _lock:
+            self.values[label_values] = value
+
+    def clear(self):
+        """ Remove all label combinations """
+        with _lock:
+            self.values = {}
+
+
+class Histogram(Metric):
+    """ Distribution of observed values over fixed buckets """
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=RUN_BUCKETS):
+        """ Constructor
+
+        :type name: str
+        :param name: Metric name, without PREFIX
+        :type description: str
+        :param description: Help text
+        :type labels: tuple
+        :param labels: Label names
+        :type buckets: tuple
+        :param buckets: Sorted upper bounds of the buckets
+        """
+        Metric.__init__(self, name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        """ Record an observation
+
+        :type value: float
+        :param value: Observed value
+        :returns: None
+        """
+        position = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts, total = self.values.get(
+                label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[position] += 1
+            self.values[label_values] = (counts, total + value)
+
+    def collect(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} {}'.format(self.name, self.metric_type)]
+        for label_values, (counts, total) in sorted(self.values.items()):
+            labels = zip(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(labels + [('le', bound)]),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(
+                self.name, _format_labels(labels), _format_value(total)))
+            lines.append('{}_count{} {}'.format(
+                self.name, _format_labels(labels), cumulative))
+        return lines
+
+
+RUN_DURATION = Histogram(
+    'run_duration_seconds',
+    'Duration of runs over all watched volumes (full) or due volumes '
+    '(partial)',
+    ('scope',), RUN_BUCKETS)
+API_CALL_DURATION = Histogram(
+    'api_call_duration_seconds',
+    'Latency of EC2 API calls, including failed and throttled calls',
+    ('action',), API_CALL_BUCKETS)
+API_ERRORS = Counter(
+    'api_errors_total',
+    'EC2 API calls that failed, by error code',
+    ('action', 'code'))
+SNAPSHOTS_CREATED = Counter(
+    'snapshots_created_total', 'Snapshots created')
+SNAPSHOTS_DELETED = Counter(
+    'snapshots_deleted_total', 'Expired snapshots deleted')
+SNAPSHOT_DELETE_FAILURES = Counter(
+    'snapshot_delete_failures_total',
+    'Expired snapshots that failed to delete')
+PROCESSING_FAILURES = Counter(
+    'processing_failures_total',
+    'Volumes and instances that failed to be processed in a run')
+SNAPSHOT_LAG = Gauge(
+    'snapshot_lag_seconds',
+    'Seconds since the newest completed snapshot of the most lagging '
+    'volume, by interval',
+    ('interval',))
+WATCHED_VOLUMES = Gauge(
+    'watched_volumes', 'Watched volumes, by interval', ('interval',))
+LAST_RUN = Gauge(
+    'last_run_timestamp_seconds', 'UNIX time of the end of the last run')
+
+
+def observe_api_call(action, seconds, error_code=None):
+    """ Record an EC2 API call
+
+    :type action: str
+    :param action: EC2 API action
+    :type seconds: float
+    :param seconds: Latency of the call
+    :type error_code: str
+    :param error_code: Error code of a failed call. None == successful
+    :returns: None
+    """
+    API_CALL_DURATION.observe(seconds, action)
+    if error_code is not None:
+        API_ERRORS.inc(1, action, error_code)
+
+
+def observe_run(seconds, summary, full):
+    """ Record a run
+
+    :type seconds: float
+    :param seconds: Duration of the run
+    :type summary: dict
+    :param summary: Summary as returned by snapshot_manager.run
+    :type full: bool
+    :param full: True if all watched volumes were processed
+    :returns: None
+    """
+    RUN_DURATION.observe(seconds, 'full' if full else 'partial')
+    SNAPSHOTS_CREATED.inc(summary['created'])
+    SNAPSHOTS_DELETED.inc(summary['deleted'])
+    SNAPSHOT_DELETE_FAILURES.inc(summary['delete_failed'])
+    PROCESSING_FAILURES.inc(summary['failed'])
+    LAST_RUN.set(time.time())
+
+
+def set_snapshot_lag(volumes, now=None):
+    """ Set the snapshot lag and number of watched volumes per interval
+
+    :type volumes: iterable
+    :param volumes: (interval, start time of the newest completed
+        snapshot) for all watched volumes. Volumes without completed
+        snapshots count as watched, but not towards the lag
+    :type now: float
+    :param now: Current UNIX timestamp. Default: time.time()
+    :returns: None
+    """
+    if now is None:
+        now = time.time()
+
+    lags = {}
+    counts = {}
+    for interval, last_snapshot in volumes:
+        interval = interval or 'none'
+        counts[interval] = counts.get(interval, 0) + 1
+        if last_snapshot is not None:
+            lags[interval] = max(lags.get(interval, 0), now - last_snapshot)
+
+    SNAPSHOT_LAG.clear()
+    WATCHED_VOLUMES.clear()
+    for interval, lag in lags.items():
+        SNAPSHOT_LAG.set(int(lag), interval)
+    for interval, count in counts.items():
+        WATCHED_VOLUMES.set(count, interval)
+
+
+def write_textfile(path):
+    """ Write all metrics to a file, atomically
+
+    :type path: str
+    :param path: File to write, e.g. in the node_exporter textfile
+        collector directory
+    :returns: None
+    """
+    with _lock:
+        lines = []
+        for metric in _metrics:
+            lines.extend(metric.collect())
+
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp_path, 'w') as filehandle:
+            filehandle.write('\n'.join(lines) + '\n')
+        os.rename(temp_path, path)
+    except (IOError, OSError) as error:
+        logger.warning('Could not write metrics to {}: {}'.format(
+            path, error))
+
+
+def _format_labels(labels):
+    """ Format label pairs, e.g. {action="DescribeVolumes"}
+
+    :type labels: list
+    :param labels: [(name, value)]
+    :returns: str
+    """
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+
+def _format_value(value):
+    """ Format a sample value """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,109 @@
+""" Paged iteration over EC2 instances, volumes and snapshots
+
+The boto get_all_* methods read a complete result set into one list. The
+generators in this module request MaxResults items at a time and follow
+NextToken, so only one page of boto objects is held in memory at a time.
+"""
+from boto.ec2.instance import Reservation
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
+
+# Maximum number of volumes returned per DescribeVolumes page
+VOLUME_PAGE_SIZE = 500
+
+# Maximum number of snapshots returned per DescribeSnapshots page
+SNAPSHOT_PAGE_SIZE = 1000
+
+# Maximum number of reservations returned per DescribeInstances page
+INSTANCE_PAGE_SIZE = 1000
+
+
+def iter_volumes(connection, filters=None, page_size=VOLUME_PAGE_SIZE):
+    """ Iterate over volumes, one page at a time
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type filters: dict
+    :param filters: EC2 API filters
+    :type page_size: int
+    :param page_size: Number of volumes per DescribeVolumes call
+    :returns: generator -- boto.ec2.volume.Volume
+    """
+    return _iter_pages(
+        connection, 'DescribeVolumes', {}, filters, Volume, page_size)
+
+
+def iter_instances(connection, filters=None, page_size=INSTANCE_PAGE_SIZE):
+    """ Iterate over instances, one page of reservations at a time
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type filters: dict
+    :param filters: EC2 API filters
+    :type page_size: int
+    :param page_size: Number of reservations per DescribeInstances call
+    :returns: generator -- boto.ec2.instance.Instance
+    """
+    for reservation in _iter_pages(
+            connection, 'DescribeInstances', {}, filters, Reservation,
+            page_size):
+        for instance in reservation.instances:
+            yield instance
+
+
+def iter_snapshots(connection, filters=None, owner='self',
+                   page_size=SNAPSHOT_PAGE_SIZE):
+    """ Iterate over snapshots, one page at a time
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type filters: dict
+    :param filters: EC2 API filters
+    :type owner: str
+    :param owner: Only snapshots owned by this account. None == all
+        snapshots we have access to, including public snapshots
+    :type page_size: int
+    :param page_size: Number of snapshots per DescribeSnapshots call
+    :returns: generator -- boto.ec2.snapshot.Snapshot
+    """
+    params = {}
+    if owner:
+        params['Owner.1'] = owner
+
+    return _iter_pages(
+        connection, 'DescribeSnapshots', params, filters, Snapshot,
+        page_size)
+
+
+def _iter_pages(connection, action, params, filters, cls, page_size):
+    """ Iterate over the items of a paged Describe action
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type action: str
+    :param action: EC2 API action
+    :type params: dict
+    :param params: Request parameters
+    :type filters: dict
+    :param filters: EC2 API filters
+    :type cls: class
+    :param cls: boto class of the items
+    :type page_size: int
+    :param page_size: Number of items per call
+    :returns: generator
+    """
+    params = dict(params)
+    params['MaxResults'] = page_size
+    if filters:
+        connection.build_filter_params(params, filters)
+
+    while True:
+        page = connection.get_list(
+            action, params, [('item', cls)], verb='POST')
+
+        for item in page:
+            yield item
+
+        if not page.next_token:
+            return
+        params['NextToken'] = page.next_token
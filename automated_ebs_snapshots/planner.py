@@ -0,0 +1,276 @@
+""" Compute what a run would create and delete
+
+All functions in this module are pure: they work on volumes and snapshots
+that have already been fetched and make no API calls. Volumes need id and
+tags attributes, snapshots are snapshot_record.SnapshotRecord objects.
+"""
+from automated_ebs_snapshots import retention
+from automated_ebs_snapshots import snapshot_record
+from automated_ebs_snapshots.valid_intervals import INTERVAL_SECONDS
+
+# Age used for volumes without snapshots
+NO_SNAPSHOT_AGE = 3600*24*365*10  # 10 years :)
+
+# Snapshot statuses that do not hold a usable copy of the volume
+FAILED_STATUSES = ('error',)
+
+
+def get_newest_age(snapshots, now):
+    """ Get the age of the newest snapshot
+
+    Pending snapshots count, as they will be completed, but failed
+    snapshots do not.
+
+    :type snapshots: list
+    :param snapshots: Snapshots of a volume
+    :type now: float
+    :param now: Current UNIX timestamp
+    :returns: int -- Age in seconds, NO_SNAPSHOT_AGE if there are none
+    """
+    start_times = [
+        snapshot.start_time for snapshot in snapshots
+        if snapshot.status not in FAILED_STATUSES]
+    if not start_times:
+        return NO_SNAPSHOT_AGE
+
+    return int(now - max(start_times))
+
+
+def needs_snapshot(interval, age, force=False, max_age=None):
+    """ Check if a volume needs a new snapshot
+
+    :type interval: str
+    :param interval: A valid snapshotting interval
+    :type age: int
+    :param age: Age of the newest snapshot, as returned by get_newest_age
+    :type force: bool
+    :param force: Always create a new snapshot
+    :type max_age: int
+    :param max_age: Maximum age of the newest snapshot, as returned by
+        slots.Slots.get_max_age. None == the interval
+    :returns: bool
+    """
+    if max_age is None:
+        max_age = INTERVAL_SECONDS[interval]
+    return force or age > max_age
+
+
+def get_volume_snapshots(snapshots):
+    """ Get the snapshots taken of a volume on its own
+
+    Snapshots taken of all volumes of an instance together are handled by
+    the retention of the instance, see select_expired_groups.
+
+    :type snapshots: list
+    :param snapshots: Snapshots of a volume
+    :returns: list -- Snapshots without the group tag
+    """
+    return [
+        snapshot for snapshot in snapshots
+        if snapshot.get_tag(snapshot_record.GROUP_TAG) is None]
+
+
+def select_expired(snapshots, policy):
+    """ Select the snapshots not kept by the retention policy
+
+    Only completed snapshots count towards the retention and are expired,
+    so old snapshots are not deleted before their replacements complete.
+    Failed snapshots are expired once a newer snapshot has completed.
+
+    :type snapshots: list
+    :param snapshots: Snapshots of a volume
+    :type policy: list
+    :param policy: Retention policy, see retention.parse_policy
+    :returns: list -- The expired snapshots, sorted by start time
+    """
+    if not policy:
+        return []
+
+    completed = [
+        snapshot for snapshot in snapshots if snapshot.status == 'completed']
+    expired = retention.select_expired(
+        completed, policy, key=lambda x: x.start_time)
+    if not completed:
+        return expired
+
+    newest = max(snapshot.start_time for snapshot in completed)
+    expired.extend(
+        snapshot for snapshot in snapshots
+        if snapshot.status in FAILED_STATUSES and
+        snapshot.start_time < newest)
+    expired.sort(key=lambda x: x.start_time)
+    return expired
+
+
+def select_expired_groups(snapshots, policy):
+    """ Select the snapshot sets of an instance not kept by the retention
+
+    The snapshots of one set share the same group tag value. Only sets in
+    which all snapshots are completed count towards the retention and are
+    expired, so a set is always deleted as a whole. Sets with a failed
+    snapshot are expired once a newer set has completed.
+
+    :type snapshots: list
+    :param snapshots: Snapshots of the instance, with the group tag
+    :type policy: list
+    :param policy: Retention policy of snapshot sets, see
+        retention.parse_policy
+    :returns: list -- The snapshots of the expired sets
+    """
+    if not policy:
+        return []
+
+    sets = {}
+    for snapshot in snapshots:
+        sets.setdefault(
+            snapshot.get_tag(snapshot_record.GROUP_TAG), []).append(snapshot)
+
+    def start_time(members):
+        """ Get the start time of a set """
+        return min(member.start_time for member in members)
+
+    completed = [
+        members for members in sets.values()
+        if all(member.status == 'completed' for member in members)]
+    expired = retention.select_expired(completed, policy, key=start_time)
+    if completed:
+        newest = max(start_time(members) for members in completed)
+        expired.extend(
+            members for members in sets.values()
+            if start_time(members) < newest and
+            any(member.status in FAILED_STATUSES for member in members))
+    return [snapshot for members in expired for snapshot in members]
+
+
+def compute_plan(volumes, snapshots_by_volume, now, force=False,
+                 max_deletions=0, slots=None):
+    """ Compute the snapshots a run would create and delete
+
+    :type volumes: list
+    :param volumes: Watched volumes
+    :type snapshots_by_volume: dict
+    :param snapshots_by_volume: {volume_id: [snapshots]}
+    :type now: float
+    :param now: Current UNIX timestamp
+    :type force: bool
+    :param force: Plan a forced run
+    :type max_deletions: int
+    :param max_deletions: Maximum number of snapshots to delete.
+        0 == no limit
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :returns: dict -- With the keys create, delete, deferred and skipped.
+        create lists dicts with volume_id, interval and age (of the newest
+        snapshot), delete and deferred list dicts with snapshot_id,
+        volume_id and start_time, skipped lists dicts with volume_id and
+        reason
+    """
+    plan = {'create': [], 'delete': [], 'deferred': [], 'skipped': []}
+    expired = []
+
+    for volume in volumes:
+        snapshots = get_volume_snapshots(
+            snapshots_by_volume.get(volume.id, []))
+        interval = volume.tags.get('AutomatedEBSSnapshots')
+
+        if interval is None:
+            plan['skipped'].append({
+                'volume_id': volume.id,
+                'reason': 'Missing tag AutomatedEBSSnapshots'
+            })
+        elif interval not in INTERVAL_SECONDS:
+            plan['skipped'].append({
+                'volume_id': volume.id,
+                'reason': 'Invalid interval {}'.format(interval)
+            })
+        else:
+            age = get_newest_age(snapshots, now)
+            max_age = None
+            if slots is not None:
+                max_age = slots.get_max_age(volume.id, interval, now)
+            if needs_snapshot(interval, age, force, max_age):
+                plan['create'].append({
+                    'volume_id': volume.id,
+                    'interval': interval,
+                    'age': None if age == NO_SNAPSHOT_AGE else age
+                })
+
+        value = volume.tags.get('AutomatedEBSSnapshotsRetention')
+        if value is None:
+            continue
+        try:
+            policy = retention.parse_policy(value)
+        except ValueError:
+            plan['skipped'].append({
+                'volume_id': volume.id,
+                'reason': 'Invalid retention {}'.format(value)
+            })
+            continue
+
+        expired.extend(select_expired(snapshots, policy))
+
+    # The run deletes the oldest snapshots first
+    expired.sort(key=lambda x: x.start_time)
+    if max_deletions and len(expired) > max_deletions:
+        expired, deferred = expired[:max_deletions], expired[max_deletions:]
+    else:
+        deferred = []
+
+    plan['delete'] = [_describe(snapshot) for snapshot in expired]
+    plan['deferred'] = [_describe(snapshot) for snapshot in deferred]
+
+    return plan
+
+
+def estimate_api_calls(plan, volume_count, volume_pages, snapshot_pages,
+                       bulk=False, named_volume_ids=None, instance_count=0,
+                       instance_pages=1):
+    """ Estimate the number of API calls a run would make
+
+    :type plan: dict
+    :param plan: Plan as returned by compute_plan
+    :type volume_count: int
+    :param volume_count: Number of watched volumes
+    :type volume_pages: int
+    :param volume_pages: Number of DescribeVolumes pages listing the
+        watched volumes
+    :type snapshot_pages: int
+    :param snapshot_pages: Number of DescribeSnapshots pages in a bulk fetch
+    :type bulk: bool
+    :param bulk: Estimate for a run with bulk fetching of snapshots
+    :type named_volume_ids: set
+    :param named_volume_ids: Volumes with a Name tag. boto copies the Name
+        tag to new snapshots with one extra DescribeVolumes and CreateTags
+        call each
+    :type instance_count: int
+    :param instance_count: Number of watched instances with a valid
+        interval, whose snapshot sets are described one instance at a time
+    :type instance_pages: int
+    :param instance_pages: Number of DescribeInstances pages listing the
+        watched instances
+    :returns: dict -- {action: number of calls}
+    """
+    creates = len(plan['create'])
+    named_creates = len([
+        create for create in plan['create']
+        if create['volume_id'] in (named_volume_ids or set())])
+
+    return {
+        'DescribeVolumes': volume_pages + creates,
+        'DescribeInstances': instance_pages,
+        'DescribeSnapshots':
+        (snapshot_pages if bulk else volume_count) + instance_count,
+        'CreateSnapshot': creates,
+        'CreateSnapshots': len(plan.get('create_sets', [])),
+        'CreateTags': named_creates,
+        'DeleteSnapshot': len(plan['delete']),
+    }
+
+
+def _describe(snapshot):
+    """ Describe a snapshot in a plan """
+    return {
+        'snapshot_id': snapshot.id,
+        'volume_id': snapshot.volume_id,
+        'start_time': snapshot_record.format_timestamp(snapshot.start_time)
+    }
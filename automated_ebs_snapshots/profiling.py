@@ -0,0 +1,162 @@
+""" Per phase timing of runs, with optional cProfile output
+
+Code paths wrap their phases in phase(). Timing is off until start() is
+called, and phase() then costs only a check of a module global.
+"""
+import contextlib
+import cProfile
+import logging
+import threading
+import time
+
+from automated_ebs_snapshots import metrics
+
+logger = logging.getLogger(__name__)
+
+_profile = None
+
+
+class Profile(object):
+    """ Time spent per phase, summed over all worker threads """
+    def __init__(self, pstats_file=None):
+        """ Constructor
+
+        :type pstats_file: str
+        :param pstats_file: File to dump cProfile statistics to. None == do
+            not run cProfile
+        """
+        self.pstats_file = pstats_file
+        self.started = time.time()
+        self.phases = {}
+        self.order = []
+        self.profiler = cProfile.Profile() if pstats_file else None
+        self.api_calls = _get_api_calls()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        """ Record one pass through a phase
+
+        :type name: str
+        :param name: Phase name
+        :type seconds: float
+        :param seconds: Time spent in the phase
+        :returns: None
+        """
+        with self._lock:
+            if name not in self.phases:
+                self.phases[name] = [0, 0.0]
+                self.order.append(name)
+            self.phases[name][0] += 1
+            self.phases[name][1] += seconds
+
+
+def start(pstats_file=None):
+    """ Start timing phases, and profiling if a pstats file is given
+
+    cProfile only sees the main thread, so profiles are complete with one
+    worker only.
+
+    :type pstats_file: str
+    :param pstats_file: File to dump cProfile statistics to
+    :returns: Profile
+    """
+    global _profile
+    _profile = Profile(pstats_file)
+    if _profile.profiler is not None:
+        _profile.profiler.enable()
+    return _profile
+
+
+def stop():
+    """ Stop timing, dump the cProfile statistics and log the report
+
+    :returns: None
+    """
+    global _profile
+    profile, _profile = _profile, None
+    if profile is None:
+        return
+
+    if profile.profiler is not None:
+        profile.profiler.disable()
+        profile.profiler.dump_stats(profile.pstats_file)
+        logger.info('Wrote profile statistics to {}'.format(
+            profile.pstats_file))
+
+    _log_report(profile, time.time() - profile.started)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """ Time a phase of a run
+
+    :type name: str
+    :param name: Phase name
+    """
+    profile = _profile
+    if profile is None:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        profile.add(name, time.time() - started)
+
+
+def _get_api_calls():
+    """ Get the EC2 API calls made so far, from the metrics
+
+    :returns: dict -- {action: (calls, errors, seconds)}
+    """
+    errors = {}
+    for (action, code), count in metrics.API_ERRORS.values.items():
+        errors[action] = errors.get(action, 0) + count
+
+    return dict(
+        (action, (sum(counts), errors.get(action, 0), total))
+        for (action,), (counts, total)
+        in metrics.API_CALL_DURATION.values.items())
+
+
+def _log_report(profile, seconds):
+    """ Log the time per phase and the EC2 API calls per action
+
+    :type profile: Profile
+    :param profile: Finished profile
+    :type seconds: float
+    :param seconds: Wall clock time of the profile
+    :returns: None
+    """
+    separator = '+{}+{}+{}+{}+'.format(
+        '-' * 27, '-' * 10, '-' * 10, '-' * 12)
+    row = '| {:<25} | {:>8} | {:>8} | {:>10} |'
+
+    logger.info(separator)
+    logger.info(row.format('Phase', 'Calls', '', 'Seconds'))
+    logger.info(separator)
+    for name in profile.order:
+        calls, phase_seconds = profile.phases[name]
+        logger.info(row.format(
+            name, calls, '', '{:.3f}'.format(phase_seconds)))
+    logger.info(separator)
+
+    logger.info(row.format('API action', 'Calls', 'Errors', 'Seconds'))
+    logger.info(separator)
+    total_calls = 0
+    for action, (calls, errors, api_seconds) in sorted(
+            _get_api_calls().items()):
+        before = profile.api_calls.get(action, (0, 0, 0.0))
+        calls -= before[0]
+        if not calls:
+            continue
+        total_calls += calls
+        logger.info(row.format(
+            action, calls, errors - before[1],
+            '{:.3f}'.format(api_seconds - before[2])))
+    logger.info(separator)
+
+    logger.info(
+        'Finished in {:.3f} seconds with {} API calls. Phase times are '
+        'summed over all workers'.format(seconds, total_calls))
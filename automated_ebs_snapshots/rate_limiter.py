@@ -0,0 +1,271 @@
+""" Rate limiting and retries for EC2 API calls """
+import functools
+import logging
+import random
+import threading
+import time
+
+from boto.exception import BotoServerError
+
+from automated_ebs_snapshots import metrics
+
+logger = logging.getLogger(__name__)
+
+# Sustained requests per second and burst size per EC2 API action
+ACTION_RATES = {
+    'DescribeInstances': (10, 20),
+    'DescribeSnapshots': (10, 20),
+    'DescribeVolumes': (10, 20),
+    'CreateSnapshot': (5, 10),
+    'CreateSnapshots': (5, 10),
+    'DeleteSnapshot': (5, 10),
+    'CreateTags': (5, 10),
+    'DeleteTags': (5, 10),
+}
+DEFAULT_RATE = (5, 10)
+
+# Error codes returned by EC2 when we are sending requests too fast
+THROTTLING_ERRORS = [
+    'RequestLimitExceeded',
+    'SnapshotCreationPerVolumeRateExceeded',
+    'Throttling',
+    'ThrottlingException',
+]
+
+# HTTP statuses of transient server errors, retried like boto does
+RETRY_STATUSES = [500, 502, 503, 504]
+
+# Retry settings for throttled calls
+MAX_RETRIES = 8
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+
+
+class TokenBucket(object):
+    """ Token bucket whose rate adapts to throttling
+
+    The rate is halved every time a call is throttled and slowly grows back
+    to the configured rate as calls succeed.
+    """
+    def __init__(self, rate, capacity):
+        """ Constructor
+
+        :type rate: float
+        :param rate: Sustained number of calls per second
+        :type capacity: int
+        :param capacity: Maximum burst size
+        """
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 20
+        self.rate = self.max_rate
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a call may be made """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+    def decrease(self):
+        """ Slow down after a throttling error """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def increase(self):
+        """ Speed up again after a successful call """
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+class RateLimiter(object):
+    """ Per action rate limits with jittered exponential backoff """
+    def __init__(self, rates=None, max_retries=MAX_RETRIES,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        """ Constructor
+
+        :type rates: dict
+        :param rates: {action: (rate, capacity)}. Default: ACTION_RATES
+        :type max_retries: int
+        :param max_retries: Number of retries per throttled call
+        :type base_delay: float
+        :param base_delay: Backoff delay in seconds for the first retry
+        :type max_delay: float
+        :param max_delay: Upper limit in seconds for the backoff delay
+        """
+        self.rates = ACTION_RATES if rates is None else rates
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, action):
+        """ Get the token bucket for an API action
+
+        :type action: str
+        :param action: EC2 API action, e.g. DescribeSnapshots
+        :returns: TokenBucket
+        """
+        with self._lock:
+            if action not in self.buckets:
+                rate, capacity = self.rates.get(action, DEFAULT_RATE)
+                self.buckets[action] = TokenBucket(rate, capacity)
+            return self.buckets[action]
+
+    def call(self, action, function, *args, **kwargs):
+        """ Call function within the rate limits of action
+
+        Throttled calls and transient server errors are retried up to
+        max_retries times with full jitter exponential backoff. Other errors
+        are raised immediately.
+
+        :type action: str
+        :param action: EC2 API action, e.g. DescribeSnapshots
+        :type function: callable
+        :param function: Function performing the API call
+        :returns: The return value of function
+        """
+        return self.call_with_retries(action, (), function, *args, **kwargs)
+
+    def call_with_retries(self, action, retry_exceptions, function, *args,
+                          **kwargs):
+        """ Call function within the rate limits of action, and also retry
+        the given exceptions
+
+        :type action: str
+        :param action: EC2 API action, e.g. DescribeSnapshots
+        :type retry_exceptions: tuple
+        :param retry_exceptions: Exception classes to retry like transient
+            server errors, e.g. the connection errors of a boto connection
+        :type function: callable
+        :param function: Function performing the API call
+        :returns: The return value of function
+        """
+        bucket = self.bucket(action)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            started = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except BotoServerError as error:
+                # EC2 throttles with HTTP 503, which boto raises as a
+                # BotoServerError rather than an EC2ResponseError
+                metrics.observe_api_call(
+                    action, time.time() - started,
+                    error.error_code or str(error.status))
+                if error.error_code in THROTTLING_ERRORS:
+                    bucket.decrease()
+                    reason = 'throttled'
+                elif error.status in RETRY_STATUSES:
+                    reason = 'failed with HTTP {}'.format(error.status)
+                else:
+                    raise
+                if not self._backoff(action, reason, attempt):
+                    raise
+            except Exception as error:
+                metrics.observe_api_call(
+                    action, time.time() - started, type(error).__name__)
+                if not isinstance(error, retry_exceptions):
+                    raise
+                reason = 'failed with {}'.format(type(error).__name__)
+                if not self._backoff(action, reason, attempt):
+                    raise
+            else:
+                metrics.observe_api_call(action, time.time() - started)
+                bucket.increase()
+                return result
+
+            attempt += 1
+
+    def _backoff(self, action, reason, attempt):
+        """ Sleep before the next attempt of a failed call
+
+        :type action: str
+        :param action: EC2 API action
+        :type reason: str
+        :param reason: Why the call failed, for the log
+        :type attempt: int
+        :param attempt: Number of retries made so far
+        :returns: bool -- False if the call must not be retried again
+        """
+        if attempt >= self.max_retries:
+            logger.error('{} {}, giving up after {} retries'.format(
+                action, reason, attempt))
+            return False
+
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt + 1)))
+        logger.warning(
+            '{} {}, retrying in {:.1f} seconds (attempt {} of {})'.format(
+                action, reason, delay, attempt + 1, self.max_retries))
+        time.sleep(delay)
+        return True
+
+
+def throttle_connection(connection, limiter=None):
+    """ Route all API calls of an EC2 connection through a rate limiter
+
+    boto sends every EC2 request through get_list, get_object or
+    get_status, including calls made from Volume and Snapshot objects, so
+    wrapping those three methods covers all API actions. boto's own
+    retries are turned off, as they would hide throttling from the
+    limiter. The limiter retries the connection errors boto would have
+    retried instead.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type limiter: RateLimiter
+    :param limiter: Rate limiter to use. Default: a new RateLimiter
+    :returns: boto.ec2.connection.EC2Connection -- The same connection
+    """
+    if getattr(connection, 'rate_limiter', None):
+        return connection
+
+    if limiter is None:
+        limiter = RateLimiter()
+
+    for name in ['get_list', 'get_object', 'get_status']:
+        setattr(
+            connection,
+            name,
+            _throttled(
+                limiter, getattr(connection, name),
+                connection.http_exceptions))
+    connection.num_retries = 0
+    connection.rate_limiter = limiter
+
+    return connection
+
+
+def _throttled(limiter, method, retry_exceptions=()):
+    """ Wrap a boto request method in the rate limiter
+
+    :type limiter: RateLimiter
+    :param limiter: Rate limiter to use
+    :type method: callable
+    :param method: Bound get_list, get_object or get_status method
+    :type retry_exceptions: tuple
+    :param retry_exceptions: Connection errors to retry
+    :returns: callable
+    """
+    @functools.wraps(method)
+    def wrapper(action, *args, **kwargs):
+        return limiter.call_with_retries(
+            action, retry_exceptions, method, action, *args, **kwargs)
+
+    return wrapper
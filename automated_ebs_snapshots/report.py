@@ -0,0 +1,203 @@
+""" Report the snapshot lag and retention of watched volumes
+
+compute_report works on volumes and snapshots that have already been
+fetched, like planner.compute_plan, so a report needs no API calls beyond
+one sweep over the volumes and one over the snapshots.
+"""
+import csv
+import json
+import logging
+import sys
+
+from automated_ebs_snapshots import planner
+from automated_ebs_snapshots import retention
+from automated_ebs_snapshots import snapshot_record
+from automated_ebs_snapshots.valid_intervals import INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Columns of the CSV output, in order
+COLUMNS = [
+    'volume_id', 'name', 'interval', 'retention', 'status', 'newest',
+    'age', 'completed_age', 'overdue', 'snapshots', 'pending', 'kept',
+    'expired']
+
+
+def compute_report(volumes, snapshots_by_volume, now, slots=None):
+    """ Compute the snapshot lag and retention of volumes
+
+    :type volumes: list
+    :param volumes: Watched volumes
+    :type snapshots_by_volume: dict
+    :param snapshots_by_volume: {volume_id: [snapshots]}
+    :type now: float
+    :param now: Current UNIX timestamp
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :returns: list -- One dict per volume with the keys in COLUMNS, most
+        overdue first. age and overdue are in seconds, and None for
+        volumes without snapshots. overdue is negative until the volume is
+        due. completed_age is the age of the newest completed snapshot,
+        None if there is none. kept is the most snapshots the retention
+        keeps, 0 == all
+    """
+    rows = []
+    for volume in volumes:
+        snapshots = planner.get_volume_snapshots(
+            snapshots_by_volume.get(volume.id, []))
+        interval = volume.tags.get('AutomatedEBSSnapshots')
+        value = volume.tags.get('AutomatedEBSSnapshotsRetention', '0')
+
+        age = planner.get_newest_age(snapshots, now)
+        if age == planner.NO_SNAPSHOT_AGE:
+            age = None
+        completed = [
+            snapshot.start_time for snapshot in snapshots
+            if snapshot.status == 'completed']
+
+        row = {
+            'volume_id': volume.id,
+            'name': volume.tags.get('Name', ''),
+            'interval': interval,
+            'retention': value,
+            'status': 'ok',
+            'newest': None,
+            'age': age,
+            'completed_age': (
+                int(now - max(completed)) if completed else None),
+            'overdue': None,
+            'snapshots': len(completed),
+            'pending': len([
+                snapshot for snapshot in snapshots
+                if snapshot.status == 'pending']),
+            'kept': 0,
+            'expired': 0
+        }
+        rows.append(row)
+
+        if age is not None:
+            last_snapshot = int(now) - age
+            row['newest'] = snapshot_record.format_timestamp(last_snapshot)
+            if interval in INTERVAL_SECONDS:
+                if slots is not None:
+                    due_time = slots.get_due_time(
+                        volume.id, interval, last_snapshot)
+                else:
+                    due_time = last_snapshot + INTERVAL_SECONDS[interval]
+                row['overdue'] = int(now - due_time)
+
+        try:
+            policy = retention.parse_policy(value)
+        except ValueError:
+            row['status'] = 'invalid retention'
+        else:
+            row['kept'] = retention.max_kept(policy)
+            row['expired'] = len(planner.select_expired(snapshots, policy))
+            if row['expired']:
+                row['status'] = 'over retention'
+
+        if interval not in INTERVAL_SECONDS:
+            row['status'] = 'invalid interval'
+        elif age is None:
+            row['status'] = 'no snapshots'
+        elif row['overdue'] > 0:
+            row['status'] = 'overdue'
+
+    rows.sort(key=_get_sort_key)
+    return rows
+
+
+def print_report(rows, output_format='table'):
+    """ Print a report
+
+    JSON and CSV are printed to stdout, tables are logged.
+
+    :type rows: list
+    :param rows: Report as returned by compute_report
+    :type output_format: str
+    :param output_format: table, csv or json
+    :returns: None
+    """
+    if output_format == 'json':
+        print(json.dumps(rows, indent=2, sort_keys=True))
+        return
+
+    if output_format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow([_format_csv(row[column]) for column in COLUMNS])
+        return
+
+    separator = '+{}+{}+{}+{}+{}+{}+{}+{}+'.format(
+        '-' * 23, '-' * 22, '-' * 10, '-' * 18, '-' * 10, '-' * 10,
+        '-' * 12, '-' * 19)
+    # Unicode, as volume names may not be ASCII
+    row_format = (
+        u'| {:<21} | {:<20} | {:<8} | {:<16} | {:>8} | {:>8} | {:>10} | '
+        u'{:<17} |')
+
+    logger.info(separator)
+    logger.info(row_format.format(
+        'Volume ID', 'Volume name', 'Interval', 'Retention', 'Age',
+        'Overdue', 'Snapshots', 'Status'))
+    logger.info(separator)
+    for row in rows:
+        logger.info(row_format.format(
+            row['volume_id'],
+            row['name'][:20],
+            row['interval'] or '',
+            row['retention'][:16],
+            _format_duration(row['age']),
+            _format_duration(row['overdue']),
+            '{}/{}'.format(row['snapshots'], row['kept'] or '-'),
+            row['status']))
+    logger.info(separator)
+
+    statuses = {}
+    for row in rows:
+        statuses[row['status']] = statuses.get(row['status'], 0) + 1
+    logger.info('Reported {} volumes: {}'.format(
+        len(rows), ', '.join(
+            '{} {}'.format(count, status)
+            for status, count in sorted(statuses.items())) or 'none'))
+
+
+def _get_sort_key(row):
+    """ Sort volumes without snapshots first, then the most overdue
+
+    :type row: dict
+    :param row: Row of the report
+    :returns: tuple
+    """
+    if row['status'] == 'invalid interval':
+        return (2, 0, row['volume_id'])
+    if row['overdue'] is None:
+        return (0, 0, row['volume_id'])
+    return (1, -row['overdue'], row['volume_id'])
+
+
+def _format_csv(value):
+    """ Format a value for the csv module, which needs byte strings
+
+    :type value: str
+    :param value: Value of a column
+    :returns: str
+    """
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _format_duration(seconds):
+    """ Format seconds as hours, e.g. 26.5h
+
+    :type seconds: int
+    :param seconds: Duration. None == unknown
+    :returns: str
+    """
+    if seconds is None:
+        return '-'
+    return '{:.1f}h'.format(seconds / 3600.0)
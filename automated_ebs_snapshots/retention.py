@@ -0,0 +1,141 @@
+""" Parse and apply snapshot retention policies
+
+The AutomatedEBSSnapshotsRetention tag holds either a number of snapshots
+to keep, or a tiered policy such as h24,d14,w8,m12. A tiered policy keeps
+the newest snapshot of each of the 24 most recent hours, 14 most recent
+days, 8 most recent weeks and 12 most recent months that have snapshots.
+A snapshot kept by one tier is also counted by the other tiers it falls in,
+so the policy keeps at most the sum of its counts.
+
+A policy is a list of (unit, count) tiers, where the unit None keeps the
+newest count snapshots. Periods are in UTC and weeks start on Mondays.
+"""
+import time
+
+# Tier units of tiered policies
+TIER_UNITS = ('h', 'd', 'w', 'm', 'y')
+
+
+def parse_policy(value):
+    """ Parse a retention tag value
+
+    :type value: str
+    :param value: Number of snapshots to keep, or tiers like h24,d14,w8,m12
+    :returns: list -- [(unit, count)]. [] == keep all
+    :raises: ValueError -- If the value is not a valid retention
+    """
+    value = str(value).strip().lower()
+    try:
+        count = int(value)
+    except ValueError:
+        pass
+    else:
+        if count < 0:
+            raise ValueError('Invalid retention {}'.format(value))
+        return [(None, count)] if count else []
+
+    policy = []
+    units = set()
+    for tier in value.split(','):
+        tier = tier.strip()
+        unit = tier[:1]
+        if unit not in TIER_UNITS or unit in units or not tier[1:].isdigit():
+            raise ValueError('Invalid retention {}'.format(value))
+        units.add(unit)
+        count = int(tier[1:])
+        if count:
+            policy.append((unit, count))
+
+    return policy
+
+
+def format_policy(policy):
+    """ Format a policy as a retention tag value
+
+    :type policy: list
+    :param policy: Policy as returned by parse_policy
+    :returns: str
+    """
+    if not policy:
+        return '0'
+    if policy[0][0] is None:
+        return str(policy[0][1])
+    return ','.join('{}{}'.format(unit, count) for unit, count in policy)
+
+
+def max_kept(policy):
+    """ Get the maximum number of snapshots a policy keeps
+
+    :type policy: list
+    :param policy: Policy as returned by parse_policy
+    :returns: int -- 0 == keep all
+    """
+    return sum(count for unit, count in policy)
+
+
+def select_expired(items, policy, key):
+    """ Select the items not kept by a policy
+
+    The items are sorted newest first and bucketed in one pass, counting
+    down the remaining periods of every tier as new periods are reached.
+
+    :type items: list
+    :param items: Snapshots or snapshot sets
+    :type policy: list
+    :param policy: Policy as returned by parse_policy
+    :type key: callable
+    :param key: Function returning the UNIX timestamp of an item
+    :returns: list -- Expired items, oldest first
+    """
+    if not policy:
+        return []
+
+    remaining = [count for unit, count in policy]
+    last_periods = [None] * len(policy)
+
+    expired = []
+    for position, item in enumerate(sorted(items, key=key, reverse=True)):
+        timestamp = key(item)
+        kept = False
+        for tier, (unit, count) in enumerate(policy):
+            if not remaining[tier]:
+                continue
+
+            period = _get_period(unit, timestamp, position)
+            if period != last_periods[tier]:
+                last_periods[tier] = period
+                remaining[tier] -= 1
+                kept = True
+
+        if not kept:
+            expired.append(item)
+
+    expired.reverse()
+    return expired
+
+
+def _get_period(unit, timestamp, position):
+    """ Get the period of a tier that a timestamp falls in
+
+    :type unit: str
+    :param unit: Tier unit, None == every item is its own period
+    :type timestamp: int
+    :param timestamp: UNIX timestamp
+    :type position: int
+    :param position: Position of the item, newest first
+    :returns: int
+    """
+    if unit is None:
+        return position
+    if unit == 'h':
+        return timestamp // 3600
+    if unit == 'd':
+        return timestamp // 86400
+    if unit == 'w':
+        # 1970-01-01 was a Thursday
+        return (timestamp // 86400 + 3) // 7
+
+    date = time.gmtime(timestamp)
+    if unit == 'm':
+        return date.tm_year * 12 + date.tm_mon
+    return date.tm_year
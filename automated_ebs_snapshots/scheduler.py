@@ -0,0 +1,80 @@
+""" Schedule volumes by the time their next snapshot is due """
+import heapq
+
+
+class Scheduler(object):
+    """ Priority queue of volumes ordered by their next due time
+
+    Rescheduling or removing a volume leaves its old heap entry in place;
+    stale entries are skipped when they reach the top of the heap.
+    """
+    def __init__(self):
+        """ Constructor """
+        self._heap = []
+        self._due_times = {}
+
+    def __len__(self):
+        return len(self._due_times)
+
+    def __contains__(self, volume_id):
+        return volume_id in self._due_times
+
+    def schedule(self, volume_id, due_time):
+        """ Schedule a volume, replacing any earlier due time
+
+        :type volume_id: str
+        :param volume_id: Volume ID
+        :type due_time: float
+        :param due_time: UNIX timestamp when the volume is due
+        :returns: None
+        """
+        self._due_times[volume_id] = due_time
+        heapq.heappush(self._heap, (due_time, volume_id))
+
+    def remove(self, volume_id):
+        """ Stop scheduling a volume
+
+        :type volume_id: str
+        :param volume_id: Volume ID
+        :returns: None
+        """
+        self._due_times.pop(volume_id, None)
+
+    def clear(self):
+        """ Remove all volumes """
+        self._heap = []
+        self._due_times = {}
+
+    def next_due_time(self):
+        """ Get the earliest due time
+
+        :returns: float -- UNIX timestamp or None if nothing is scheduled
+        """
+        self._drop_stale()
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, now):
+        """ Remove and return all volumes that are due
+
+        :type now: float
+        :param now: Current UNIX timestamp
+        :returns: list -- Volume IDs
+        """
+        due = []
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            due_time, volume_id = heapq.heappop(self._heap)
+            del self._due_times[volume_id]
+            due.append(volume_id)
+
+    def _drop_stale(self):
+        """ Pop heap entries that were rescheduled or removed """
+        while self._heap:
+            due_time, volume_id = self._heap[0]
+            if self._due_times.get(volume_id) == due_time:
+                return
+            heapq.heappop(self._heap)
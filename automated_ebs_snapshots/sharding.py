@@ -0,0 +1,309 @@
+""" Split the watched volumes and instances between several daemons
+
+With --shard I/N, the range of 32 bit hashes of volume and instance IDs is
+divided into N equal shards, and a daemon owns shard I. Daemons on
+different hosts can then share the work of one account and region.
+
+Ownership is held through leases in a LeaseBackend shared by all daemons.
+A daemon renews the lease of its own shard on every check. If a daemon
+dies, its lease expires and another daemon takes the shard over, until the
+owner is back and asks for it. A shard is only released between runs and
+only taken over once its lease expired, so a volume is never processed by
+two daemons at the same time. A run must therefore finish within the lease
+TTL.
+"""
+import logging
+import os
+import socket
+import sqlite3
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+def parse_shard(value):
+    """ Parse a shard of the form I/N
+
+    :type value: str
+    :param value: Shard, e.g. 2/5 for the second of five shards
+    :returns: tuple -- (shard, count)
+    :raises: ValueError -- If the shard can not be parsed
+    """
+    try:
+        shard, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard {}'.format(value))
+
+    if not 1 <= shard <= count:
+        raise ValueError('Invalid shard {}'.format(value))
+
+    return shard, count
+
+
+def get_shard(resource_id, count):
+    """ Get the shard of a volume or instance
+
+    :type resource_id: str
+    :param resource_id: Volume or instance ID
+    :type count: int
+    :param count: Number of shards
+    :returns: int -- Shard [1-count]
+    """
+    return ((zlib.crc32(resource_id) & 0xffffffff) * count >> 32) + 1
+
+
+class LeaseBackend(object):
+    """ Store of shard leases shared by all daemons
+
+    Implementations must make acquire atomic across all daemons, e.g. with
+    a conditional write.
+    """
+    def get_leases(self):
+        """ Get all leases
+
+        :returns: dict -- {shard: (owner, expires, requested_by)}
+        """
+        raise NotImplementedError
+
+    def acquire(self, shard, owner, ttl, now):
+        """ Acquire or renew the lease of a shard
+
+        The lease is granted if it is not held, has expired or is already
+        held by owner. Granting a lease clears a request by the new owner.
+
+        :type shard: int
+        :param shard: Shard
+        :type owner: str
+        :param owner: Daemon asking for the lease
+        :type ttl: int
+        :param ttl: Seconds until the lease expires
+        :type now: float
+        :param now: Current UNIX timestamp
+        :returns: bool -- True if owner holds the lease
+        """
+        raise NotImplementedError
+
+    def request(self, shard, owner):
+        """ Ask the holder of a lease to hand it over, see hand_over
+
+        :type shard: int
+        :param shard: Shard
+        :type owner: str
+        :param owner: Daemon asking for the lease
+        :returns: None
+        """
+        raise NotImplementedError
+
+    def hand_over(self, shard, owner, ttl, now):
+        """ Pass a lease held by owner to the daemon that requested it
+
+        :type shard: int
+        :param shard: Shard
+        :type owner: str
+        :param owner: Daemon holding the lease
+        :type ttl: int
+        :param ttl: Seconds until the lease of the new owner expires
+        :type now: float
+        :param now: Current UNIX timestamp
+        :returns: None
+        """
+        raise NotImplementedError
+
+    def release(self, shard, owner):
+        """ Release a lease, if held by owner
+
+        :type shard: int
+        :param shard: Shard
+        :type owner: str
+        :param owner: Daemon holding the lease
+        :returns: None
+        """
+        raise NotImplementedError
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """ Leases in an SQLite database
+
+    The database must be reachable by all daemons, so this backend suits
+    daemons on one host, or testing. SQLite locking is not reliable on most
+    network file systems.
+    """
+    def __init__(self, path):
+        """ Constructor
+
+        The database is opened on first use, so the backend can be created
+        before the daemon forks.
+
+        :type path: str
+        :param path: Path to the database file
+        """
+        self.path = path
+        self.db = None
+
+    def get_leases(self):
+        cursor = self._get_db().execute(
+            'SELECT shard, owner, expires, requested_by FROM leases')
+        return dict((row[0], (row[1], row[2], row[3])) for row in cursor)
+
+    def acquire(self, shard, owner, ttl, now):
+        db = self._get_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT owner, expires, requested_by FROM leases '
+                'WHERE shard = ?', (shard,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+
+            requested_by = row[2] if row is not None else None
+            if requested_by == owner:
+                requested_by = None
+            db.execute(
+                'INSERT OR REPLACE INTO leases (shard, owner, expires, '
+                'requested_by) VALUES (?, ?, ?, ?)',
+                (shard, owner, int(now + ttl), requested_by))
+            return True
+        finally:
+            db.execute('COMMIT')
+
+    def request(self, shard, owner):
+        self._get_db().execute(
+            'UPDATE leases SET requested_by = ? WHERE shard = ? AND '
+            'owner != ?', (owner, shard, owner))
+
+    def hand_over(self, shard, owner, ttl, now):
+        self._get_db().execute(
+            'UPDATE leases SET owner = requested_by, requested_by = NULL, '
+            'expires = ? WHERE shard = ? AND owner = ? AND '
+            'requested_by IS NOT NULL', (int(now + ttl), shard, owner))
+
+    def release(self, shard, owner):
+        self._get_db().execute(
+            'DELETE FROM leases WHERE shard = ? AND owner = ?',
+            (shard, owner))
+
+    def _get_db(self):
+        """ Get the database connection, opening it on first use
+
+        :returns: sqlite3.Connection
+        """
+        if self.db is None:
+            # Autocommit, with explicit transactions in acquire
+            self.db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'shard INTEGER PRIMARY KEY, owner TEXT, expires INTEGER, '
+                'requested_by TEXT)')
+        return self.db
+
+
+class Shards(object):
+    """ The shards owned by one daemon or run """
+    def __init__(self, shard, count, backend=None, ttl=900, owner=None):
+        """ Constructor
+
+        :type shard: int
+        :param shard: Shard of this daemon [1-count]
+        :type count: int
+        :param count: Number of shards
+        :type backend: LeaseBackend
+        :param backend: Lease store shared by all daemons. None == own the
+            shard without leases, and never take over other shards
+        :type ttl: int
+        :param ttl: Seconds until a lease that is not renewed expires
+        :type owner: str
+        :param owner: Name of this daemon in the leases.
+            Default: <hostname>:<pid> of the process that first calls
+            refresh, so a Shards built before the daemon forks carries the
+            pid of the daemon
+        """
+        self.shard = shard
+        self.count = count
+        self.backend = backend
+        self.ttl = ttl
+        self.owner = owner
+        self.started = None
+        self.owned = set([shard]) if backend is None else set()
+
+    def owns(self, resource_id):
+        """ Check if a volume or instance is in an owned shard
+
+        :type resource_id: str
+        :param resource_id: Volume or instance ID
+        :returns: bool
+        """
+        return get_shard(resource_id, self.count) in self.owned
+
+    def refresh(self, now=None):
+        """ Renew, take over and hand back leases
+
+        Call this between runs, and at least once every third of the TTL.
+        Shards without a lease are only taken over one TTL after the first
+        refresh, to give all daemons the time to start.
+
+        :type now: float
+        :param now: Current UNIX timestamp. Default: time.time()
+        :returns: bool -- True if the owned shards changed
+        """
+        if self.backend is None:
+            return False
+
+        if now is None:
+            now = time.time()
+        if self.started is None:
+            self.started = now
+        if self.owner is None:
+            self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        leases = self.backend.get_leases()
+        owned = set()
+        for shard in range(1, self.count + 1):
+            owner, expires, requested_by = leases.get(
+                shard, (None, None, None))
+
+            if shard == self.shard:
+                if self.backend.acquire(shard, self.owner, self.ttl, now):
+                    owned.add(shard)
+                elif requested_by != self.owner:
+                    logger.info(
+                        'Shard {} is held by {}, asking for it back'.format(
+                            shard, owner))
+                    self.backend.request(shard, self.owner)
+
+            elif owner == self.owner:
+                if requested_by is not None:
+                    logger.info('Handing shard {} back to {}'.format(
+                        shard, requested_by))
+                    self.backend.hand_over(shard, self.owner, self.ttl, now)
+                elif self.backend.acquire(shard, self.owner, self.ttl, now):
+                    owned.add(shard)
+
+            elif (owner is None and now - self.started >= self.ttl or
+                    owner is not None and expires <= now):
+                if self.backend.acquire(shard, self.owner, self.ttl, now):
+                    logger.warning(
+                        'Taking over shard {} from {}'.format(
+                            shard, owner or 'no owner'))
+                    owned.add(shard)
+
+        changed = owned != self.owned
+        if changed:
+            logger.info('Owning shards {} of {}'.format(
+                ', '.join(str(shard) for shard in sorted(owned)) or 'none',
+                self.count))
+        self.owned = owned
+        return changed
+
+    def release(self):
+        """ Release all leases, e.g. when stopping
+
+        :returns: None
+        """
+        if self.backend is None:
+            return
+
+        for shard in self.owned:
+            self.backend.release(shard, self.owner)
+        self.owned = set()
@@ -0,0 +1,106 @@
+""" Spread and align the times volumes are due for a snapshot
+
+Without slots a volume is due once its newest snapshot is older than the
+interval, so volumes first snapshotted together stay due together. With
+slots, each interval is divided into periods starting at a fixed time, and
+every volume gets a slot in each period: the aligned time plus an offset
+within the window, derived from a hash of the volume ID. A volume is due
+once its newest snapshot predates its latest slot.
+
+Periods start on Monday 1970-01-05 00:00 UTC, so daily slots are at the
+same time every day, weekly slots on the same weekday and hourly slots at
+the same minute of every hour.
+"""
+import zlib
+
+from automated_ebs_snapshots.valid_intervals import INTERVAL_SECONDS
+
+# Start of the first period, a Monday
+ORIGIN = 4 * 86400
+
+
+class Slots(object):
+    """ Deterministic per volume snapshot slots """
+    def __init__(self, window=0, align=None):
+        """ Constructor
+
+        :type window: int
+        :param window: Seconds after the aligned time to spread the slots
+            of the volumes over. 0 == no spreading
+        :type align: int
+        :param align: Seconds from the start of each period that the
+            window starts at, see parse_time. None == start of the period
+        """
+        self.window = window
+        self.align = align or 0
+
+    def get_offset(self, resource_id, interval):
+        """ Get the offset of a volume's slot in each period
+
+        :type resource_id: str
+        :param resource_id: Volume or instance ID
+        :type interval: str
+        :param interval: A valid snapshotting interval
+        :returns: int -- Seconds from the start of the period
+        """
+        period = INTERVAL_SECONDS[interval]
+        offset = self.align
+        window = min(self.window, period)
+        if window:
+            offset += (zlib.crc32(resource_id) & 0xffffffff) % window
+        return offset % period
+
+    def get_max_age(self, resource_id, interval, now):
+        """ Get the maximum age of the newest snapshot of a volume
+
+        :type resource_id: str
+        :param resource_id: Volume or instance ID
+        :type interval: str
+        :param interval: A valid snapshotting interval
+        :type now: float
+        :param now: Current UNIX timestamp
+        :returns: int -- Seconds since the latest slot
+        """
+        period = INTERVAL_SECONDS[interval]
+        base = ORIGIN + self.get_offset(resource_id, interval)
+        return int(now - base) % period
+
+    def get_due_time(self, resource_id, interval, last_snapshot):
+        """ Get the first slot after a snapshot
+
+        :type resource_id: str
+        :param resource_id: Volume or instance ID
+        :type interval: str
+        :param interval: A valid snapshotting interval
+        :type last_snapshot: int
+        :param last_snapshot: Start time of the newest snapshot
+        :returns: int -- UNIX timestamp
+        """
+        period = INTERVAL_SECONDS[interval]
+        base = ORIGIN + self.get_offset(resource_id, interval)
+        return last_snapshot + period - (last_snapshot - base) % period
+
+
+def parse_time(value):
+    """ Parse an aligned time of the form [HH:]MM, in UTC
+
+    :type value: str
+    :param value: Time, e.g. 02:30. A bare number is minutes past the hour
+    :returns: int -- Seconds from midnight
+    :raises: ValueError -- If the time can not be parsed
+    """
+    parts = value.split(':')
+    try:
+        if len(parts) == 1:
+            hours, minutes = 0, int(parts[0])
+        elif len(parts) == 2:
+            hours, minutes = int(parts[0]), int(parts[1])
+        else:
+            raise ValueError
+    except ValueError:
+        raise ValueError('Invalid time {}'.format(value))
+
+    if not 0 <= hours < 24 or not 0 <= minutes < 60:
+        raise ValueError('Invalid time {}'.format(value))
+
+    return hours * 3600 + minutes * 60
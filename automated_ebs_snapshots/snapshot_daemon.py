@@ -0,0 +1,255 @@
+""" Daemon running the snapshot manager on a schedule """
+import logging
+import signal
+import sys
+import time
+
+from automated_ebs_snapshots import connection_manager
+from automated_ebs_snapshots import metrics
+from automated_ebs_snapshots import scheduler
+from automated_ebs_snapshots import snapshot_manager
+from automated_ebs_snapshots import state_cache
+from automated_ebs_snapshots import volume_manager
+from automated_ebs_snapshots.daemon import Daemon
+
+logger = logging.getLogger(__name__)
+
+
+class AutoEBSDaemon(Daemon):
+    """ Daemon for automatic-ebs-snapshots
+
+    Watched volumes are kept in a scheduler ordered by the time their next
+    snapshot is due. The daemon sleeps until the earliest of the next due
+    time, the next refresh of the watch list and the next full run.
+
+    With shards, the daemon only handles the volumes and instances of the
+    shards it holds a lease on, and renews the leases on every check. A
+    full run picks up the volumes of shards that were taken over or handed
+    back.
+    """
+    def __init__(self, pidfile, options, slots=None, shards=None):
+        """ Constructor
+
+        :type pidfile: str
+        :param pidfile: Path to the pid file
+        :type options: argparse.Namespace
+        :param options: Parsed command line options
+        :type slots: automated_ebs_snapshots.slots.Slots
+        :param slots: Snapshot slots. None == snapshot once per interval
+        :type shards: automated_ebs_snapshots.sharding.Shards
+        :param shards: Shards to handle. None == all volumes and instances
+        """
+        Daemon.__init__(self, pidfile)
+        self.options = options
+        self.slots = slots
+        self.shards = shards
+
+    def run(self, check_interval=300):
+        """ Run the daemon
+
+        :type check_interval: int
+        :param check_interval: Delay in seconds between refreshes of the
+            list of watched volumes
+        """
+        if self.shards is not None and self.shards.backend is not None:
+            # Hand the leases over right away when stopped
+            signal.signal(signal.SIGTERM, self._stop_signal)
+            check_interval = min(check_interval, self.shards.ttl // 3)
+
+        state = state_cache.StateCache(self.options.state_dir)
+        schedule = scheduler.Scheduler()
+        tracker = snapshot_manager.new_completion_tracker()
+        self._schedule(state, schedule, not_before=0)
+        last_refresh = 0
+
+        # Read configuration from the config file if present, else fall
+        # back to command line options. The connection is reused across
+        # cycles until the config file changes
+        connections = connection_manager.ConnectionCache(
+            config_file=self.options.config,
+            region=self.options.region,
+            access_key=self.options.access_key_id,
+            secret_key=self.options.secret_access_key)
+
+        while True:
+            connection = connections.get_connection()
+
+            now = time.time()
+            shards_changed = (
+                self.shards is not None and self.shards.refresh(now))
+            if shards_changed or state.needs_reconcile(
+                    self.options.reconcile_interval, now):
+                self._run(
+                    connection, state, schedule, tracker, check_interval,
+                    bulk=bool(self.options.bulk_fetch))
+                state.set_last_reconcile(now)
+                last_refresh = now
+
+            elif now - last_refresh >= check_interval:
+                self._refresh(
+                    connection, state, schedule, tracker, check_interval)
+                last_refresh = now
+
+            if tracker.next_poll_time and tracker.next_poll_time <= now:
+                for result in tracker.poll(connection):
+                    # Completed snapshots count towards the retention, so
+                    # the volume may have snapshots to delete now. The
+                    # retention of instances is applied in full runs
+                    if result['status'] == 'completed' and \
+                            result['instance_id'] is None:
+                        schedule.schedule(result['volume_id'], now)
+
+            volume_ids = schedule.pop_due(time.time())
+            if volume_ids:
+                self._run(
+                    connection, state, schedule, tracker, check_interval,
+                    volume_ids=volume_ids)
+
+            if self.options.metrics_file:
+                metrics.set_snapshot_lag(
+                    (volume['interval'], volume['last_completed'])
+                    for volume in state.get_volumes())
+                metrics.write_textfile(self.options.metrics_file)
+
+            wake_up = min(
+                wake_up for wake_up in [
+                    schedule.next_due_time(),
+                    tracker.next_poll_time,
+                    last_refresh + check_interval,
+                    state.get_last_reconcile() +
+                    self.options.reconcile_interval]
+                if wake_up is not None)
+            delay = max(1, wake_up - time.time())
+            logger.info('Sleeping {:.0f} seconds until next check'.format(
+                delay))
+            time.sleep(delay)
+
+    def _run(self, connection, state, schedule, tracker, check_interval,
+             volume_ids=None, bulk=False):
+        """ Run the snapshot manager and reschedule the processed volumes
+
+        :type connection: boto.ec2.connection.EC2Connection
+        :param connection: EC2 connection object
+        :type state: automated_ebs_snapshots.state_cache.StateCache
+        :param state: State cache
+        :type schedule: automated_ebs_snapshots.scheduler.Scheduler
+        :param schedule: Scheduler
+        :type tracker: completion_tracker.CompletionTracker
+        :param tracker: Tracker for the created snapshots
+        :type check_interval: int
+        :param check_interval: Minimum delay before a volume is retried
+        :type volume_ids: list
+        :param volume_ids: Volumes to process. None == all watched
+        :type bulk: bool
+        :param bulk: Fetch all snapshots in one paged sweep
+        :returns: None
+        """
+        snapshot_manager.run(
+            connection,
+            bulk=bulk,
+            workers=self.options.workers,
+            max_deletions=self.options.max_deletions,
+            volume_ids=volume_ids,
+            state=state,
+            tracker=tracker,
+            slots=self.slots,
+            shards=self.shards)
+
+        self._schedule(
+            state, schedule,
+            not_before=time.time() + check_interval,
+            volume_ids=volume_ids)
+
+    def _refresh(self, connection, state, schedule, tracker,
+                 check_interval):
+        """ Pick up volumes that were watched, unwatched or changed
+
+        :type connection: boto.ec2.connection.EC2Connection
+        :param connection: EC2 connection object
+        :type state: automated_ebs_snapshots.state_cache.StateCache
+        :param state: State cache
+        :type schedule: automated_ebs_snapshots.scheduler.Scheduler
+        :param schedule: Scheduler
+        :type tracker: completion_tracker.CompletionTracker
+        :param tracker: Tracker for the created snapshots
+        :type check_interval: int
+        :param check_interval: Minimum delay before a volume is retried
+        :returns: None
+        """
+        cached = dict(
+            (volume['volume_id'], volume) for volume in state.get_volumes())
+
+        changed = []
+        for volume in volume_manager.iter_watched_volumes(connection):
+            if self.shards is not None and not self.shards.owns(volume.id):
+                continue
+
+            record = cached.pop(volume.id, None)
+            if (record is None or
+                    record['interval'] !=
+                    volume.tags.get('AutomatedEBSSnapshots') or
+                    record['retention'] !=
+                    volume_manager.get_retention(volume)):
+                changed.append(volume.id)
+
+        if cached:
+            logger.info('{} volumes are no longer watched'.format(
+                len(cached)))
+            state.update_volumes([], removed=cached.keys())
+            for volume_id in cached:
+                schedule.remove(volume_id)
+
+        if changed:
+            logger.info('{} volumes are new or have changed tags'.format(
+                len(changed)))
+            self._run(
+                connection, state, schedule, tracker, check_interval,
+                volume_ids=changed)
+
+    def _schedule(self, state, schedule, not_before, volume_ids=None):
+        """ Schedule volumes according to the state cache
+
+        :type state: automated_ebs_snapshots.state_cache.StateCache
+        :param state: State cache
+        :type schedule: automated_ebs_snapshots.scheduler.Scheduler
+        :param schedule: Scheduler
+        :type not_before: float
+        :param not_before: Earliest time to schedule volumes that are
+            already due at, e.g. volumes that failed. Other volumes are
+            scheduled at their due time
+        :type volume_ids: list
+        :param volume_ids: Volumes to reschedule. None == all
+        :returns: None
+        """
+        now = time.time()
+        if volume_ids is None:
+            schedule.clear()
+        else:
+            for volume_id in volume_ids:
+                schedule.remove(volume_id)
+            volume_ids = set(volume_ids)
+
+        for volume in state.get_volumes():
+            if volume_ids is not None and \
+                    volume['volume_id'] not in volume_ids:
+                continue
+
+            due_time = state_cache.get_due_time(volume, self.slots)
+            if due_time is None:
+                continue
+            if due_time <= now:
+                due_time = max(due_time, not_before)
+            schedule.schedule(volume['volume_id'], due_time)
+
+    def _stop_signal(self, signum, frame):
+        """ Release the shard leases and exit on SIGTERM
+
+        :type signum: int
+        :param signum: Signal number
+        :type frame: frame
+        :param frame: Current stack frame
+        :returns: None
+        """
+        logger.info('Stopping, releasing the shard leases')
+        self.shards.release()
+        sys.exit(0)
@@ -1,27 +1,749 @@
 """ Module handling the snapshots """
+import json
 import logging
-import datetime
+import threading
+import time
 
 from boto.exception import EC2ResponseError
 
+from automated_ebs_snapshots import completion_tracker
+from automated_ebs_snapshots import connection_manager
+from automated_ebs_snapshots import instance_manager
+from automated_ebs_snapshots import metrics
+from automated_ebs_snapshots import pagination
+from automated_ebs_snapshots import planner
+from automated_ebs_snapshots import profiling
+from automated_ebs_snapshots import report as snapshot_report
+from automated_ebs_snapshots import retention
+from automated_ebs_snapshots import snapshot_record
 from automated_ebs_snapshots import volume_manager
+from automated_ebs_snapshots import worker_pool
 from automated_ebs_snapshots.valid_intervals import VALID_INTERVALS
 
 logger = logging.getLogger(__name__)
 
+# Seconds between full snapshot sweeps of incremental runs. Full sweeps pick
+# up snapshots that were deleted outside of Automated EBS Snapshots
+FULL_SWEEP_INTERVAL = 86400
 
-def run(connection, force=False):
+# Incremental sweeps fall back to a full sweep if the watermark is older
+# than this many days, to keep the start-time filter short
+MAX_DELTA_DAYS = 7
+
+# Seconds before the watermark to fetch snapshots from, for snapshots that
+# show up in DescribeSnapshots some time after they started
+WATERMARK_OVERLAP = 3600
+
+
+def run(connection, force=False, bulk=False, workers=1, max_deletions=0,
+        volume_ids=None, state=None, tracker=None, slots=None, shards=None):
     """ Ensure that we have snapshots for a given volume
 
+    Snapshots are created per volume first, and per watched instance in
+    full runs. Snapshots exceeding the retention of their volume or
+    instance are then collected into one queue and deleted in a separate
+    stage.
+
+    Full bulk runs with a state cache are incremental: the snapshots are
+    read from the cache and updated with the snapshots started since the
+    watermark, and the retention is only applied to volumes that gained a
+    snapshot or had their tags changed, see _get_incremental_index.
+
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
-    :returns: None
+    :type force: bool
+    :param force: Always create a new snapshot
+    :type bulk: bool
+    :param bulk: Fetch all snapshots in one paged sweep instead of one
+        DescribeSnapshots call per volume
+    :type workers: int
+    :param workers: Number of volumes to process and snapshots to delete
+        concurrently
+    :type max_deletions: int
+    :param max_deletions: Maximum number of snapshots to delete in this
+        run. 0 == no limit
+    :type volume_ids: list
+    :param volume_ids: Only process these volumes. None == all watched
+    :type state: automated_ebs_snapshots.state_cache.StateCache
+    :param state: Cache to record the state of processed volumes in
+    :type tracker: automated_ebs_snapshots.completion_tracker.CompletionTracker
+    :param tracker: Tracker to add the created snapshots to
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :type shards: automated_ebs_snapshots.sharding.Shards
+    :param shards: Only process volumes and instances in these shards.
+        None == all
+    :returns: dict -- Number of created, deleted, skipped and failed
+    """
+    started = time.time()
+    volumes = volume_manager.get_watched_volumes(connection, volume_ids)
+    if shards is not None:
+        volumes = [volume for volume in volumes if shards.owns(volume.id)]
+
+    # All snapshot ages in this run are computed at the same point in time
+    now = time.time()
+
+    # Volumes to apply the retention of. None == all
+    changed = None
+    incremental = bulk and state is not None and volume_ids is None
+    if incremental:
+        with profiling.phase('describe snapshots'):
+            index, delta, full_sweep, watermark = _get_incremental_index(
+                connection, state, now)
+        tags_hashes = dict(
+            (volume.id, volume_manager.get_tags_hash(volume))
+            for volume in volumes)
+        cached_hashes = {} if full_sweep else state.get_tags_hashes()
+        if not full_sweep:
+            changed = set(
+                snapshot.volume_id for snapshot in delta
+                if snapshot.get_tag(snapshot_record.GROUP_TAG) is None)
+            changed.update(
+                volume.id for volume in volumes
+                if cached_hashes.get(volume.id) != tags_hashes[volume.id])
+            logger.info(
+                'Applying the retention of {} of {} volumes with new '
+                'snapshots or changed tags'.format(
+                    len(changed.intersection(tags_hashes)), len(volumes)))
+        for volume in volumes:
+            index.setdefault(volume.id, [])
+    elif bulk:
+        with profiling.phase('describe snapshots'):
+            index = get_snapshot_index(
+                connection, [volume.id for volume in volumes])
+        for volume in volumes:
+            index.setdefault(volume.id, [])
+    else:
+        index = None
+
+    def process(volume):
+        """ Ensure snapshots and find expired snapshots for one volume
+
+        Only the expired snapshots and the newest start time are kept, so
+        the snapshots of a volume can be freed once it is processed.
+        """
+        if index is not None:
+            snapshots = index.pop(volume.id)
+        else:
+            with profiling.phase('describe snapshots'):
+                snapshots = [
+                    snapshot_record.from_snapshot(snapshot)
+                    for snapshot in pagination.iter_snapshots(
+                        connection,
+                        filters={'volume-id': volume.id},
+                        owner=None)]
+        snapshots = planner.get_volume_snapshots(snapshots)
+
+        created = _ensure_snapshot(
+            connection, volume, snapshots, force, now, slots)
+        if changed is None or created or volume.id in changed:
+            expired = _get_expired_snapshots(volume, snapshots)
+        else:
+            expired = []
+
+        # Record the newest usable snapshot, the number of snapshots
+        # counting towards the retention and the newest completed snapshot
+        expired_ids = set(snapshot.id for snapshot in expired)
+        last_snapshot = max([
+            snapshot.start_time for snapshot in snapshots
+            if snapshot.id not in expired_ids and
+            snapshot.status not in planner.FAILED_STATUSES] or [None])
+        completed = [
+            snapshot.start_time for snapshot in snapshots
+            if snapshot.status == 'completed']
+
+        return (
+            created,
+            (last_snapshot, len(completed), max(completed or [None])),
+            expired)
+
+    summary = {
+        'created': 0,
+        'deleted': 0,
+        'delete_failed': 0,
+        'deferred': 0,
+        'skipped': 0,
+        'failed': 0
+    }
+    expired = []
+    processed = []
+    created_snapshots = []
+    for volume, result, error in worker_pool.run_concurrently(
+            process, volumes, workers):
+        if error:
+            summary['failed'] += 1
+            processed.append((volume, None))
+            continue
+
+        created, volume_state, volume_expired = result
+        if created:
+            summary['created'] += 1
+            created_snapshots.append(created)
+            if tracker is not None:
+                tracker.add(volume, created)
+        else:
+            summary['skipped'] += 1
+        expired.extend(volume_expired)
+        processed.append((volume, volume_state))
+
+    instances = []
+    if volume_ids is None:
+        instances = [
+            instance for instance
+            in instance_manager.get_watched_instances(connection)
+            if shards is None or shards.owns(instance.id)]
+
+    def process_instance(instance):
+        """ Ensure snapshot sets and find expired sets for one instance """
+        return instance_manager.process(
+            connection, instance, now, force, slots)
+
+    for instance, result, error in worker_pool.run_concurrently(
+            process_instance, instances, workers):
+        if error:
+            summary['failed'] += 1
+            continue
+
+        created, instance_expired = result
+        if created:
+            summary['created'] += len(created)
+            if tracker is not None:
+                tracker.add_set(instance, created)
+        else:
+            summary['skipped'] += 1
+        expired.extend(instance_expired)
+
+    # Delete the oldest snapshots first, and leave the rest for the next run
+    # if there are more than max_deletions
+    expired.sort(key=lambda x: x.start_time)
+    # Volumes with snapshots left to delete, whose retention is applied
+    # again in the next incremental run
+    pending = set(
+        volume.id for volume, volume_state in processed
+        if volume_state is None)
+    if max_deletions and len(expired) > max_deletions:
+        summary['deferred'] = len(expired) - max_deletions
+        logger.info(
+            'Deferring deletion of {} snapshots to the next run'.format(
+                summary['deferred']))
+        pending.update(
+            snapshot.volume_id for snapshot in expired[max_deletions:])
+        expired = expired[:max_deletions]
+
+    deleted_counts = {}
+    deleted_ids = []
+    stale = False
+    with profiling.phase('delete snapshots'):
+        for snapshot, error in _delete_snapshots(
+                connection, expired, workers):
+            if error:
+                summary['delete_failed'] += 1
+                pending.add(snapshot.volume_id)
+                if getattr(error, 'error_code', None) == \
+                        'InvalidSnapshot.NotFound':
+                    stale = True
+            else:
+                summary['deleted'] += 1
+                deleted_ids.append(snapshot.id)
+                if snapshot.get_tag(snapshot_record.GROUP_TAG) is None:
+                    deleted_counts[snapshot.volume_id] = (
+                        deleted_counts.get(snapshot.volume_id, 0) + 1)
+
+    if state is not None:
+        with profiling.phase('update state'):
+            _update_state(
+                state, processed, deleted_counts, volumes, volume_ids)
+            if incremental:
+                state.update_snapshots(
+                    delta + created_snapshots,
+                    removed=deleted_ids,
+                    replace=full_sweep)
+                state.set_tags_hashes(
+                    dict(
+                        (volume_id, None if volume_id in pending else
+                         tags_hash)
+                        for volume_id, tags_hash in tags_hashes.items()
+                        if volume_id in pending or
+                        cached_hashes.get(volume_id) != tags_hash),
+                    replace=full_sweep)
+                if full_sweep:
+                    state.set_last_full_sweep(now)
+                state.set_watermark(watermark)
+            else:
+                state.update_snapshots([], removed=deleted_ids)
+
+            # A snapshot in the cache was deleted outside of Automated EBS
+            # Snapshots, so the next incremental run makes a full sweep
+            if stale:
+                state.set_watermark(None)
+
+    metrics.observe_run(time.time() - started, summary, volume_ids is None)
+    if volume_ids is None:
+        metrics.set_snapshot_lag(
+            (volume.tags.get('AutomatedEBSSnapshots'),
+             volume_state[2] if volume_state else None)
+            for volume, volume_state in processed)
+
+    logger.info(
+        'Processed {total} volumes and {instances} instances: {created} '
+        'snapshots created, {deleted} snapshots deleted ({delete_failed} '
+        'failed, {deferred} deferred), {skipped} skipped, '
+        '{failed} failed'.format(
+            total=len(volumes), instances=len(instances), **summary))
+
+    return summary
+
+
+def plan(connection, force=False, bulk=False, max_deletions=0,
+         slots=None, shards=None):
+    """ Compute what run() would create and delete, without changing anything
+
+    Volumes and snapshots are fetched once, in bulk, and the plan is
+    computed in memory by planner.compute_plan.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type force: bool
+    :param force: Plan a forced run
+    :type bulk: bool
+    :param bulk: Estimate API calls for a run with bulk fetching
+    :type max_deletions: int
+    :param max_deletions: Maximum number of snapshots to delete in the run.
+        0 == no limit
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :type shards: automated_ebs_snapshots.sharding.Shards
+    :param shards: Only plan volumes in these shards. None == all
+    :returns: dict -- Plan as returned by planner.compute_plan, with the
+        snapshot sets to create under create_sets, as dicts with
+        instance_id and interval, and the estimated API calls of the run
+        under api_calls
     """
     volumes = volume_manager.get_watched_volumes(connection)
+    volume_pages = _get_page_count(
+        len(volumes), pagination.VOLUME_PAGE_SIZE)
+    instances = instance_manager.get_watched_instances(connection)
+    instance_pages = _get_page_count(
+        len(instances), pagination.INSTANCE_PAGE_SIZE)
+    if shards is not None:
+        volumes = [volume for volume in volumes if shards.owns(volume.id)]
+        instances = [
+            instance for instance in instances if shards.owns(instance.id)]
+    instances = [
+        instance for instance in instances
+        if instance.tags['AutomatedEBSSnapshots'] in VALID_INTERVALS]
+
+    # The sweep reads all snapshots of the account, but only the snapshots
+    # of the watched volumes and instances are indexed, like in run()
+    counts = {}
+    index = get_snapshot_index(
+        connection, [volume.id for volume in volumes], counts=counts,
+        instance_ids=[instance.id for instance in instances])
+    snapshot_pages = _get_page_count(
+        counts['snapshots'], pagination.SNAPSHOT_PAGE_SIZE)
+
+    now = time.time()
+    run_plan = planner.compute_plan(
+        volumes, index, now,
+        force=force, max_deletions=max_deletions, slots=slots)
+    run_plan['create_sets'] = [
+        {
+            'instance_id': instance.id,
+            'interval': instance.tags['AutomatedEBSSnapshots']
+        }
+        for instance in instances
+        if instance_manager.needs_snapshot_set(
+            instance, index.get(instance.id, []), now, force, slots)]
+    run_plan['api_calls'] = planner.estimate_api_calls(
+        run_plan,
+        len(volumes),
+        volume_pages,
+        snapshot_pages,
+        bulk=bulk,
+        named_volume_ids=set(
+            volume.id for volume in volumes if volume.tags.get('Name')),
+        instance_count=len(instances),
+        instance_pages=instance_pages)
+
+    return run_plan
+
+
+def report(connection, slots=None, shards=None):
+    """ Report the snapshot lag and retention of all watched volumes
+
+    All data comes from one paged sweep over the watched volumes and one
+    over the snapshots of the account.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :type shards: automated_ebs_snapshots.sharding.Shards
+    :param shards: Only report volumes in these shards. None == all
+    :returns: list -- Report as returned by report.compute_report
+    """
+    volumes = volume_manager.get_watched_volumes(connection)
+    if shards is not None:
+        volumes = [volume for volume in volumes if shards.owns(volume.id)]
+
+    with profiling.phase('describe snapshots'):
+        index = get_snapshot_index(
+            connection, [volume.id for volume in volumes])
+
+    return snapshot_report.compute_report(
+        volumes, index, time.time(), slots=slots)
+
+
+def print_plan(run_plan, output_format='table'):
+    """ Print a plan
+
+    :type run_plan: dict
+    :param run_plan: Plan as returned by plan()
+    :type output_format: str
+    :param output_format: table or json. csv is rejected by main()
+    :returns: None
+    """
+    if output_format == 'json':
+        print(json.dumps(run_plan, indent=2, sort_keys=True))
+        return
+
+    separator = '+{}+{}+{}+'.format('-' * 10, '-' * 25, '-' * 52)
+    row = '| {:<8} | {:<23} | {:<50} |'
+
+    logger.info(separator)
+    logger.info(row.format('Action', 'Volume or instance ID', 'Details'))
+    logger.info(separator)
+    for create in run_plan['create']:
+        if create['age'] is None:
+            details = '{}, no snapshots'.format(create['interval'])
+        else:
+            details = '{}, newest is {} seconds old'.format(
+                create['interval'], create['age'])
+        logger.info(row.format('create', create['volume_id'], details))
+    for delete in run_plan['delete']:
+        logger.info(row.format(
+            'delete', delete['volume_id'],
+            '{} ({})'.format(delete['snapshot_id'], delete['start_time'])))
+    for create_set in run_plan['create_sets']:
+        logger.info(row.format(
+            'create', create_set['instance_id'],
+            '{}, snapshot set of all volumes'.format(
+                create_set['interval'])))
+    for skipped in run_plan['skipped']:
+        logger.info(row.format(
+            'skip', skipped['volume_id'], skipped['reason']))
+    logger.info(separator)
+
+    logger.info(
+        'Plan: create {} snapshots and {} snapshot sets, delete {} '
+        'snapshots, defer {} deletions, skip {} volumes'.format(
+            len(run_plan['create']),
+            len(run_plan['create_sets']),
+            len(run_plan['delete']),
+            len(run_plan['deferred']),
+            len(run_plan['skipped'])))
+    logger.info('The run would make {} API calls: {}'.format(
+        sum(run_plan['api_calls'].values()),
+        ', '.join(
+            '{} {}'.format(count, action)
+            for action, count in sorted(run_plan['api_calls'].items()))))
+
+
+def new_completion_tracker():
+    """ Create a tracker for snapshots created by run()
+
+    Failed snapshots are retried with the same description as the
+    original snapshot, and failed snapshot sets with a new set of the
+    instance.
+
+    :returns: completion_tracker.CompletionTracker
+    """
+    return completion_tracker.CompletionTracker(
+        create_snapshot=_create_snapshot,
+        create_snapshot_set=_create_snapshot_set)
+
+
+def run_targets(targets, force=False, bulk=False, workers=1,
+                max_deletions=0, completion_timeout=0, slots=None,
+                shards=None):
+    """ Run for several accounts and regions concurrently
+
+    Each target gets its own connection, rate limits and pool of workers.
+
+    :type targets: list
+    :param targets: Targets as returned by
+        config_file_parser.get_configuration
+    :type force: bool
+    :param force: Always create a new snapshot
+    :type bulk: bool
+    :param bulk: Fetch all snapshots in one paged sweep per target
+    :type workers: int
+    :param workers: Number of volumes to process concurrently per target,
+        unless the target sets its own number of workers
+    :type max_deletions: int
+    :param max_deletions: Maximum number of snapshots to delete per target.
+        0 == no limit
+    :type completion_timeout: int
+    :param completion_timeout: Seconds to wait for the created snapshots
+        to complete per target. 0 == do not wait
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :type shards: automated_ebs_snapshots.sharding.Shards
+    :param shards: Only process volumes and instances in these shards.
+        None == all
+    :returns: dict -- {target name: summary as returned by run()}. The
+        summary is None for targets that failed
+    """
+    # Pass target names rather than targets to the pool, so that
+    # credentials never end up in error messages
+    targets_by_name = dict((target['name'], target) for target in targets)
+
+    def process(name):
+        """ Connect to and run for one target """
+        target = targets_by_name[name]
+        connection = connection_manager.connect_to_target(target)
+        tracker = new_completion_tracker() if completion_timeout else None
+
+        summary = run(
+            connection,
+            force=force,
+            bulk=bulk,
+            workers=target['workers'] or workers,
+            max_deletions=max_deletions,
+            tracker=tracker,
+            slots=slots,
+            shards=shards)
+
+        if tracker is not None:
+            tracker.wait(connection, completion_timeout)
+
+        return summary
+
+    summaries = {}
+    for name, summary, error in worker_pool.run_concurrently(
+            process, targets_by_name.keys(), len(targets)):
+        summaries[name] = summary
 
-    for volume in volumes:
-        _ensure_snapshot(connection, volume, force)
-        _remove_old_snapshots(connection, volume)
+    _log_target_report(targets, summaries)
+
+    return summaries
+
+
+def _log_target_report(targets, summaries):
+    """ Log a combined report of a run over several targets
+
+    :type targets: list
+    :param targets: Targets that were run
+    :type summaries: dict
+    :param summaries: {target name: summary as returned by run()}
+    :returns: None
+    """
+    columns = ['created', 'deleted', 'deferred', 'skipped', 'failed']
+    totals = dict((column, 0) for column in columns)
+    separator = '+{}+{}'.format('-' * 32, '+'.join(['-' * 10] * 5) + '+')
+
+    logger.info(separator)
+    logger.info('| {:<30} | {} |'.format(
+        'Target', ' | '.join(
+            '{:<8}'.format(column.capitalize()) for column in columns)))
+    logger.info(separator)
+
+    for target in targets:
+        summary = summaries.get(target['name'])
+        if summary is None:
+            logger.info('| {:<30} | {:<52} |'.format(
+                target['name'], 'Failed, see the log for details'))
+            continue
+
+        for column in columns:
+            totals[column] += summary[column]
+        logger.info('| {:<30} | {} |'.format(
+            target['name'], ' | '.join(
+                '{:<8}'.format(summary[column]) for column in columns)))
+
+    logger.info(separator)
+    logger.info('| {:<30} | {} |'.format(
+        'Total', ' | '.join(
+            '{:<8}'.format(totals[column]) for column in columns)))
+    logger.info(separator)
+
+
+def _update_state(state, processed, deleted_counts, volumes, volume_ids):
+    """ Record the state of processed volumes in the state cache
+
+    :type state: automated_ebs_snapshots.state_cache.StateCache
+    :param state: State cache
+    :type processed: list
+    :param processed: [(boto.ec2.volume.Volume, (last_snapshot,
+        snapshot_count, last_completed))] where last_snapshot is the start
+        time of the newest snapshot that was not expired and last_completed
+        the start time of the newest completed snapshot. The tuple is None
+        for volumes that failed, so that they are retried in the next run
+    :type deleted_counts: dict
+    :param deleted_counts: {volume_id: snapshots deleted in this run}
+    :type volumes: list
+    :param volumes: All volumes found in this run
+    :type volume_ids: list
+    :param volume_ids: Volumes requested for this run. None == all
+    :returns: None
+    """
+    records = []
+    for volume, volume_state in processed:
+        last_snapshot, snapshot_count, last_completed = (
+            volume_state or (None, 0, None))
+        records.append({
+            'volume_id': volume.id,
+            'interval': volume.tags.get('AutomatedEBSSnapshots'),
+            'retention': volume_manager.get_retention(volume),
+            'last_snapshot': last_snapshot,
+            'last_completed': last_completed,
+            'snapshot_count':
+            snapshot_count - deleted_counts.get(volume.id, 0)
+        })
+
+    if volume_ids is None:
+        state.update_volumes(records, replace=True)
+    else:
+        # Volumes that were requested but are no longer watched
+        removed = set(volume_ids) - set(volume.id for volume in volumes)
+        state.update_volumes(records, removed=removed)
+
+
+def _get_incremental_index(connection, state, now):
+    """ Get all snapshots from the state cache and the snapshots since the
+    watermark
+
+    DescribeSnapshots can not filter on a time range, so the snapshots are
+    fetched with start-time wildcards for every day since the watermark.
+    All snapshots are fetched if the cache is not filled, if the watermark
+    is more than MAX_DELTA_DAYS old, or once every FULL_SWEEP_INTERVAL.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type state: automated_ebs_snapshots.state_cache.StateCache
+    :param state: State cache
+    :type now: float
+    :param now: Current UNIX timestamp
+    :returns: tuple -- (index, delta, full_sweep, watermark) where index is
+        {volume_id: [snapshot_record.SnapshotRecord]}, delta the snapshots
+        that are new or changed since the last run, full_sweep True if all
+        snapshots were fetched and watermark the new watermark
+    """
+    watermark = state.get_watermark()
+    last_full_sweep = state.get_last_full_sweep()
+    if (watermark is None or last_full_sweep is None or
+            now - last_full_sweep >= FULL_SWEEP_INTERVAL or
+            now - watermark > MAX_DELTA_DAYS * 86400):
+        index = get_snapshot_index(connection)
+        delta = [
+            snapshot for snapshots in index.values()
+            for snapshot in snapshots]
+        full_sweep = True
+
+    else:
+        index = state.get_snapshots()
+        cached = dict(
+            (snapshot.id, snapshot) for snapshots in index.values()
+            for snapshot in snapshots)
+
+        first_day = int(watermark - WATERMARK_OVERLAP) // 86400
+        start_times = [
+            time.strftime('%Y-%m-%dT*', time.gmtime(day * 86400))
+            for day in range(first_day, int(now) // 86400 + 1)]
+
+        delta = []
+        for snapshot in pagination.iter_snapshots(
+                connection, filters={'start-time': start_times}):
+            record = snapshot_record.from_snapshot(snapshot)
+            known = cached.get(record.id)
+            if known is None:
+                index.setdefault(record.volume_id, []).append(record)
+            elif known.status != record.status:
+                known.status = record.status
+            else:
+                continue
+            delta.append(record)
+        full_sweep = False
+
+        logger.info(
+            'Found {} new or changed snapshots since {}'.format(
+                len(delta), snapshot_record.format_timestamp(watermark)))
+
+    # The watermark is the newest start time, or the oldest start time of
+    # a pending snapshot, whose status will still change
+    watermark = None
+    oldest_pending = None
+    for snapshots in index.values():
+        for snapshot in snapshots:
+            if watermark is None or snapshot.start_time > watermark:
+                watermark = snapshot.start_time
+            if snapshot.status == 'pending' and (
+                    oldest_pending is None or
+                    snapshot.start_time < oldest_pending):
+                oldest_pending = snapshot.start_time
+    if oldest_pending is not None:
+        watermark = oldest_pending
+    elif watermark is None:
+        watermark = int(now)
+
+    return index, delta, full_sweep, watermark
+
+
+def get_snapshot_index(connection, volume_ids=None, counts=None,
+                       instance_ids=None):
+    """ Fetch all snapshots owned by the account, grouped by volume
+
+    The snapshots are read in pages of pagination.SNAPSHOT_PAGE_SIZE, so a
+    full sweep needs one DescribeSnapshots call per page rather than one per
+    volume.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type volume_ids: list
+    :param volume_ids: Only index snapshots of these volumes. None == all
+    :type counts: dict
+    :param counts: If given, the number of snapshots read in the sweep is
+        stored under 'snapshots', including those not indexed
+    :type instance_ids: list
+    :param instance_ids: Index the snapshot sets of these instances under
+        the instance ID rather than the volume ID
+    :returns: dict -- {volume_id: [snapshot_record.SnapshotRecord]}
+    """
+    if volume_ids is not None:
+        volume_ids = set(volume_ids)
+    instance_ids = set(instance_ids or [])
+
+    index = {}
+    swept = 0
+    for snapshot in pagination.iter_snapshots(connection):
+        swept += 1
+        group = snapshot.tags.get(snapshot_record.GROUP_TAG)
+        if group and group.split(':')[0] in instance_ids:
+            index.setdefault(group.split(':')[0], []).append(
+                snapshot_record.from_snapshot(snapshot))
+        elif volume_ids is None or snapshot.volume_id in volume_ids:
+            index.setdefault(snapshot.volume_id, []).append(
+                snapshot_record.from_snapshot(snapshot))
+
+    if counts is not None:
+        counts['snapshots'] = swept
+
+    logger.info('Indexed {} snapshots of {} volumes'.format(
+        sum(len(snapshots) for snapshots in index.values()), len(index)))
+
+    return index
+
+
+def _get_page_count(item_count, page_size):
+    """ Get the number of calls a paged listing takes
+
+    :type item_count: int
+    :param item_count: Number of items listed
+    :type page_size: int
+    :param page_size: Number of items per page
+    :returns: int -- Number of pages, at least 1
+    """
+    return max(1, (item_count + page_size - 1) // page_size)
 
 
 def _create_snapshot(volume):
@@ -29,107 +751,157 @@ def _create_snapshot(volume):
 
     :type volume: boto.ec2.volume.Volume
     :param volume: Volume to snapshot
-    :returns: boto.ec2.snapshot.Snapshot -- The new snapshot
+    :returns: snapshot_record.SnapshotRecord -- The new snapshot
     """
     logger.info('Creating new snapshot for {}'.format(volume.id))
-    snapshot = volume.create_snapshot(
-        description="Automatic snapshot by Automated EBS Snapshots")
+    with profiling.phase('create snapshot'):
+        snapshot = volume.create_snapshot(
+            description="Automatic snapshot by Automated EBS Snapshots")
     logger.info('Created snapshot {} for volume {}'.format(
         snapshot.id, volume.id))
 
-    return snapshot
+    return snapshot_record.from_snapshot(snapshot)
+
 
+def _create_snapshot_set(instance):
+    """ Create a new snapshot set of an instance
+
+    :type instance: boto.ec2.instance.Instance
+    :param instance: Instance to snapshot, with the connection it was
+        fetched with
+    :returns: [snapshot_record.SnapshotRecord] -- The new snapshots
+    """
+    return instance_manager.create_group_snapshot(
+        instance.connection, instance, time.time())
 
-def _ensure_snapshot(connection, volume, force):
+
+def _ensure_snapshot(connection, volume, snapshots, force, now,
+                     slots=None):
     """ Ensure that a given volume has an appropriate snapshot
 
+    New snapshots are appended to the snapshots list.
+
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
     :type volume: boto.ec2.volume.Volume
     :param volume: Volume to check
-    :returns: None
+    :type snapshots: list
+    :param snapshots: Current snapshots of the volume
+    :type force: bool
+    :param force: Always create a new snapshot
+    :type now: float
+    :param now: UNIX timestamp the snapshot ages are computed at
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :returns: snapshot_record.SnapshotRecord -- The new snapshot or None
     """
     if 'AutomatedEBSSnapshots' not in volume.tags:
         logger.warning(
             'Missing tag AutomatedEBSSnapshots for volume {}'.format(
                 volume.id))
-        return
+        return None
 
     interval = volume.tags['AutomatedEBSSnapshots']
     if volume.tags['AutomatedEBSSnapshots'] not in VALID_INTERVALS:
         logger.warning(
             '"{}" is not a valid snapshotting interval for volume {}'.format(
                 interval, volume.id))
-        return
+        return None
 
-    snapshots = connection.get_all_snapshots(filters={'volume-id': volume.id})
+    age = planner.get_newest_age(snapshots, now)
+    if snapshots and not force:
+        logger.info('The newest snapshot for {} is {} seconds old'.format(
+            volume.id, age))
 
-    # Create a snapshot if there are not already any or if forced
-    if not snapshots or force:
-        _create_snapshot(volume)
-        return
+    # Create a snapshot if there are none, if the newest is too old or if
+    # forced
+    max_age = None
+    if slots is not None:
+        max_age = slots.get_max_age(volume.id, interval, now)
+    if planner.needs_snapshot(interval, age, force, max_age):
+        snapshot = _create_snapshot(volume)
+        snapshots.append(snapshot)
+        return snapshot
 
-    min_delta = 3600*24*365*10  # 10 years :)
-    for snapshot in snapshots:
-        timestamp = datetime.datetime.strptime(
-            snapshot.start_time,
-            '%Y-%m-%dT%H:%M:%S.%fZ')
-        delta_seconds = int(
-            (datetime.datetime.utcnow() - timestamp).total_seconds())
-
-        if delta_seconds < min_delta:
-            min_delta = delta_seconds
-
-    logger.info('The newest snapshot for {} is {} seconds old'.format(
-        volume.id, min_delta))
-    if interval == 'hourly' and min_delta > 3600:
-        _create_snapshot(volume)
-    elif interval == 'daily' and min_delta > 3600*24:
-        _create_snapshot(volume)
-    elif interval == 'weekly' and min_delta > 3600*24*7:
-        _create_snapshot(volume)
-    elif interval == 'monthly' and min_delta > 3600*24*30:
-        _create_snapshot(volume)
-    elif interval == 'yearly' and min_delta > 3600*24*365:
-        _create_snapshot(volume)
-    else:
-        logger.info('No need for a new snapshot of {}'.format(volume.id))
+    logger.info('No need for a new snapshot of {}'.format(volume.id))
+    return None
 
 
-def _remove_old_snapshots(connection, volume):
-    """ Remove old snapshots
+def _get_expired_snapshots(volume, snapshots):
+    """ Get the snapshots exceeding the retention of a volume
 
-    :type connection: boto.ec2.connection.EC2Connection
-    :param connection: EC2 connection object
     :type volume: boto.ec2.volume.Volume
     :param volume: Volume to check
-    :returns: None
+    :type snapshots: list
+    :param snapshots: Current snapshots of the volume
+    :returns: [snapshot_record.SnapshotRecord] -- Snapshots to delete
     """
     if 'AutomatedEBSSnapshotsRetention' not in volume.tags:
         logger.warning(
             'Missing tag AutomatedEBSSnapshotsRetention for volume {}'.format(
                 volume.id))
-        return
-    retention = int(volume.tags['AutomatedEBSSnapshotsRetention'])
+        return []
+    try:
+        policy = retention.parse_policy(
+            volume.tags['AutomatedEBSSnapshotsRetention'])
+    except ValueError:
+        logger.warning('Invalid retention {} for volume {}'.format(
+            volume.tags['AutomatedEBSSnapshotsRetention'], volume.id))
+        return []
 
-    snapshots = connection.get_all_snapshots(filters={'volume-id': volume.id})
+    snapshots = planner.select_expired(snapshots, policy)
 
-    # Sort the list based on the start time
-    snapshots.sort(key=lambda x: x.start_time)
+    if not snapshots:
+        logger.info('No old snapshots to remove for {}'.format(volume.id))
+    else:
+        logger.info('Found {} old snapshots to remove for {}'.format(
+            len(snapshots), volume.id))
 
-    # Remove snapshots we want to keep
-    snapshots = snapshots[:-int(retention)]
+    return snapshots
 
+
+def _delete_snapshots(connection, snapshots, workers=1):
+    """ Delete snapshots using a bounded pool of deleters
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type snapshots: list
+    :param snapshots: Snapshots to delete
+    :type workers: int
+    :param workers: Number of snapshots to delete concurrently
+    :returns: list -- [(snapshot_record.SnapshotRecord, error)] where error is
+        None if the snapshot was deleted
+    """
     if not snapshots:
-        logger.info('No old snapshots to remove')
-        return
+        return []
+
+    total = len(snapshots)
+    progress_step = max(1, total // 10)
+    progress = {'done': 0}
+    lock = threading.Lock()
+
+    logger.info('Deleting {} old snapshots'.format(total))
 
-    for snapshot in snapshots:
-        logger.info('Deleting snapshot {}'.format(snapshot.id))
+    def delete(snapshot):
+        """ Delete one snapshot and report progress """
         try:
-            snapshot.delete()
+            connection.delete_snapshot(snapshot.id)
+            logger.info('Deleted snapshot {} of {}'.format(
+                snapshot.id, snapshot.volume_id))
+            return None
         except EC2ResponseError as error:
-            logger.warning('Could not remove snapshot: {}'.format(
-                error.message))
+            logger.warning('Could not remove snapshot {} of {}: {}'.format(
+                snapshot.id, snapshot.volume_id, error.message))
+            return error
+        finally:
+            with lock:
+                progress['done'] += 1
+                done = progress['done']
+                if done % progress_step == 0 or done == total:
+                    logger.info('Processed {} of {} deletions ({}%)'.format(
+                        done, total, 100 * done // total))
 
-    logger.info('Done deleting snapshots')
+    return [
+        (snapshot, error or result)
+        for snapshot, result, error
+        in worker_pool.run_concurrently(delete, snapshots, workers)]
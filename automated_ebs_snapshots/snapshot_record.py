@@ -0,0 +1,152 @@
+""" Compact in-memory representation of snapshots
+
+A boto Snapshot carries its connection, a tags dict and a dozen attributes
+we never read. SnapshotRecord keeps only what the retention and reporting
+code needs, and no per-instance __dict__.
+"""
+import time
+
+# Tag marking the snapshots taken together of all volumes of an instance.
+# The value is <instance ID>:<UNIX timestamp of the snapshot set>
+GROUP_TAG = 'AutomatedEBSSnapshotsGroup'
+
+# Snapshot tags kept on records
+KEPT_TAGS = ('Name', GROUP_TAG)
+
+
+class SnapshotRecord(object):
+    """ Snapshot ID, volume ID, start time, status and a few tags """
+    __slots__ = ('id', 'volume_id', 'start_time', 'status', 'tags')
+
+    def __init__(self, snapshot_id, volume_id, start_time, status='completed',
+                 tags=None):
+        """ Constructor
+
+        :type snapshot_id: str
+        :param snapshot_id: Snapshot ID
+        :type volume_id: str
+        :param volume_id: ID of the snapshotted volume
+        :type start_time: int
+        :param start_time: Start time as a UNIX timestamp
+        :type status: str
+        :param status: Snapshot status, e.g. pending or completed
+        :type tags: dict
+        :param tags: Tags listed in KEPT_TAGS. None == no tags
+        """
+        self.id = snapshot_id
+        self.volume_id = volume_id
+        self.start_time = start_time
+        self.status = status
+        self.tags = tags or None
+
+    def __repr__(self):
+        return 'SnapshotRecord:{}'.format(self.id)
+
+    def get_tag(self, key, default=None):
+        """ Get the value of a kept tag
+
+        :type key: str
+        :param key: Tag key
+        :type default: str
+        :param default: Value if the tag is not set
+        :returns: str
+        """
+        if self.tags is None:
+            return default
+        return self.tags.get(key, default)
+
+
+def from_snapshot(snapshot):
+    """ Convert a boto snapshot to a record
+
+    :type snapshot: boto.ec2.snapshot.Snapshot
+    :param snapshot: Snapshot
+    :returns: SnapshotRecord
+    """
+    tags = dict(
+        (key, snapshot.tags[key]) for key in KEPT_TAGS
+        if key in snapshot.tags)
+
+    return SnapshotRecord(
+        snapshot.id,
+        snapshot.volume_id,
+        parse_timestamp(snapshot.start_time),
+        # CreateSnapshots reports the status as state
+        snapshot.status or getattr(snapshot, 'state', None),
+        tags)
+
+
+def parse_timestamp(value):
+    """ Parse an EC2 ISO 8601 timestamp
+
+    Fractional seconds are optional and ignored, and the timestamp may end
+    with Z or a +HH:MM / -HH:MM offset. This is several times faster than
+    datetime.strptime, which matters when parsing millions of snapshots.
+
+    :type value: str
+    :param value: Timestamp, e.g. 2014-01-01T12:00:00.000Z
+    :returns: int -- Seconds since the epoch (UTC)
+    :raises: ValueError -- If the timestamp can not be parsed
+    """
+    try:
+        if (value[4] != '-' or value[7] != '-' or value[10] not in 'Tt ' or
+                value[13] != ':' or value[16] != ':'):
+            raise ValueError
+        timestamp = (
+            _days_from_civil(
+                int(value[0:4]), int(value[5:7]), int(value[8:10])) * 86400 +
+            int(value[11:13]) * 3600 +
+            int(value[14:16]) * 60 +
+            int(value[17:19]))
+
+        suffix = value[19:]
+        if suffix[:1] == '.':
+            suffix = suffix[1:].lstrip('0123456789')
+        if suffix in ('', 'Z', 'z'):
+            return timestamp
+        if suffix[0] in '+-' and len(suffix) == 6 and suffix[3] == ':':
+            offset = int(suffix[1:3]) * 3600 + int(suffix[4:6]) * 60
+            if suffix[0] == '+':
+                return timestamp - offset
+            return timestamp + offset
+    except (IndexError, TypeError, ValueError):
+        pass
+
+    raise ValueError('Invalid timestamp {}'.format(value))
+
+
+def _days_from_civil(year, month, day):
+    """ Get the number of days since 1970-01-01 for a proleptic Gregorian date
+
+    :type year: int
+    :param year: Year
+    :type month: int
+    :param month: Month [1-12]
+    :type day: int
+    :param day: Day of the month [1-31]
+    :returns: int -- Days since the epoch
+    """
+    if not 1 <= month <= 12 or not 1 <= day <= 31:
+        raise ValueError
+
+    # Count years from March, so that the leap day ends the year
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = (
+        year_of_era * 365 + year_of_era // 4 - year_of_era // 100 +
+        day_of_year)
+
+    return era * 146097 + day_of_era - 719468
+
+
+def format_timestamp(timestamp):
+    """ Format a UNIX timestamp like EC2 does
+
+    :type timestamp: int
+    :param timestamp: Seconds since the epoch (UTC)
+    :returns: str -- Timestamp, e.g. 2014-01-01T12:00:00.000Z
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
@@ -0,0 +1,376 @@
+""" Local cache of the snapshot state of watched volumes """
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+from automated_ebs_snapshots import snapshot_record
+from automated_ebs_snapshots.valid_intervals import INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS volumes (
+        volume_id TEXT PRIMARY KEY,
+        interval TEXT,
+        retention INTEGER,
+        last_snapshot INTEGER,
+        snapshot_count INTEGER,
+        last_completed INTEGER,
+        updated INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS snapshots (
+        snapshot_id TEXT PRIMARY KEY,
+        volume_id TEXT,
+        start_time INTEGER,
+        status TEXT,
+        tags TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS volume_tags (
+        volume_id TEXT PRIMARY KEY,
+        tags_hash TEXT)''',
+]
+
+
+def get_due_time(volume, slots=None):
+    """ Get the time a cached volume needs to be checked again
+
+    :type volume: dict
+    :param volume: Cached volume as returned by StateCache.get_volumes
+    :type slots: automated_ebs_snapshots.slots.Slots
+    :param slots: Snapshot slots. None == snapshot once per interval
+    :returns: int -- UNIX timestamp or None if the volume is never due
+    """
+    retention = volume['retention']
+    if retention and volume['snapshot_count'] > retention:
+        return 0
+
+    interval = INTERVAL_SECONDS.get(volume['interval'])
+    if not interval:
+        return None
+
+    if volume['last_snapshot'] is None:
+        return 0
+
+    if slots is not None:
+        return slots.get_due_time(
+            volume['volume_id'], volume['interval'], volume['last_snapshot'])
+
+    # The newest snapshot must be strictly older than the interval
+    return volume['last_snapshot'] + interval + 1
+
+
+class StateCache(object):
+    """ SQLite backed cache of the last known state of each watched volume
+
+    For each volume the cache stores the interval, the retention, the start
+    time of the newest snapshot and the number of snapshots. That is enough
+    to tell which volumes need a new snapshot or have too many snapshots
+    without asking EC2. The start time of the newest completed snapshot is
+    stored for the snapshot lag metric.
+
+    Incremental runs also cache all snapshots of the account, the hash of
+    the tags of each volume whose retention was applied, and a watermark
+    below which all snapshots are known, see snapshot_manager.run.
+    """
+    def __init__(self, state_dir=None):
+        """ Constructor
+
+        :type state_dir: str
+        :param state_dir: Directory to keep the cache database in.
+            None == keep the cache in memory only
+        """
+        if state_dir is None:
+            self.path = ':memory:'
+        else:
+            if not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+            self.path = os.path.join(state_dir, 'state.db')
+
+        self.db = sqlite3.connect(self.path)
+        outdated = self._drop_outdated_volumes()
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        if outdated:
+            # Rebuild the cached volumes in the next reconciliation
+            self._set_meta('last_reconcile', None)
+
+    def close(self):
+        """ Close the database """
+        self.db.close()
+
+    def get_volumes(self):
+        """ Get all cached volumes
+
+        :returns: list -- [dict] with one dict per volume
+        """
+        cursor = self.db.execute(
+            'SELECT volume_id, interval, retention, last_snapshot, '
+            'snapshot_count, last_completed FROM volumes')
+        return [
+            {
+                'volume_id': row[0],
+                'interval': row[1],
+                'retention': row[2],
+                'last_snapshot': row[3],
+                'snapshot_count': row[4],
+                'last_completed': row[5]
+            }
+            for row in cursor]
+
+    def get_due_volume_ids(self, now=None, slots=None):
+        """ Get volumes that need a snapshot or have too many snapshots
+
+        :type now: int
+        :param now: Current UNIX timestamp. Default: time.time()
+        :type slots: automated_ebs_snapshots.slots.Slots
+        :param slots: Snapshot slots. None == snapshot once per interval
+        :returns: list -- Volume IDs
+        """
+        if now is None:
+            now = time.time()
+
+        due = []
+        for volume in self.get_volumes():
+            due_time = get_due_time(volume, slots)
+            if due_time is not None and due_time < now:
+                due.append(volume['volume_id'])
+
+        return due
+
+    def update_volumes(self, volumes, removed=None, replace=False):
+        """ Store the state of volumes
+
+        :type volumes: list
+        :param volumes: [dict] with volume_id, interval, retention,
+            last_snapshot, snapshot_count and last_completed
+        :type removed: list
+        :param removed: Volume IDs that are no longer watched
+        :type replace: bool
+        :param replace: Replace all cached volumes with volumes
+        :returns: None
+        """
+        now = int(time.time())
+        with self.db:
+            if replace:
+                self.db.execute('DELETE FROM volumes')
+            for volume_id in removed or []:
+                self.db.execute(
+                    'DELETE FROM volumes WHERE volume_id = ?', (volume_id,))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO volumes (volume_id, interval, '
+                'retention, last_snapshot, snapshot_count, last_completed, '
+                'updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        volume['volume_id'],
+                        volume['interval'],
+                        volume['retention'],
+                        volume['last_snapshot'],
+                        volume['snapshot_count'],
+                        volume['last_completed'],
+                        now
+                    )
+                    for volume in volumes])
+
+    def get_snapshots(self):
+        """ Get all cached snapshots
+
+        :returns: dict -- {volume_id: [snapshot_record.SnapshotRecord]}
+        """
+        cursor = self.db.execute(
+            'SELECT snapshot_id, volume_id, start_time, status, tags '
+            'FROM snapshots')
+
+        index = {}
+        for row in cursor:
+            index.setdefault(row[1], []).append(
+                snapshot_record.SnapshotRecord(
+                    row[0], row[1], row[2], row[3],
+                    json.loads(row[4]) if row[4] else None))
+        return index
+
+    def update_snapshots(self, snapshots, removed=None, replace=False):
+        """ Store snapshots
+
+        :type snapshots: list
+        :param snapshots: [snapshot_record.SnapshotRecord] to add or update
+        :type removed: list
+        :param removed: IDs of deleted snapshots, removed after adding
+            snapshots
+        :type replace: bool
+        :param replace: Replace all cached snapshots with snapshots
+        :returns: None
+        """
+        with self.db:
+            if replace:
+                self.db.execute('DELETE FROM snapshots')
+            self.db.executemany(
+                'INSERT OR REPLACE INTO snapshots (snapshot_id, volume_id, '
+                'start_time, status, tags) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (
+                        snapshot.id,
+                        snapshot.volume_id,
+                        snapshot.start_time,
+                        snapshot.status,
+                        json.dumps(snapshot.tags) if snapshot.tags else None
+                    )
+                    for snapshot in snapshots])
+            self.db.executemany(
+                'DELETE FROM snapshots WHERE snapshot_id = ?',
+                [(snapshot_id,) for snapshot_id in removed or []])
+
+    def get_tags_hashes(self):
+        """ Get the tag hashes of volumes whose retention was applied
+
+        :returns: dict -- {volume_id: tags_hash}
+        """
+        return dict(self.db.execute(
+            'SELECT volume_id, tags_hash FROM volume_tags'))
+
+    def set_tags_hashes(self, hashes, replace=False):
+        """ Store the tag hashes of volumes
+
+        :type hashes: dict
+        :param hashes: {volume_id: tags_hash}. None removes the hash, so the
+            retention of the volume is applied again in the next run
+        :type replace: bool
+        :param replace: Replace all stored hashes
+        :returns: None
+        """
+        with self.db:
+            if replace:
+                self.db.execute('DELETE FROM volume_tags')
+            self.db.executemany(
+                'DELETE FROM volume_tags WHERE volume_id = ?',
+                [
+                    (volume_id,) for volume_id, tags_hash in hashes.items()
+                    if tags_hash is None])
+            self.db.executemany(
+                'INSERT OR REPLACE INTO volume_tags (volume_id, tags_hash) '
+                'VALUES (?, ?)',
+                [
+                    (volume_id, tags_hash)
+                    for volume_id, tags_hash in hashes.items()
+                    if tags_hash is not None])
+
+    def get_watermark(self):
+        """ Get the snapshot watermark
+
+        All snapshots started before the watermark are in the cache, and
+        none of them are pending.
+
+        :returns: int -- UNIX timestamp or None if the cache is not filled
+        """
+        return self._get_meta('snapshot_watermark')
+
+    def set_watermark(self, timestamp):
+        """ Store the snapshot watermark
+
+        :type timestamp: int
+        :param timestamp: UNIX timestamp. None == the cached snapshots can
+            not be trusted, e.g. because one was deleted outside of
+            Automated EBS Snapshots
+        :returns: None
+        """
+        self._set_meta('snapshot_watermark', timestamp)
+
+    def get_last_full_sweep(self):
+        """ Get the time all snapshots were last fetched from EC2
+
+        :returns: int -- UNIX timestamp or None
+        """
+        return self._get_meta('last_full_sweep')
+
+    def set_last_full_sweep(self, timestamp=None):
+        """ Store the time all snapshots were last fetched from EC2
+
+        :type timestamp: int
+        :param timestamp: UNIX timestamp. Default: time.time()
+        :returns: None
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self._set_meta('last_full_sweep', timestamp)
+
+    def get_last_reconcile(self):
+        """ Get the time of the last full reconciliation with EC2
+
+        :returns: int -- UNIX timestamp or None
+        """
+        return self._get_meta('last_reconcile')
+
+    def set_last_reconcile(self, timestamp=None):
+        """ Store the time of the last full reconciliation with EC2
+
+        :type timestamp: int
+        :param timestamp: UNIX timestamp. Default: time.time()
+        :returns: None
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self._set_meta('last_reconcile', timestamp)
+
+    def needs_reconcile(self, reconcile_interval, now=None):
+        """ Check if it is time for a full reconciliation with EC2
+
+        :type reconcile_interval: int
+        :param reconcile_interval: Seconds between full reconciliations
+        :type now: int
+        :param now: Current UNIX timestamp. Default: time.time()
+        :returns: bool
+        """
+        if now is None:
+            now = time.time()
+
+        last_reconcile = self.get_last_reconcile()
+        return (
+            last_reconcile is None or
+            now - last_reconcile >= reconcile_interval)
+
+    def _get_meta(self, key):
+        """ Get a timestamp from the meta table
+
+        :type key: str
+        :param key: Key
+        :returns: int -- UNIX timestamp or None
+        """
+        row = self.db.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return int(row[0]) if row else None
+
+    def _set_meta(self, key, timestamp):
+        """ Store a timestamp in the meta table
+
+        :type key: str
+        :param key: Key
+        :type timestamp: int
+        :param timestamp: UNIX timestamp. None removes the key
+        :returns: None
+        """
+        with self.db:
+            if timestamp is None:
+                self.db.execute('DELETE FROM meta WHERE key = ?', (key,))
+            else:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                    (key, str(int(timestamp))))
+
+    def _drop_outdated_volumes(self):
+        """ Drop a volumes table written by an older version
+
+        :returns: bool -- True if the table was dropped
+        """
+        columns = [
+            row[1] for row in self.db.execute('PRAGMA table_info(volumes)')]
+        if not columns or 'last_completed' in columns:
+            return False
+
+        logger.info('Dropping the cached volumes of an older version')
+        self.db.execute('DROP TABLE volumes')
+        return True
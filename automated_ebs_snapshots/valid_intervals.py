@@ -5,3 +5,11 @@ VALID_INTERVALS = [
     u'weekly',
     u'monthly',
     u'yearly']
+
+# Maximum age in seconds of the newest snapshot for each interval
+INTERVAL_SECONDS = {
+    u'hourly': 3600,
+    u'daily': 3600*24,
+    u'weekly': 3600*24*7,
+    u'monthly': 3600*24*30,
+    u'yearly': 3600*24*365}
@@ -1,60 +1,131 @@
 # -*- coding: utf-8 -*-
 """ Handle EBS volumes """
+import hashlib
 import logging
 import re
 
 from boto.exception import EC2ResponseError
 
+from automated_ebs_snapshots import pagination
+from automated_ebs_snapshots import profiling
+from automated_ebs_snapshots import retention as retention_policy
+from automated_ebs_snapshots import snapshot_record
 from automated_ebs_snapshots.valid_intervals import VALID_INTERVALS
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of values in a single EC2 API filter
+FILTER_VALUE_LIMIT = 200
 
-def get_watched_volumes(connection):
+# Maximum number of resources per CreateTags or DeleteTags call
+TAG_BATCH_SIZE = 500
+
+# Regular expression to check whether input is a volume id
+VOLUME_ID_PATTERN = re.compile('vol-\w{8}')
+
+
+def get_watched_volumes(connection, volume_ids=None):
     """ Get a list of volumes that we are watching
 
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
+    :type volume_ids: list
+    :param volume_ids: Only return watched volumes among these. None == all
     :returns: [boto.ec2.volume.Volume] -- List of volumes
     """
-    return connection.get_all_volumes(
-        filters={'tag-key': 'AutomatedEBSSnapshots'})
+    with profiling.phase('describe volumes'):
+        return [
+            volume for volume
+            in iter_watched_volumes(connection, volume_ids)]
+
+
+def iter_watched_volumes(connection, volume_ids=None):
+    """ Iterate over the volumes that we are watching, one page at a time
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type volume_ids: list
+    :param volume_ids: Only return watched volumes among these. None == all
+    :returns: generator -- boto.ec2.volume.Volume
+    """
+    if volume_ids is None:
+        for volume in pagination.iter_volumes(
+                connection, filters={'tag-key': 'AutomatedEBSSnapshots'}):
+            yield volume
+        return
+
+    # Filter on volume-id rather than passing volume_ids, as the latter
+    # fails if any of the volumes has been deleted
+    volume_ids = [volume_id for volume_id in volume_ids]
+    for start in range(0, len(volume_ids), FILTER_VALUE_LIMIT):
+        for volume in pagination.iter_volumes(
+                connection,
+                filters={
+                    'tag-key': 'AutomatedEBSSnapshots',
+                    'volume-id': volume_ids[start:start + FILTER_VALUE_LIMIT]
+                }):
+            yield volume
+
+
+def get_retention(volume):
+    """ Get the maximum number of snapshots to keep for a volume
+
+    :type volume: boto.ec2.volume.Volume
+    :param volume: Volume
+    :returns: int -- Retention. 0 == keep all
+    """
+    try:
+        return retention_policy.max_kept(retention_policy.parse_policy(
+            volume.tags.get('AutomatedEBSSnapshotsRetention', 0)))
+    except ValueError:
+        return 0
+
+
+def get_tags_hash(volume):
+    """ Get a hash of the Automated EBS Snapshots tags of a volume
+
+    :type volume: boto.ec2.volume.Volume
+    :param volume: Volume
+    :returns: str -- Hash of all tags starting with AutomatedEBSSnapshots
+    """
+    return hashlib.sha1(repr(sorted(
+        (key, value) for key, value in volume.tags.items()
+        if key.startswith('AutomatedEBSSnapshots')))).hexdigest()
 
 
 def list(connection):
     """ List watched EBS volumes
 
+    Volumes are listed as they are read, one page at a time.
+
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
     :returns: None
     """
-    volumes = get_watched_volumes(connection)
-
-    if not volumes:
-        logger.info('No watched volumes found')
-        return
-
-    logger.info(
-        '+-----------------------'
-        '+----------------------'
-        '+--------------'
-        '+------------+')
-    logger.info(
-        '| {volume:<21} '
-        '| {volume_name:<20.20} '
-        '| {interval:<12} '
-        '| {retention:<10} |'.format(
-            volume='Volume ID',
-            volume_name='Volume name',
-            interval='Interval',
-            retention='Retention'))
-    logger.info(
-        '+-----------------------'
-        '+----------------------'
-        '+--------------'
-        '+------------+')
+    found = False
+    for volume in iter_watched_volumes(connection):
+        if not found:
+            found = True
+            logger.info(
+                '+-----------------------'
+                '+----------------------'
+                '+--------------'
+                '+------------------+')
+            logger.info(
+                '| {volume:<21} '
+                '| {volume_name:<20.20} '
+                '| {interval:<12} '
+                '| {retention:<16} |'.format(
+                    volume='Volume ID',
+                    volume_name='Volume name',
+                    interval='Interval',
+                    retention='Retention'))
+            logger.info(
+                '+-----------------------'
+                '+----------------------'
+                '+--------------'
+                '+------------------+')
 
-    for volume in volumes:
         if 'AutomatedEBSSnapshots' not in volume.tags:
             interval = 'Interval tag not found'
         elif volume.tags['AutomatedEBSSnapshots'] not in VALID_INTERVALS:
@@ -77,17 +148,21 @@ def list(connection):
             '| {volume_id:<14} '
             '| {volume_name:<20.20} '
             '| {interval:<12} '
-            '| {retention:<10} |'.format(
+            '| {retention:<16} |'.format(
                 volume_id=volume.id,
                 volume_name=volume_name,
                 interval=interval,
                 retention=retention))
 
+    if not found:
+        logger.info('No watched volumes found')
+        return
+
     logger.info(
         '+-----------------------'
         '+----------------------'
         '+--------------'
-        '+------------+')
+        '+------------------+')
 
 
 def unwatch(connection, volume_id):
@@ -100,8 +175,9 @@ def unwatch(connection, volume_id):
     :returns: bool - True if the watch was successful
     """
     try:
-        volume = connection.get_all_volumes(volume_ids=[volume_id])[0]
-        volume.remove_tag('AutomatedEBSSnapshots')
+        with profiling.phase('unwatch volume'):
+            volume = connection.get_all_volumes(volume_ids=[volume_id])[0]
+            volume.remove_tag('AutomatedEBSSnapshots')
     except EC2ResponseError:
         pass
 
@@ -119,10 +195,18 @@ def watch(connection, volume_id, interval='daily', retention=0):
     :param volume_id: VolumeID to add to the watchlist
     :type interval: str
     :param interval: Backup interval [hourly|daily|weekly|monthly|yearly]
-    :type retention: int
-    :param retention: Number of snapshots to keep. 0 == keep all
+    :type retention: str
+    :param retention: Number of snapshots to keep, or a tiered policy like
+        h24,d14,w8,m12 (see retention.parse_policy). 0 == keep all
     :returns: bool - True if the watch was successful
     """
+    try:
+        retention = retention_policy.format_policy(
+            retention_policy.parse_policy(retention))
+    except ValueError:
+        logger.warning('{} is not a valid retention'.format(retention))
+        return False
+
     try:
         volume = connection.get_all_volumes(volume_ids=[volume_id])[0]
     except EC2ResponseError:
@@ -134,17 +218,11 @@ def watch(connection, volume_id, interval='daily', retention=0):
             '{} is not a valid interval. Valid intervals are {}'.format(
                 interval, ', '.join(VALID_INTERVALS)))
 
-    # Remove the tag first
-    volume.remove_tag('AutomatedEBSSnapshots')
-
-    # Re-add the tag
-    volume.add_tag('AutomatedEBSSnapshots', value=interval)
-
-    # Remove the tag first
-    volume.remove_tag('AutomatedEBSSnapshotsRetention')
-
-    # Re-add the tag
-    volume.add_tag('AutomatedEBSSnapshotsRetention', value=int(retention))
+    # CreateTags replaces the values of existing tags
+    _tag_volumes(connection, [volume.id], {
+        'AutomatedEBSSnapshots': interval,
+        'AutomatedEBSSnapshotsRetention': retention
+    })
 
     logger.info('Updated the rotation interval to {} for {}'.format(
         interval, volume_id))
@@ -163,10 +241,7 @@ def get_volume_id(connection, volume):
     :param volume: Volume ID or Volume Name
     :returns: Volume ID or None if the given volume does not exist
     """
-    # Regular expression to check whether input is a volume id
-    volume_id_pattern = re.compile('vol-\w{8}')
-
-    if volume_id_pattern.match(volume):
+    if VOLUME_ID_PATTERN.match(volume):
         # input is volume id
         try:
             # Check whether it exists
@@ -189,8 +264,55 @@ def get_volume_id(connection, volume):
     return volume_id
 
 
+def resolve_volumes(connection, volumes):
+    """ Look up volumes by volume ID or Name tag, in batches
+
+    IDs and names are resolved with one DescribeVolumes call per
+    FILTER_VALUE_LIMIT IDs or names, rather than one call each.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type volumes: list
+    :param volumes: Volume IDs or Volume Names
+    :returns: dict -- {volume ID or name: boto.ec2.volume.Volume}. Volumes
+        that do not exist are left out
+    """
+    volume_ids = sorted(set(
+        volume for volume in volumes if VOLUME_ID_PATTERN.match(volume)))
+    names = sorted(set(
+        volume for volume in volumes if not VOLUME_ID_PATTERN.match(volume)))
+
+    found = {}
+    for values, filter_name in [
+            (volume_ids, 'volume-id'), (names, 'tag:Name')]:
+        for start in range(0, len(values), FILTER_VALUE_LIMIT):
+            for volume in pagination.iter_volumes(
+                    connection,
+                    filters={
+                        filter_name: values[start:start + FILTER_VALUE_LIMIT]
+                    }):
+                key = volume.id
+                if filter_name == 'tag:Name':
+                    key = volume.tags['Name']
+                    if key in found:
+                        logger.warning('Volume {} not unique'.format(key))
+                        continue
+                found[key] = volume
+
+    for volume in volume_ids + names:
+        if volume not in found:
+            logger.warning('Volume {} not found'.format(volume))
+
+    return found
+
+
 def watch_from_file(connection, file_name):
-    """ Start watching a new volume
+    """ Start watching all volumes in a file
+
+    Each line holds a volume ID or name, an interval and a retention. The
+    volumes are resolved in batches, and tagged with one CreateTags call
+    per TAG_BATCH_SIZE volumes with the same interval and retention.
+    Volumes that already have the right tags are skipped.
 
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
@@ -198,17 +320,60 @@ def watch_from_file(connection, file_name):
     :param file_name: path to config file
     :returns: None
     """
-    with open(file_name, 'r') as filehandle:
-        for line in filehandle.xreadlines():
-            volume, interval, retention = line.rstrip().split(',')
-            watch(
-                connection,
-                get_volume_id(connection, volume),
-                interval, retention)
+    lines = _read_volume_file(file_name)
+    volumes = resolve_volumes(connection, [line[0] for line in lines])
+
+    # Later lines win for volumes listed more than once
+    wanted = {}
+    for volume, interval, retention in lines:
+        if volume not in volumes:
+            continue
+
+        try:
+            retention = retention_policy.format_policy(
+                retention_policy.parse_policy(retention))
+        except ValueError:
+            logger.warning('{} is not a valid retention for {}'.format(
+                retention, volume))
+            continue
+
+        if interval not in VALID_INTERVALS:
+            logger.warning(
+                '{} is not a valid interval. Valid intervals are {}'.format(
+                    interval, ', '.join(VALID_INTERVALS)))
+
+        wanted[volumes[volume].id] = (volumes[volume], interval, retention)
+
+    batches = {}
+    unchanged = 0
+    for volume, interval, retention in wanted.values():
+        if (volume.tags.get('AutomatedEBSSnapshots') == interval and
+                volume.tags.get('AutomatedEBSSnapshotsRetention') ==
+                retention):
+            unchanged += 1
+            continue
+        batches.setdefault((interval, retention), []).append(volume.id)
+
+    if unchanged:
+        logger.info('{} volumes are already watched as requested'.format(
+            unchanged))
+
+    for (interval, retention), volume_ids in sorted(batches.items()):
+        _tag_volumes(connection, sorted(volume_ids), {
+            'AutomatedEBSSnapshots': interval,
+            'AutomatedEBSSnapshotsRetention': retention
+        })
+        logger.info(
+            'Updated the rotation interval to {} for {} volumes'.format(
+                interval, len(volume_ids)))
 
 
 def unwatch_from_file(connection, file_name):
-    """ Start watching a new volume
+    """ Stop watching all volumes in a file
+
+    The volumes are resolved in batches, and untagged with one DeleteTags
+    call per TAG_BATCH_SIZE volumes. Volumes that are not watched are
+    skipped.
 
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
@@ -216,15 +381,64 @@ def unwatch_from_file(connection, file_name):
     :param file_name: path to config file
     :returns: None
     """
+    volumes = resolve_volumes(
+        connection, [line[0] for line in _read_volume_file(file_name)])
+
+    volume_ids = sorted(set(
+        volume.id for volume in volumes.values()
+        if 'AutomatedEBSSnapshots' in volume.tags))
+    if not volume_ids:
+        return
+
+    with profiling.phase('tag volumes'):
+        for start in range(0, len(volume_ids), TAG_BATCH_SIZE):
+            connection.delete_tags(
+                volume_ids[start:start + TAG_BATCH_SIZE],
+                ['AutomatedEBSSnapshots'])
+    logger.info('Removed {} volumes from the watchlist'.format(
+        len(volume_ids)))
+
+
+def _read_volume_file(file_name):
+    """ Read a file of volumes, intervals and retentions
+
+    :type file_name: str
+    :param file_name: path to config file
+    :returns: list -- [(volume ID or name, interval, retention)]
+    """
+    lines = []
     with open(file_name, 'r') as filehandle:
         for line in filehandle.xreadlines():
-            volume, interval, retention = line.rstrip().split(',')
-            unwatch(connection, get_volume_id(connection, volume))
+            if not line.strip():
+                continue
+            # Tiered retention policies contain commas
+            volume, interval, retention = line.rstrip().split(',', 2)
+            lines.append((volume, interval, retention))
+    return lines
+
+
+def _tag_volumes(connection, volume_ids, tags):
+    """ Set tags on volumes, TAG_BATCH_SIZE volumes per CreateTags call
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object
+    :type volume_ids: list
+    :param volume_ids: Volume IDs
+    :type tags: dict
+    :param tags: {key: value}
+    :returns: None
+    """
+    with profiling.phase('tag volumes'):
+        for start in range(0, len(volume_ids), TAG_BATCH_SIZE):
+            connection.create_tags(
+                volume_ids[start:start + TAG_BATCH_SIZE], tags)
 
 
 def list_snapshots(connection, volume):
     """ List all snapshots for the volume
 
+    Snapshots are listed as they are read, one page at a time.
+
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
     :type volume: str
@@ -250,15 +464,18 @@ def list_snapshots(connection, volume):
 
     vid = get_volume_id(connection, volume)
     if vid:
-        vol = connection.get_all_volumes(volume_ids=[vid])[0]
-        for snap in vol.snapshots():
+        # Let EC2 filter on the volume instead of reading all snapshots
+        for snapshot in pagination.iter_snapshots(
+                connection, filters={'volume-id': vid}, owner=None):
+            snap = snapshot_record.from_snapshot(snapshot)
             logger.info(
                 '| {snapshot:<14} '
                 '| {snapshot_name:<20.20} '
                 '| {created:<25} |'.format(
                     snapshot=snap.id,
-                    snapshot_name=snap.tags.get('Name', ''),
-                    created=snap.start_time))
+                    snapshot_name=snap.get_tag('Name', ''),
+                    created=snapshot_record.format_timestamp(
+                        snap.start_time)))
 
     logger.info(
         '+----------------'
@@ -0,0 +1,98 @@
+""" Bounded pool of worker threads, or greenlets with the gevent engine """
+import logging
+import threading
+import Queue
+
+logger = logging.getLogger(__name__)
+
+# gevent.pool when the gevent engine is used, see use_gevent
+_gevent_pool = None
+
+
+def use_gevent():
+    """ Run workers as greenlets on one thread instead of as threads
+
+    The standard library is patched by gevent, so that sockets, sleeps and
+    locks, including those of boto and the rate limiter, yield to other
+    greenlets. One process can then have thousands of API calls in flight,
+    still bound by the shared rate limits. Call this before boto is
+    imported, as automated_ebs_snapshots.main does.
+
+    :returns: None
+    :raises: ImportError -- If gevent is not installed
+    """
+    global _gevent_pool
+    from gevent import monkey
+    from gevent import pool
+
+    monkey.patch_all()
+    _gevent_pool = pool
+
+
+def run_concurrently(function, items, workers=1):
+    """ Call function for every item using at most workers threads, or
+    greenlets if use_gevent was called
+
+    Exceptions raised by function are logged and returned rather than
+    raised, so that one failing item does not stop the others.
+
+    :type function: callable
+    :param function: Function taking one item as argument
+    :type items: iterable
+    :param items: Items to process
+    :type workers: int
+    :param workers: Maximum number of concurrent threads
+    :returns: list -- [(item, result, error)] in the order of items
+    """
+    items = [item for item in items]
+    results = [None] * len(items)
+
+    def call(position):
+        """ Process one item and store the outcome """
+        item = items[position]
+        try:
+            results[position] = (item, function(item), None)
+        except Exception as error:
+            logger.exception('Unhandled error when processing {}'.format(
+                item))
+            results[position] = (item, None, error)
+
+    if workers <= 1 or len(items) <= 1:
+        for position in range(len(items)):
+            call(position)
+        return results
+
+    if _gevent_pool is not None:
+        greenlets = _gevent_pool.Pool(workers)
+        for position in range(len(items)):
+            greenlets.spawn(call, position)
+        greenlets.join()
+        return results
+
+    queue = Queue.Queue()
+    for position in range(len(items)):
+        queue.put(position)
+
+    def worker():
+        """ Consume items until the queue is empty """
+        while True:
+            try:
+                position = queue.get_nowait()
+            except Queue.Empty:
+                return
+            call(position)
+
+    threads = []
+    for number in range(min(workers, len(items))):
+        thread = threading.Thread(
+            target=worker, name='worker-{}'.format(number + 1))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Join with a timeout so that KeyboardInterrupt is still delivered
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+
+    return results
@@ -0,0 +1,539 @@
+""" In-process fake EC2 backend for benchmarks
+
+FakeEC2Connection is a real boto EC2Connection that answers
+DescribeInstances, DescribeVolumes, DescribeSnapshots, CreateSnapshot,
+CreateSnapshots, DeleteSnapshot, CreateTags and DeleteTags from in-memory
+state, with configurable latency
+and throttling per API call. Only the generic get_list, get_object and
+get_status methods are replaced, so boto's request building and the object
+methods (volume.create_snapshot(), snapshot.delete() and so on) still run.
+Errors are sent as HTTP responses through boto's make_request, so they are
+retried and raised exactly as EC2 errors are.
+"""
+import bisect
+import datetime
+import fnmatch
+import itertools
+import random
+import threading
+import time
+
+from boto.ec2.connection import EC2Connection
+from boto.ec2.instance import Instance
+from boto.ec2.instance import Reservation
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
+from boto.resultset import ResultSet
+
+ERROR_BODY = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<Response><Errors><Error><Code>{code}</Code>'
+    '<Message>{message}</Message></Error></Errors>'
+    '<RequestID>fake</RequestID></Response>')
+
+
+class _FakeHTTPResponse(object):
+    """ Canned HTTP response with the methods boto's _mexe uses """
+    def __init__(self, status, body):
+        self.status = status
+        self.reason = 'Error'
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+    def getheaders(self):
+        return []
+
+
+class _FakeHTTPConnection(object):
+    """ HTTP connection answering every request with one response """
+    def __init__(self, response):
+        self.response = response
+
+    def request(self, method, path, body=None, headers=None):
+        pass
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        pass
+
+
+def _indexed(params, prefix):
+    """ Collect the values of params named prefix.1, prefix.2, ...
+
+    :type params: dict
+    :param params: Request parameters
+    :type prefix: str
+    :param prefix: Parameter name prefix
+    :returns: list
+    """
+    values = []
+    for i in itertools.count(1):
+        key = '{}.{}'.format(prefix, i)
+        if key not in params:
+            return values
+        values.append(params[key])
+
+
+def _filters(params):
+    """ Parse Filter.N.Name and Filter.N.Value.M parameters
+
+    :type params: dict
+    :param params: Request parameters
+    :returns: dict -- {name: [values]}
+    """
+    filters = {}
+    for i in itertools.count(1):
+        name = params.get('Filter.{}.Name'.format(i))
+        if name is None:
+            return filters
+        filters[name] = _indexed(params, 'Filter.{}.Value'.format(i))
+
+
+def _matches(data, filters):
+    """ Check if a stored instance, volume or snapshot matches all filters
+
+    Tag values and start times may contain * and ? wildcards, as in EC2.
+
+    :type data: dict
+    :param data: Stored instance, volume or snapshot
+    :type filters: dict
+    :param filters: {name: [values]}
+    :returns: bool
+    """
+    for name, values in filters.items():
+        if name == 'tag-key':
+            if not set(values) & set(data['tags']):
+                return False
+        elif name == 'tag-value':
+            if not set(values) & set(data['tags'].values()):
+                return False
+        elif name.startswith('tag:'):
+            value = data['tags'].get(name[4:])
+            if value is None:
+                return False
+            if value not in values and not any(
+                    fnmatch.fnmatchcase(value, pattern)
+                    for pattern in values if '*' in pattern or '?' in pattern):
+                return False
+        elif name == 'volume-id':
+            if data.get('volume_id', data['id']) not in values:
+                return False
+        elif name == 'attachment.instance-id':
+            if data.get('instance_id') not in values:
+                return False
+        elif name == 'instance-id':
+            if data['id'] not in values:
+                return False
+        elif name == 'snapshot-id':
+            if data['id'] not in values:
+                return False
+        elif name == 'status':
+            if data.get('status') not in values:
+                return False
+        elif name == 'start-time':
+            if not any(
+                    fnmatch.fnmatchcase(data['start_time'], pattern)
+                    for pattern in values):
+                return False
+    return True
+
+
+class FakeEC2Connection(EC2Connection):
+    """ EC2 connection answering from in-memory state
+
+    API calls are counted per action in calls, and calls failing with
+    RequestLimitExceeded in throttled.
+    """
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0,
+                 snapshot_duration=0.0, snapshot_failure_rate=0.0):
+        """ Constructor
+
+        :type latency: float
+        :param latency: Seconds to sleep per API call
+        :type throttle_rate: float
+        :param throttle_rate: Probability [0-1] of an API call failing with
+            RequestLimitExceeded
+        :type seed: int
+        :param seed: Random seed used for throttling and snapshot failures
+        :type snapshot_duration: float
+        :param snapshot_duration: Seconds a created snapshot stays pending
+        :type snapshot_failure_rate: float
+        :param snapshot_failure_rate: Probability [0-1] of a created
+            snapshot ending in the error state
+        """
+        EC2Connection.__init__(
+            self,
+            aws_access_key_id='AKIAFAKE',
+            aws_secret_access_key='fake')
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.snapshot_duration = snapshot_duration
+        self.snapshot_failure_rate = snapshot_failure_rate
+        # CreateSnapshots needs a newer API version than boto's default
+        self.APIVersion = '2016-11-15'
+        self.calls = {}
+        self.throttled = {}
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self._instance_keys = []
+        self._volume_keys = []
+        self._snapshot_keys = []
+        self._snapshots_by_volume = {}
+        self._in_progress = {}
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+
+    def add_instance(self, instance_id, tags=None, root_volume_id=None):
+        """ Add an instance to the fake account
+
+        Volumes are attached to the instance with add_volume.
+
+        :type instance_id: str
+        :param instance_id: Instance ID
+        :type tags: dict
+        :param tags: Instance tags
+        :type root_volume_id: str
+        :param root_volume_id: ID of the root volume of the instance
+        :returns: None
+        """
+        with self._lock:
+            if instance_id not in self.instances:
+                bisect.insort(self._instance_keys, instance_id)
+            self.instances[instance_id] = {
+                'id': instance_id,
+                'tags': dict(tags or {}),
+                'root_volume_id': root_volume_id,
+            }
+
+    def add_volume(self, volume_id, tags=None, instance_id=None):
+        """ Add a volume to the fake account
+
+        :type volume_id: str
+        :param volume_id: Volume ID
+        :type tags: dict
+        :param tags: Volume tags
+        :type instance_id: str
+        :param instance_id: Instance the volume is attached to
+        :returns: None
+        """
+        with self._lock:
+            if volume_id not in self.volumes:
+                bisect.insort(self._volume_keys, volume_id)
+            self.volumes[volume_id] = {
+                'id': volume_id,
+                'tags': dict(tags or {}),
+                'instance_id': instance_id,
+            }
+
+    def add_snapshot(self, volume_id, start_time, status='completed',
+                     tags=None):
+        """ Add a snapshot to the fake account
+
+        :type volume_id: str
+        :param volume_id: Volume ID
+        :type start_time: datetime.datetime
+        :param start_time: Start time (UTC)
+        :type status: str
+        :param status: Snapshot status
+        :type tags: dict
+        :param tags: Snapshot tags
+        :returns: str -- Snapshot ID
+        """
+        with self._lock:
+            snapshot_id = 'snap-{:017x}'.format(next(self._ids))
+            self.snapshots[snapshot_id] = {
+                'id': snapshot_id,
+                'volume_id': volume_id,
+                'start_time': start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'status': status,
+                'tags': dict(tags or {}),
+            }
+            # IDs are increasing, so the key list stays sorted
+            self._snapshot_keys.append(snapshot_id)
+            self._snapshots_by_volume.setdefault(
+                volume_id, []).append(snapshot_id)
+        return snapshot_id
+
+    def reset_counters(self):
+        """ Reset the API call counters """
+        self.calls = {}
+        self.throttled = {}
+
+    def _call(self, action, params):
+        """ Count, delay and maybe throttle an API call """
+        with self._lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            throttle = self._random.random() < self.throttle_rate
+            if throttle:
+                self.throttled[action] = self.throttled.get(action, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            self._fail(
+                action, params, 'RequestLimitExceeded',
+                'Request limit exceeded.', 503)
+
+    def _finish_snapshots(self):
+        """ Complete or fail the created snapshots that are done """
+        now = time.time()
+        for snapshot_id, done in list(self._in_progress.items()):
+            if done > now:
+                continue
+            del self._in_progress[snapshot_id]
+            data = self.snapshots.get(snapshot_id)
+            if data is None:
+                continue
+            if self._random.random() < self.snapshot_failure_rate:
+                data['status'] = 'error'
+            else:
+                data['status'] = 'completed'
+
+    def _fail(self, action, params, code, message, status=400):
+        """ Fail an API call like EC2 does
+
+        The error is served as the HTTP response to a real boto request, so
+        5xx errors go through boto's retries and end in a BotoServerError,
+        and 4xx errors raise an EC2ResponseError.
+        """
+        self._local.response = _FakeHTTPResponse(
+            status, ERROR_BODY.format(code=code, message=message))
+        try:
+            response = self.make_request(action, params)
+        finally:
+            self._local.response = None
+        raise self.ResponseError(
+            response.status, response.reason, response.read())
+
+    def get_http_connection(self, host, port, is_secure):
+        return _FakeHTTPConnection(self._local.response)
+
+    def new_http_connection(self, host, port, is_secure):
+        return _FakeHTTPConnection(self._local.response)
+
+    def put_http_connection(self, host, port, is_secure, connection):
+        pass
+
+    def _volume(self, data):
+        """ Build a boto Volume from a stored volume """
+        volume = Volume(self)
+        volume.id = data['id']
+        volume.status = 'in-use' if data['instance_id'] else 'available'
+        volume.tags.update(data['tags'])
+        return volume
+
+    def _reservation(self, data):
+        """ Build a boto Reservation of one stored instance """
+        instance = Instance(self)
+        instance.id = data['id']
+        instance.tags.update(data['tags'])
+        reservation = Reservation(self)
+        reservation.instances.append(instance)
+        return reservation
+
+    def _snapshot(self, data):
+        """ Build a boto Snapshot from a stored snapshot """
+        snapshot = Snapshot(self)
+        snapshot.id = data['id']
+        snapshot.volume_id = data['volume_id']
+        snapshot.start_time = data['start_time']
+        snapshot.status = data['status']
+        snapshot.tags.update(data['tags'])
+        return snapshot
+
+    @staticmethod
+    def _page(keys, store, params, filters):
+        """ Select one page of matching items
+
+        The NextToken is the last key of the previous page, so each page
+        only scans the keys it returns.
+
+        :type keys: list
+        :param keys: Sorted candidate keys
+        :type store: dict
+        :param store: {key: stored item}
+        :type params: dict
+        :param params: Request parameters
+        :type filters: dict
+        :param filters: {name: [values]}
+        :returns: tuple -- ([stored items], next token or None)
+        """
+        start = 0
+        if params.get('NextToken'):
+            start = bisect.bisect_right(keys, params['NextToken'])
+        max_results = params.get('MaxResults')
+        max_results = int(max_results) if max_results else None
+
+        items = []
+        for position in range(start, len(keys)):
+            data = store.get(keys[position])
+            if data is None or not _matches(data, filters):
+                continue
+            items.append(data)
+            if len(items) == max_results:
+                if position + 1 < len(keys):
+                    return items, keys[position]
+                break
+        return items, None
+
+    def get_list(self, action, params, markers, path='/', parent=None,
+                 verb='GET'):
+        self._call(action, params)
+        result = ResultSet(markers)
+        filters = _filters(params)
+
+        with self._lock:
+            if action == 'DescribeInstances':
+                items, result.next_token = self._page(
+                    sorted(_indexed(params, 'InstanceId')) or
+                    self._instance_keys,
+                    self.instances, params, filters)
+                result.extend(self._reservation(item) for item in items)
+
+            elif action == 'CreateSnapshots':
+                result.extend(self._create_snapshots(params))
+
+            elif action == 'DescribeVolumes':
+                keys = _indexed(params, 'VolumeId')
+                for volume_id in keys:
+                    if volume_id not in self.volumes:
+                        self._fail(
+                            action, params, 'InvalidVolume.NotFound',
+                            'The volume {} does not exist.'.format(volume_id))
+                items, result.next_token = self._page(
+                    sorted(keys) or self._volume_keys, self.volumes,
+                    params, filters)
+                result.extend(self._volume(item) for item in items)
+
+            elif action == 'DescribeSnapshots':
+                self._finish_snapshots()
+                keys = _indexed(params, 'SnapshotId')
+                if not keys and 'volume-id' in filters:
+                    for volume_id in filters['volume-id']:
+                        keys.extend(
+                            self._snapshots_by_volume.get(volume_id, []))
+                    keys.sort()
+                elif not keys:
+                    keys = self._snapshot_keys
+                items, result.next_token = self._page(
+                    keys, self.snapshots, params, filters)
+                result.extend(self._snapshot(item) for item in items)
+
+            else:
+                raise NotImplementedError(action)
+
+        return result
+
+    def _create_snapshots(self, params):
+        """ Snapshot all volumes attached to an instance
+
+        :type params: dict
+        :param params: CreateSnapshots request parameters
+        :returns: list -- [boto.ec2.snapshot.Snapshot]
+        """
+        instance_id = params['InstanceSpecification.InstanceId']
+        instance = self.instances.get(instance_id)
+        if instance is None:
+            self._fail(
+                'CreateSnapshots', params, 'InvalidInstanceID.NotFound',
+                'The instance ID {} does not exist'.format(instance_id))
+        exclude_boot = (
+            params.get('InstanceSpecification.ExcludeBootVolume') == 'true')
+
+        tags = {}
+        for i in itertools.count(1):
+            key = params.get('TagSpecification.1.Tag.{}.Key'.format(i))
+            if key is None:
+                break
+            tags[key] = params.get(
+                'TagSpecification.1.Tag.{}.Value'.format(i), '')
+
+        start_time = datetime.datetime.utcnow()
+        snapshots = []
+        for volume in sorted(self.volumes.values(), key=lambda v: v['id']):
+            if volume['instance_id'] != instance_id:
+                continue
+            if exclude_boot and volume['id'] == instance['root_volume_id']:
+                continue
+
+            snapshot_tags = {}
+            if params.get('CopyTagsFromSource') == 'volume':
+                snapshot_tags.update(volume['tags'])
+            snapshot_tags.update(tags)
+
+            snapshot_id = self.add_snapshot(
+                volume['id'], start_time, status='pending',
+                tags=snapshot_tags)
+            self._in_progress[snapshot_id] = (
+                time.time() + self.snapshot_duration)
+            snapshots.append(self._snapshot(self.snapshots[snapshot_id]))
+
+        return snapshots
+
+    def get_object(self, action, params, cls, path='/', parent=None,
+                   verb='GET'):
+        self._call(action, params)
+
+        if action == 'CreateSnapshot':
+            volume_id = params['VolumeId']
+            if volume_id not in self.volumes:
+                self._fail(
+                    action, params, 'InvalidVolume.NotFound',
+                    'The volume {} does not exist.'.format(volume_id))
+            with self._lock:
+                snapshot_id = self.add_snapshot(
+                    volume_id, datetime.datetime.utcnow(), status='pending')
+                self._in_progress[snapshot_id] = (
+                    time.time() + self.snapshot_duration)
+                return self._snapshot(self.snapshots[snapshot_id])
+
+        raise NotImplementedError(action)
+
+    def get_status(self, action, params, path='/', parent=None, verb='GET'):
+        self._call(action, params)
+
+        if action == 'DeleteSnapshot':
+            with self._lock:
+                data = self.snapshots.pop(params['SnapshotId'], None)
+                if data is None:
+                    self._fail(
+                        action, params, 'InvalidSnapshot.NotFound',
+                        'The snapshot {} does not exist.'.format(
+                            params['SnapshotId']))
+                # Stale entries in the key lists are skipped when paging
+                self._snapshots_by_volume[data['volume_id']].remove(data['id'])
+            return True
+
+        if action in ('CreateTags', 'DeleteTags'):
+            resource_ids = _indexed(params, 'ResourceId')
+            tags = {}
+            for i in itertools.count(1):
+                key = params.get('Tag.{}.Key'.format(i))
+                if key is None:
+                    break
+                tags[key] = params.get('Tag.{}.Value'.format(i), '')
+            with self._lock:
+                for resource_id in resource_ids:
+                    data = (
+                        self.instances.get(resource_id) or
+                        self.volumes.get(resource_id) or
+                        self.snapshots.get(resource_id))
+                    if data is None:
+                        continue
+                    for tag, value in tags.items():
+                        if action == 'CreateTags':
+                            data['tags'][tag] = value
+                        else:
+                            data['tags'].pop(tag, None)
+            return True
+
+        raise NotImplementedError(action)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+""" Benchmark the snapshot and retention paths against a fake EC2 backend
+
+Each benchmark runs in its own subprocess against a freshly generated fleet
+of volumes and snapshots held by benchmarks.fake_ec2.FakeEC2Connection, and
+reports the wall time, the number of API calls per action and the peak
+memory of the process.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --volumes 10000 --snapshots 50
+"""
+import argparse
+import datetime
+import json
+import logging
+import os.path
+import random
+import resource
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+BENCHMARKS = ['run', 'run-bulk', 'plan', 'list', 'list-snapshots']
+
+# Seconds between snapshots of a volume, per interval
+INTERVALS = {
+    'hourly': 3600,
+    'daily': 86400,
+    'weekly': 604800,
+}
+
+
+def build_fleet(connection, volumes, snapshots, seed=0):
+    """ Populate a fake EC2 account with watched volumes and snapshots
+
+    Volumes get a random interval and a retention around the number of
+    snapshots, so a run both creates and deletes snapshots.
+
+    :type connection: fake_ec2.FakeEC2Connection
+    :param connection: Fake EC2 connection
+    :type volumes: int
+    :param volumes: Number of watched volumes
+    :type snapshots: int
+    :param snapshots: Number of snapshots per volume
+    :type seed: int
+    :param seed: Random seed
+    :returns: None
+    """
+    generator = random.Random(seed)
+    now = datetime.datetime.utcnow()
+
+    for number in range(volumes):
+        volume_id = 'vol-{:017x}'.format(number)
+        interval = generator.choice(sorted(INTERVALS))
+        retention = max(1, snapshots + generator.randint(-2, 2))
+        connection.add_volume(
+            volume_id,
+            tags={
+                'Name': 'volume-{}'.format(number),
+                'AutomatedEBSSnapshots': interval,
+                'AutomatedEBSSnapshotsRetention': str(retention)
+            },
+            instance_id='i-{:017x}'.format(number // 2))
+
+        # Half of the volumes are due for a new snapshot
+        offset = generator.random() * INTERVALS[interval] * 2
+        for age in range(snapshots):
+            connection.add_snapshot(
+                volume_id,
+                now - datetime.timedelta(
+                    seconds=offset + age * INTERVALS[interval]))
+
+
+def run_benchmark(name, options):
+    """ Run one benchmark in this process
+
+    :type name: str
+    :param name: Benchmark name
+    :type options: argparse.Namespace
+    :param options: Command line options
+    :returns: dict -- Benchmark result
+    """
+    if options.engine == 'gevent':
+        # Patch the standard library before boto is imported
+        from automated_ebs_snapshots import worker_pool
+        worker_pool.use_gevent()
+
+    from fake_ec2 import FakeEC2Connection
+    from automated_ebs_snapshots import rate_limiter
+    from automated_ebs_snapshots import snapshot_manager
+    from automated_ebs_snapshots import volume_manager
+    logging.getLogger().setLevel(logging.WARNING)
+
+    connection = FakeEC2Connection(
+        latency=options.latency,
+        throttle_rate=options.throttle_rate,
+        seed=options.seed)
+    build_fleet(connection, options.volumes, options.snapshots, options.seed)
+    if options.rate_limit:
+        rate_limiter.throttle_connection(connection)
+    setup_memory = _get_peak_memory()
+
+    start = time.time()
+    if name == 'run':
+        snapshot_manager.run(connection, workers=options.workers)
+    elif name == 'run-bulk':
+        snapshot_manager.run(connection, bulk=True, workers=options.workers)
+    elif name == 'plan':
+        snapshot_manager.plan(connection, bulk=True)
+    elif name == 'list':
+        volume_manager.list(connection)
+    elif name == 'list-snapshots':
+        volume_manager.list_snapshots(connection, 'vol-{:017x}'.format(0))
+    wall_time = time.time() - start
+
+    return {
+        'benchmark': name,
+        'wall_time': wall_time,
+        'api_calls': connection.calls,
+        'throttled': connection.throttled,
+        'setup_memory': setup_memory,
+        'peak_memory': _get_peak_memory()
+    }
+
+
+def _get_peak_memory():
+    """ Get the peak resident memory of this process
+
+    :returns: int -- Kilobytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # ru_maxrss is in bytes on OS X
+        peak //= 1024
+    return peak
+
+
+def _run_in_subprocess(name, argv):
+    """ Run one benchmark in a new process, for separate peak memory
+
+    :type name: str
+    :param name: Benchmark name
+    :type argv: list
+    :param argv: Command line options to pass on
+    :returns: dict -- Benchmark result
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--single', name] + argv)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def _print_results(results):
+    """ Print a table of benchmark results
+
+    :type results: list
+    :param results: Benchmark results
+    :returns: None
+    """
+    separator = '+{}+{}+{}+{}+{}+'.format(
+        '-' * 16, '-' * 12, '-' * 14, '-' * 14, '-' * 32)
+    row = '| {:<14} | {:>10} | {:>12} | {:>12} | {:<30} |'
+    print(separator)
+    print(row.format(
+        'Benchmark', 'Wall time', 'Setup (kB)', 'Peak (kB)', 'API calls'))
+    print(separator)
+    for result in results:
+        actions = sorted(result['api_calls'].items()) or [('-', '')]
+        for number, (action, count) in enumerate(actions):
+            throttled = result['throttled'].get(action)
+            if throttled:
+                count = '{} ({} throttled)'.format(count, throttled)
+            calls = '{} {}'.format(action, count)
+            if number == 0:
+                print(row.format(
+                    result['benchmark'],
+                    '{:.2f}s'.format(result['wall_time']),
+                    result['setup_memory'],
+                    result['peak_memory'],
+                    calls))
+            else:
+                print(row.format('', '', '', '', calls))
+        print(separator)
+
+
+def main():
+    """ Main function """
+    parser = argparse.ArgumentParser(
+        description='Benchmark Automated EBS Snapshots against a fake EC2')
+    parser.add_argument(
+        '--volumes',
+        type=int,
+        default=1000,
+        help='Number of watched volumes. Default: 1000')
+    parser.add_argument(
+        '--snapshots',
+        type=int,
+        default=50,
+        help='Number of snapshots per volume. Default: 50')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of workers for the run benchmarks. Default: 1')
+    parser.add_argument(
+        '--engine',
+        default='threads',
+        choices=['threads', 'gevent'],
+        help='Concurrency engine of the workers. Default: threads')
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='Seconds of latency per API call. Default: 0')
+    parser.add_argument(
+        '--throttle-rate',
+        type=float,
+        default=0.0,
+        help=(
+            'Share of API calls [0-1] failing with RequestLimitExceeded. '
+            'Use with --rate-limit. Default: 0'))
+    parser.add_argument(
+        '--rate-limit',
+        action='store_true',
+        help=(
+            'Rate limit and retry API calls like a real connection. '
+            'Wall times are then bound by the API rate limits'))
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Random seed for the fleet and throttling. Default: 0')
+    parser.add_argument(
+        '--benchmark',
+        action='append',
+        choices=BENCHMARKS,
+        help='Benchmark to run, may be repeated. Default: all')
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print the results as JSON')
+    parser.add_argument(
+        '--single',
+        choices=BENCHMARKS,
+        help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.single:
+        print(json.dumps(run_benchmark(options.single, options)))
+        return
+
+    argv = [
+        '--volumes', str(options.volumes),
+        '--snapshots', str(options.snapshots),
+        '--workers', str(options.workers),
+        '--engine', options.engine,
+        '--latency', str(options.latency),
+        '--throttle-rate', str(options.throttle_rate),
+        '--seed', str(options.seed)
+    ]
+    if options.rate_limit:
+        argv.append('--rate-limit')
+
+    results = [
+        _run_in_subprocess(name, argv)
+        for name in options.benchmark or BENCHMARKS]
+
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        _print_results(results)
+
+
+if __name__ == '__main__':
+    main()
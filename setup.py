@@ -22,6 +22,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=['boto >= 2.29.1'],
+    extras_require={'gevent': ['gevent']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Console',
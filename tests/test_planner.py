@@ -0,0 +1,96 @@
+""" Tests for the expiry of snapshots by the planner """
+import unittest
+
+from automated_ebs_snapshots import planner
+from automated_ebs_snapshots.snapshot_record import GROUP_TAG
+from automated_ebs_snapshots.snapshot_record import SnapshotRecord
+
+
+def _snapshot(snapshot_id, start_time, status='completed', group=None):
+    """ Create a snapshot record of vol-1
+
+    :returns: SnapshotRecord
+    """
+    tags = {GROUP_TAG: group} if group else None
+    return SnapshotRecord(snapshot_id, 'vol-1', start_time, status, tags)
+
+
+def _ids(snapshots):
+    """ Get the sorted IDs of snapshots
+
+    :returns: list
+    """
+    return sorted(snapshot.id for snapshot in snapshots)
+
+
+class SelectExpiredTests(unittest.TestCase):
+    """ Tests for planner.select_expired """
+    def test_pending_not_counted(self):
+        snapshots = [
+            _snapshot('snap-1', 100),
+            _snapshot('snap-2', 200, 'pending'),
+        ]
+        self.assertEqual(planner.select_expired(snapshots, [(None, 1)]), [])
+
+    def test_failed_before_completed(self):
+        snapshots = [
+            _snapshot('snap-1', 100, 'error'),
+            _snapshot('snap-2', 200),
+            _snapshot('snap-3', 300, 'error'),
+        ]
+        self.assertEqual(
+            _ids(planner.select_expired(snapshots, [(None, 5)])),
+            ['snap-1'])
+
+    def test_failed_without_completed(self):
+        snapshots = [
+            _snapshot('snap-1', 100, 'error'),
+            _snapshot('snap-2', 200, 'pending'),
+        ]
+        self.assertEqual(planner.select_expired(snapshots, [(None, 5)]), [])
+
+    def test_sorted_by_start_time(self):
+        snapshots = [
+            _snapshot('snap-1', 100),
+            _snapshot('snap-2', 150, 'error'),
+            _snapshot('snap-3', 200),
+            _snapshot('snap-4', 300),
+        ]
+        self.assertEqual(
+            [snapshot.id for snapshot in
+             planner.select_expired(snapshots, [(None, 1)])],
+            ['snap-1', 'snap-2', 'snap-3'])
+
+    def test_keep_all(self):
+        snapshots = [
+            _snapshot('snap-1', 100, 'error'),
+            _snapshot('snap-2', 200),
+        ]
+        self.assertEqual(planner.select_expired(snapshots, []), [])
+
+
+class SelectExpiredGroupsTests(unittest.TestCase):
+    """ Tests for planner.select_expired_groups """
+    def test_failed_set_before_completed_set(self):
+        snapshots = [
+            _snapshot('snap-1', 100, 'completed', 'i-1:100'),
+            _snapshot('snap-2', 100, 'error', 'i-1:100'),
+            _snapshot('snap-3', 200, 'completed', 'i-1:200'),
+            _snapshot('snap-4', 200, 'completed', 'i-1:200'),
+        ]
+        self.assertEqual(
+            _ids(planner.select_expired_groups(snapshots, [(None, 5)])),
+            ['snap-1', 'snap-2'])
+
+    def test_failed_set_after_completed_set(self):
+        snapshots = [
+            _snapshot('snap-1', 100, 'completed', 'i-1:100'),
+            _snapshot('snap-2', 200, 'completed', 'i-1:200'),
+            _snapshot('snap-3', 200, 'error', 'i-1:200'),
+        ]
+        self.assertEqual(
+            planner.select_expired_groups(snapshots, [(None, 5)]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+""" Tests for the retention policies """
+import calendar
+import unittest
+
+from automated_ebs_snapshots import retention
+
+
+def _timestamp(year, month, day, hour=0, minute=0, second=0):
+    """ Get the UNIX timestamp of a UTC time
+
+    :returns: int
+    """
+    return calendar.timegm((year, month, day, hour, minute, second))
+
+
+def _expired(timestamps, value):
+    """ Select the expired timestamps of a retention tag value
+
+    :type timestamps: list
+    :param timestamps: UNIX timestamps of the snapshots
+    :type value: str
+    :param value: Retention tag value
+    :returns: list -- Expired timestamps, oldest first
+    """
+    return retention.select_expired(
+        timestamps, retention.parse_policy(value), key=lambda x: x)
+
+
+class ParsePolicyTests(unittest.TestCase):
+    """ Tests for retention.parse_policy """
+    def test_count(self):
+        self.assertEqual(retention.parse_policy('7'), [(None, 7)])
+        self.assertEqual(retention.parse_policy(3), [(None, 3)])
+
+    def test_zero_keeps_all(self):
+        self.assertEqual(retention.parse_policy('0'), [])
+        self.assertEqual(retention.parse_policy(0), [])
+        self.assertEqual(retention.parse_policy('h0,d0'), [])
+
+    def test_tiers(self):
+        self.assertEqual(
+            retention.parse_policy('h24,d14,w8,m12,y2'),
+            [('h', 24), ('d', 14), ('w', 8), ('m', 12), ('y', 2)])
+
+    def test_whitespace_and_case(self):
+        self.assertEqual(
+            retention.parse_policy(' H24, d7 '), [('h', 24), ('d', 7)])
+
+    def test_zero_tiers_are_dropped(self):
+        self.assertEqual(retention.parse_policy('d0,w4'), [('w', 4)])
+
+    def test_invalid(self):
+        for value in ['-1', '', 'x3', 'd', 'd-1', 'd1.5', 'd3,d4', '3d',
+                      'd3;w4', 'd3,', 'keep']:
+            self.assertRaises(ValueError, retention.parse_policy, value)
+
+    def test_format_round_trip(self):
+        for value in ['0', '5', 'h24,d14,w8,m12']:
+            self.assertEqual(
+                retention.format_policy(retention.parse_policy(value)),
+                value)
+
+    def test_max_kept(self):
+        self.assertEqual(
+            retention.max_kept(retention.parse_policy('h24,d14')), 38)
+        self.assertEqual(retention.max_kept(retention.parse_policy('5')), 5)
+        self.assertEqual(retention.max_kept(retention.parse_policy('0')), 0)
+
+
+class SelectExpiredTests(unittest.TestCase):
+    """ Tests for retention.select_expired """
+    def test_keep_all(self):
+        timestamps = range(0, 864000, 3600)
+        self.assertEqual(_expired(timestamps, '0'), [])
+
+    def test_count(self):
+        timestamps = [50, 10, 40, 30, 20]
+        self.assertEqual(_expired(timestamps, '3'), [10, 20])
+
+    def test_count_larger_than_items(self):
+        self.assertEqual(_expired([10, 20], '3'), [])
+
+    def test_count_keeps_same_second(self):
+        # Count mode keeps items, not periods
+        self.assertEqual(_expired([10, 10, 10], '2'), [10])
+
+    def test_empty(self):
+        self.assertEqual(_expired([], 'h24,d14'), [])
+
+    def test_hour_boundary(self):
+        timestamps = [
+            _timestamp(2020, 1, 1, 9, 30),
+            _timestamp(2020, 1, 1, 10, 0),
+            _timestamp(2020, 1, 1, 10, 59, 59),
+            _timestamp(2020, 1, 1, 11, 0),
+        ]
+        self.assertEqual(
+            _expired(timestamps, 'h2'), [timestamps[0], timestamps[1]])
+
+    def test_day_boundary(self):
+        timestamps = [
+            _timestamp(2020, 1, 1, 0, 0),
+            _timestamp(2020, 1, 1, 23, 59, 59),
+            _timestamp(2020, 1, 2, 0, 0),
+        ]
+        self.assertEqual(_expired(timestamps, 'd1'), timestamps[:2])
+        self.assertEqual(_expired(timestamps, 'd2'), [timestamps[0]])
+
+    def test_week_starts_on_monday(self):
+        # 2020-01-06 was a Monday
+        timestamps = [
+            _timestamp(2020, 1, 5, 23, 59, 59),
+            _timestamp(2020, 1, 6, 0, 0),
+            _timestamp(2020, 1, 12, 23, 59, 59),
+        ]
+        self.assertEqual(_expired(timestamps, 'w2'), [timestamps[1]])
+
+    def test_month_boundary(self):
+        timestamps = [
+            _timestamp(2020, 1, 1),
+            _timestamp(2020, 1, 31, 23, 59, 59),
+            _timestamp(2020, 2, 1),
+            _timestamp(2020, 2, 29, 12),
+        ]
+        self.assertEqual(
+            _expired(timestamps, 'm2'), [timestamps[0], timestamps[2]])
+
+    def test_year_boundary(self):
+        timestamps = [
+            _timestamp(2019, 6, 1),
+            _timestamp(2019, 12, 31, 23, 59, 59),
+            _timestamp(2020, 1, 1),
+        ]
+        self.assertEqual(_expired(timestamps, 'y2'), [timestamps[0]])
+
+    def test_only_periods_with_snapshots_count(self):
+        # The two days without snapshots do not use up the daily tier
+        timestamps = [
+            _timestamp(2020, 1, 1, 12),
+            _timestamp(2020, 1, 2, 12),
+            _timestamp(2020, 1, 5, 12),
+        ]
+        self.assertEqual(_expired(timestamps, 'd2'), [timestamps[0]])
+
+    def test_tiers_overlap(self):
+        # The newest snapshot is kept by both tiers, so h2,d3 keeps the
+        # newest of two hours and of two more days
+        timestamps = [
+            _timestamp(2020, 1, 1, 12),
+            _timestamp(2020, 1, 2, 12),
+            _timestamp(2020, 1, 3, 10),
+            _timestamp(2020, 1, 3, 11),
+            _timestamp(2020, 1, 3, 11, 30),
+            _timestamp(2020, 1, 3, 12),
+        ]
+        self.assertEqual(
+            _expired(timestamps, 'h2,d3'), [timestamps[2], timestamps[3]])
+
+    def test_expired_oldest_first(self):
+        timestamps = [_timestamp(2020, 1, day) for day in (3, 1, 4, 2, 5)]
+        self.assertEqual(
+            _expired(timestamps, 'd2'),
+            [_timestamp(2020, 1, day) for day in (1, 2, 3)])
+
+    def test_key(self):
+        items = [{'start': 20}, {'start': 10}, {'start': 30}]
+        self.assertEqual(
+            retention.select_expired(
+                items, [(None, 1)], key=lambda item: item['start']),
+            [{'start': 10}, {'start': 20}])
+
+
+if __name__ == '__main__':
+    unittest.main()